@@ -0,0 +1,58 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+MODULES = [
+    "healthsageai.note_to_fhir.parsers",
+    "healthsageai.note_to_fhir.data_utils",
+    "healthsageai.note_to_fhir.evaluation.utils",
+    "healthsageai.note_to_fhir.evaluation.corpus",
+    "healthsageai.note_to_fhir.inference",
+]
+# Dependencies that should only be imported when they are used
+HEAVY_DEPENDENCIES = ["torch", "transformers", "pandas", "scipy", "fhir.resources.R4B.patient", "plotly"]
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure_import(module: str) -> dict:
+    """Import a module in a fresh interpreter, so nothing is cached in sys.modules
+
+    Args:
+        module (str): module name
+
+    Returns:
+        dict: import time in seconds and the heavy dependencies that were loaded
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", _PROBE.format(module=module, heavy=HEAVY_DEPENDENCIES)],
+        check=True,
+        capture_output=True,
+        text=True,
+        env=os.environ,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run_benchmark(repeat: int = 5):
+    """Median cold-start import time of the entry points of the package"""
+    for module in MODULES:
+        results = [measure_import(module) for _ in range(repeat)]
+        seconds = statistics.median(result["seconds"] for result in results)
+        loaded = ", ".join(results[-1]["loaded"]) or "-"
+        print(f"{module:<48}{1e3 * seconds:9.1f} ms    heavy dependencies: {loaded}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="number of fresh interpreters per module")
+    run_benchmark(parser.parse_args().repeat)
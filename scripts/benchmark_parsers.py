@@ -0,0 +1,59 @@
+import json
+import timeit
+import marko
+from healthsageai.note_to_fhir.parsers import extract_from_code_block, parse_json
+
+
+def extract_from_code_block_marko(markdown):
+    """The previous, marko based implementation of extract_from_code_block"""
+    parsed = marko.Parser().parse(markdown)
+    code_block = [elem for elem in parsed.children if isinstance(
+        elem, marko.block.FencedCode)]
+    if len(code_block) > 0:
+        raw_data = code_block[0].children[0].children
+        return ''.join(raw_data)
+    else:
+        return markdown if '\n\n' not in markdown else markdown.split('\n\n')[1]
+
+
+def make_generated_text(n_entries: int) -> str:
+    """Synthetic model output: some text followed by a Bundle with n_entries entries in a json code block"""
+    bundle = {
+        "resourceType": "Bundle",
+        "type": "collection",
+        "entry": [
+            {
+                "resource": {
+                    "resourceType": "Observation",
+                    "id": str(i),
+                    "status": "final",
+                    "code": {"coding": [{"display": "Body mass index"}], "text": "BMI"},
+                    "subject": {"reference": "Patient/1"},
+                    "valueQuantity": {"value": 30.7, "unit": "kg/m2"},
+                }
+            }
+            for i in range(n_entries)
+        ],
+    }
+    return "~\nHere is the FHIR:\n\n```json\n" + json.dumps(bundle, indent=2) + "\n```\n"
+
+
+def run_benchmark():
+    """Compare the fence scanner with the marko and regex based extraction"""
+    for n_entries in [1, 10, 100, 1000]:
+        text = make_generated_text(n_entries)
+        assert extract_from_code_block(text) == extract_from_code_block_marko(text)
+        number = max(1, 1000 // n_entries)
+        print(f"{n_entries} entries, {len(text)} characters:")
+        for name, extract in [
+            ("fence scanner", extract_from_code_block),
+            ("marko", extract_from_code_block_marko),
+            ("regex", parse_json),
+            ("json.loads", lambda text: json.loads(extract_from_code_block(text))),
+        ]:
+            seconds = min(timeit.repeat(lambda: extract(text), number=number, repeat=3))
+            print(f"    {name:<15}{1e6 * seconds / number:12.1f} us")
+
+
+if __name__ == "__main__":
+    run_benchmark()
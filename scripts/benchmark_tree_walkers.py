@@ -0,0 +1,273 @@
+import copy
+import timeit
+import tracemalloc
+from healthsageai.note_to_fhir.data_utils import (
+    DropNones,
+    DropSnomedLoincCodes,
+    FhirNormalizer,
+    drop_code,
+    drop_nones,
+    drop_snomed_loinc,
+)
+from healthsageai.note_to_fhir.evaluation.utils import (
+    _NO_COUNTS,
+    _add_counts,
+    _compare_leaf_counts,
+    _get_counts,
+    diff_to_list,
+    element_is_absent,
+    fhirtype_is_leaf,
+    get_diff,
+    match_list_len,
+    optimize_array_order,
+    resource_details_registry,
+)
+from healthsageai.note_to_fhir.evaluation.visuals import preprocess_for_treemap
+
+
+def drop_nones_recursive(d: dict) -> dict:
+    """The previous, recursive implementation of drop_nones"""
+    dd = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            dd[k] = drop_nones_recursive(v)
+        elif isinstance(v, (list, set, tuple)):
+            dd[k] = type(v)(drop_nones_recursive(vv) if isinstance(vv, dict) else vv
+                            for vv in v)
+        elif v is not None:
+            dd[k] = v
+    return dd
+
+
+def drop_snomed_loinc_recursive(d):
+    """The previous, recursive implementation of drop_snomed_loinc"""
+    dd = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            dd[k] = drop_snomed_loinc_recursive(v)
+        elif isinstance(v, list) and k != "coding":
+            dd[k] = [drop_snomed_loinc_recursive(vv) if isinstance(vv, dict) else vv
+                     for vv in v]
+        elif k == 'coding' and isinstance(v, list):
+            dd[k] = [drop_code(code) if "snomed" in code.get("system", "") or "loinc" in code.get("system", "") else code
+                     for code in v]
+        else:
+            dd[k] = v
+    return dd
+
+
+class FhirNormalizerRecursive(FhirNormalizer):
+    """The previous, recursive implementation of FhirNormalizer"""
+
+    def __call__(self, fhir):
+        return self._normalize(fhir, [])
+
+    def _normalize(self, value, path: list):
+        if isinstance(value, dict):
+            node = {}
+            for key, child in value.items():
+                if self._keep_value(path, value, key, child):
+                    path.append(key)
+                    node[key] = self._normalize(child, path)
+                    path.pop()
+            return node
+        if isinstance(value, list):
+            return [self._normalize(item, path) for item in value if self._keep_item(path, item)]
+        return value
+
+
+def get_counts_recursive(fhir_true, fhir_pred, resource_name: str, key: str) -> tuple:
+    """The previous, recursive implementation of _get_counts, without a score cache"""
+    fhir_true = {} if fhir_true is None else fhir_true
+    fhir_pred = {} if fhir_pred is None else fhir_pred
+    resource = fhir_true if fhir_true else fhir_pred
+    resource_type = resource_name
+    if isinstance(resource, dict) and resource.get("resourceType"):
+        resource_type = resource["resourceType"]
+    if fhirtype_is_leaf(resource_type):
+        return _compare_leaf_counts(fhir_true, fhir_pred, key, resource_type)
+    if not isinstance(fhir_pred, dict):
+        fhir_pred = {"illegal fhirtype": fhir_pred}
+
+    counts = _NO_COUNTS
+    for element_details in resource_details_registry.get(resource_type):
+        element_true = fhir_true.get(element_details.key)
+        element_pred = fhir_pred.get(element_details.key)
+        if element_is_absent(element_true) and element_is_absent(element_pred):
+            continue
+        if element_details.is_struct:
+            if not isinstance(element_pred, dict):
+                element_pred = {}
+            childcounts = get_counts_recursive(element_true, element_pred, element_details.fhirtype,
+                                               element_details.key)
+        elif element_details.is_array:
+            if not isinstance(element_pred, list):
+                element_pred = []
+            fhir_true_child, fhir_pred_child = match_list_len(element_true, element_pred)
+            if len(fhir_true_child) > 1 or len(fhir_pred_child) > 1:
+                fhir_true_child, fhir_pred_child = optimize_array_order(fhir_true_child, fhir_pred_child,
+                                                                        element_details)
+            childcounts = _NO_COUNTS
+            for fhir_true_item, fhir_pred_item in zip(fhir_true_child, fhir_pred_child):
+                childcounts = _add_counts(childcounts, get_counts_recursive(
+                    fhir_true_item, fhir_pred_item, element_details.array_item_type, element_details.key))
+        elif element_details.is_leaf:
+            node_type = element_details.fhirtype
+            if isinstance(element_true, dict) and element_true.get("resourceType"):
+                node_type = element_true["resourceType"]
+            childcounts = _compare_leaf_counts(element_true, element_pred, element_details.key, node_type)
+        else:
+            childcounts = _NO_COUNTS
+        counts = _add_counts(counts, childcounts)
+    return counts
+
+
+def get_counts(fhir_true, fhir_pred, resource_name: str, key: str) -> tuple:
+    return _get_counts(fhir_true, fhir_pred, resource_name, key)
+
+
+def preprocess_for_treemap_recursive(diff):
+    """The previous implementation of preprocess_for_treemap, concatenating lists at each level"""
+    labels = [diff.label]
+    parents = [diff.parent.label] if diff.parent else [""]
+    values = [diff]
+    for child in diff.children.values():
+        for item in child if isinstance(child, list) else [child]:
+            new_labels, new_parents, new_values = preprocess_for_treemap_recursive(item)
+            labels = labels + new_labels
+            parents = parents + new_parents
+            values = values + new_values
+    return labels, parents, values
+
+
+def diff_to_list_recursive(diff):
+    """The previous implementation of diff_to_list, deep copying each node"""
+    diff_flat = diff.model_copy(deep=True)
+    diff_flat.parent = None
+    diff_flat.children = None
+    diff_flat._label = None  # labels were not cached by this implementation, so they were relative to the copy
+    nodes = [diff_flat]
+    for child in diff.children.values():
+        for item in child if isinstance(child, list) else [child]:
+            nodes = nodes + diff_to_list_recursive(item)
+    return nodes
+
+
+def make_bundle(n_entries: int) -> dict:
+    """Synthetic Bundle with n_entries Observations, including Nones and SNOMED codings"""
+    return {
+        "resourceType": "Bundle",
+        "type": "collection",
+        "entry": [
+            {
+                "resource": {
+                    "resourceType": "Observation",
+                    "id": str(i),
+                    "status": "final",
+                    "issued": None,
+                    "code": {
+                        "coding": [
+                            {"system": "http://snomed.info/sct", "code": "60621009", "display": "Body mass index"},
+                            {"system": "http://example.org", "code": str(i), "display": None},
+                        ],
+                        "text": "BMI",
+                    },
+                    "subject": {"reference": "Patient/1", "display": None},
+                    "valueQuantity": {"value": 30.7 + i, "unit": "kg/m2"},
+                }
+            }
+            for i in range(n_entries)
+        ],
+    }
+
+
+def make_nested_extension(depth: int) -> dict:
+    """Synthetic Patient with extensions nested depth levels deep"""
+    extension = {"url": "http://example.org/leaf", "valueString": "x"}
+    for _ in range(depth):
+        extension = {"url": "http://example.org/node", "extension": [extension]}
+    return {"resourceType": "Patient", "extension": [extension]}
+
+
+def make_nested(depth: int) -> dict:
+    """Synthetic dict nested depth levels deep"""
+    d = {"value": 1, "none": None}
+    for _ in range(depth):
+        d = {"child": d, "none": None, "items": [{"none": None}]}
+    return d
+
+
+def measure(fn, *args, number: int = 5):
+    """Run fn, returning the result, the best wall time of number runs and the peak traced memory"""
+    seconds = min(timeit.repeat(lambda: fn(*args), number=1, repeat=number))
+    tracemalloc.start()
+    result = fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def compare(name, new, old, *args, same=lambda a, b: a == b, number: int = 5):
+    result_new, seconds_new, peak_new = measure(new, *args, number=number)
+    result_old, seconds_old, peak_old = measure(old, *args, number=number)
+    assert same(result_new, result_old), name
+    print(
+        f"    {name:<25}{1e3 * seconds_new:10.1f} ms {peak_new / 1e6:8.1f} MB   "
+        f"recursive {1e3 * seconds_old:10.1f} ms {peak_old / 1e6:8.1f} MB"
+    )
+
+
+def same_treemap(a, b):
+    return a[0] == b[0] and a[1] == b[1] and all(x is y for x, y in zip(a[2], b[2]))
+
+
+def same_diff_list(a, b):
+    return [x.model_dump() for x in a] == [x.model_dump() for x in b]
+
+
+def run_benchmark():
+    """Compare the iterative tree walkers with their recursive predecessors"""
+    for n_entries in [10, 100, 1000]:
+        bundle = make_bundle(n_entries)
+        print(f"Bundle with {n_entries} entries:")
+        compare("drop_nones", drop_nones, drop_nones_recursive, bundle)
+        compare("drop_snomed_loinc", drop_snomed_loinc, drop_snomed_loinc_recursive, bundle)
+        normalizer = FhirNormalizer([DropNones(), DropSnomedLoincCodes()])
+        normalizer_recursive = FhirNormalizerRecursive(normalizer.transforms)
+        compare("FhirNormalizer", normalizer, normalizer_recursive, bundle)
+        if n_entries > 100:
+            continue  # aligning the entries is quadratic
+        pred = copy.deepcopy(bundle)
+        pred["entry"][0]["resource"]["status"] = "preliminary"
+        compare("_get_counts", get_counts, get_counts_recursive, bundle, pred, "Bundle", "Bundle")
+        diff = get_diff(bundle, pred, "Bundle")
+        compare("preprocess_for_treemap", preprocess_for_treemap, preprocess_for_treemap_recursive, diff,
+                same=same_treemap)
+        if n_entries <= 10:
+            # the deep copy of each node includes its parents, so the whole tree
+            compare("diff_to_list", diff_to_list, diff_to_list_recursive, diff, same=same_diff_list, number=1)
+
+    depth = 5000
+    nested = make_nested(depth)
+    print(f"Dict nested {depth} levels deep:")
+    normalizer = FhirNormalizer([DropNones()])
+    check_depth("drop_nones", drop_nones, drop_nones_recursive, nested)
+    check_depth("FhirNormalizer", normalizer, FhirNormalizerRecursive(normalizer.transforms), nested)
+
+    depth = 1500
+    patient = make_nested_extension(depth)
+    print(f"Patient with extensions nested {depth} levels deep:")
+    check_depth("_get_counts", get_counts, get_counts_recursive, patient, patient, "Patient", "Patient")
+
+
+def check_depth(name, new, old, *args):
+    assert new(*args) is not None
+    try:
+        old(*args)
+        print(f"    recursive {name} succeeded")
+    except RecursionError:
+        print(f"    recursive {name} raised RecursionError, iterative {name} succeeded")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -13,6 +13,14 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from typing import List
+from healthsageai.note_to_fhir.traversal import rebuild_dict
+
+SUPPORTED_RESOURCE_TYPES = ['Observation', 'Condition', 'Procedure', 'Encounter', 'Patient', 'Organization',
+                            'Location', 'Practitioner', 'Immunization', 'AllergyIntolerance']
+SNOMED_LOINC_SYSTEMS = ['http://snomed.info/sct', 'http://loinc.org']
+
+
 def drop_code(coding: dict) -> dict:
     """Drop code for SNOMED and Loinc codings
 
@@ -28,21 +36,20 @@ def drop_code(coding: dict) -> dict:
     return coding_out
 
 def drop_snomed_loinc(d):
-    """Recursively drop Nones in dict d and return a new dict"""
-    dd = {}
+    """Drop the code of SNOMED and Loinc codings in dict d and return a new dict"""
+    return rebuild_dict(d, _drop_snomed_loinc_node)
+
+
+def _drop_snomed_loinc_node(d, dd, copy):
     for k, v in d.items():
         if isinstance(v, dict):
-            dd[k] = drop_snomed_loinc(v)
+            dd[k] = copy(v)
         elif isinstance(v, list) and k != "coding":
-            # note: Nones in lists are not dropped
-            dd[k] = [drop_snomed_loinc(vv) if isinstance(vv, dict) else vv
-                            for vv in v]
+            dd[k] = [copy(vv) if isinstance(vv, dict) else vv for vv in v]
         elif k == 'coding' and isinstance(v, list):
             dd[k] = [drop_code(code) if "snomed" in code.get("system","") or "loinc" in code.get("system","") else code for code in v]
         else:
             dd[k] = v
-            
-    return dd
 
 
 def remove_snomed_loinc_code_for_coding(key, val):
@@ -54,25 +61,145 @@ def remove_snomed_loinc_code_for_coding(key, val):
 
 
 def clean_fhir_resource(fhir: dict) -> dict:
-    return {key: remove_snomed_loinc_code_for_coding(key, val) for (key, val) in drop_nones(fhir).items()}
+    return FhirNormalizer([DropNones(), RemoveSnomedLoincCodings()])(fhir)
 
 
 def filter_supported_fhir_resources(resources: list) -> list:
-    return [res for res in resources if
-            res['resourceType'] in ['Observation', 'Condition', 'Procedure', 'Encounter', 'Patient', 'Organization',
-                                    'Location', 'Practitioner', 'Immunization', 'AllergyIntolerance']]
+    return [res for res in resources if res['resourceType'] in SUPPORTED_RESOURCE_TYPES]
 
 
 def drop_nones(d: dict) -> dict:
-    """Recursively drop Nones in dict d and return a new dict"""
-    dd = {}
+    """Drop Nones in dict d and its nested dicts and return a new dict"""
+    return rebuild_dict(d, _drop_nones_node)
+
+
+def _drop_nones_node(d, dd, copy):
     for k, v in d.items():
         if isinstance(v, dict):
-            dd[k] = drop_nones(v)
+            dd[k] = copy(v)
         elif isinstance(v, (list, set, tuple)):
             # note: Nones in lists are not dropped
-            dd[k] = type(v)(drop_nones(vv) if isinstance(vv, dict) else vv
-                            for vv in v)
+            dd[k] = type(v)(copy(vv) if isinstance(vv, dict) else vv for vv in v)
         elif v is not None:
             dd[k] = v
-    return dd
+
+
+class FhirTransform(object):
+    """A transform applied by FhirNormalizer. The hooks decide per value whether it is kept in the output.
+
+    Both hooks receive the path: the keys from the root to the current dict or list, list indices excluded.
+    """
+
+    def keep_value(self, path: list, node: dict, key: str, value) -> bool:
+        """Called for each key/value pair of dict node"""
+        return True
+
+    def keep_item(self, path: list, item) -> bool:
+        """Called for each item of the list at path"""
+        return True
+
+
+class DropNones(FhirTransform):
+    """Drop None values in dicts, see drop_nones. Nones in lists are kept."""
+
+    def keep_value(self, path: list, node: dict, key: str, value) -> bool:
+        return value is not None
+
+
+class DropSnomedLoincCodes(FhirTransform):
+    """Drop the code of SNOMED and LOINC codings, see drop_snomed_loinc"""
+
+    def keep_value(self, path: list, node: dict, key: str, value) -> bool:
+        if key != "code" or not path or path[-1] != "coding":
+            return True
+        system = node.get("system") or ""
+        return "snomed" not in system and "loinc" not in system
+
+
+class RemoveSnomedLoincCodings(FhirTransform):
+    """Remove SNOMED and LOINC codings from codes, see remove_snomed_loinc_code_for_coding"""
+
+    def keep_item(self, path: list, item) -> bool:
+        if len(path) < 2 or path[-1] != "coding" or path[-2] != "code":
+            return True
+        return not isinstance(item, dict) or item.get("system") not in SNOMED_LOINC_SYSTEMS
+
+
+class FilterSupportedResources(FhirTransform):
+    """Remove resources of unsupported types from Bundle entries and top-level lists of resources,
+    see filter_supported_fhir_resources"""
+
+    def keep_item(self, path: list, item) -> bool:
+        if path and path[-1] == "entry" and isinstance(item, dict):
+            item = item.get("resource")
+        elif path:
+            return True
+        if not isinstance(item, dict):
+            return True
+        return item.get("resourceType") in SUPPORTED_RESOURCE_TYPES
+
+
+class FhirNormalizer(object):
+    def __init__(self, transforms: List[FhirTransform]) -> None:
+        """Applies a list of transforms to FHIR in a single traversal, building each output node once.
+
+        Args:
+            transforms (List[FhirTransform]): e.g. [DropNones(), DropSnomedLoincCodes()]
+        """
+        self.transforms = transforms
+
+    def __call__(self, fhir):
+        """Normalize FHIR
+
+        Args:
+            fhir (dict or list): FHIR resource or list of resources
+
+        Returns:
+            dict or list: A normalized copy of fhir
+        """
+        # Each container is copied with the values its transforms keep when it is visited, after which its nested
+        # containers are visited from an explicit stack, so deeply nested FHIR does not hit the recursion limit.
+        # A stack entry (parent, slot, enter) normalizes parent[slot] in place, None leaves the key of a dict.
+        result = [fhir]
+        path = []
+        stack = [(result, 0, False)]
+        while stack:
+            entry = stack.pop()
+            if entry is None:
+                path.pop()
+                continue
+            parent, slot, enter = entry
+            if enter:
+                path.append(slot)
+                stack.append(None)
+            value = parent[slot]
+            nested = []  # stack entries of the nested containers of node
+            if isinstance(value, dict):
+                node = {}
+                for key, child in value.items():
+                    if self._keep_value(path, value, key, child):
+                        node[key] = child
+                        if isinstance(child, (dict, list)):
+                            nested.append((node, key, True))
+            elif isinstance(value, list):
+                node = [item for item in value if self._keep_item(path, item)]
+                nested = [(node, i, False) for i, item in enumerate(node) if isinstance(item, (dict, list))]
+            else:
+                continue
+            parent[slot] = node
+            nested.reverse()
+            stack.extend(nested)
+        return result[0]
+
+    def _keep_value(self, path: list, node: dict, key: str, value) -> bool:
+        for transform in self.transforms:
+            if not transform.keep_value(path, node, key, value):
+                return False
+        return True
+
+    def _keep_item(self, path: list, item) -> bool:
+        for transform in self.transforms:
+            if not transform.keep_item(path, item):
+                return False
+        return True
+
@@ -0,0 +1,271 @@
+#  Copyright (c) 2024. HealthSage AI.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Array-backed alternative to a tree of FhirDiff models, for evaluating large resources
+"""
+from typing import List
+import numpy as np
+from healthsageai.note_to_fhir.evaluation.datamodels import FhirDiff, FhirScore
+from healthsageai.note_to_fhir.evaluation.scores import SCORE_COLUMNS, ScoreTable
+from healthsageai.note_to_fhir.traversal import walk
+
+
+class CompactDiff(object):
+    __slots__ = (
+        "parents",
+        "keys",
+        "entry_nrs",
+        "resource_names",
+        "resource_types",
+        "strings",
+        "fhir_true",
+        "fhir_pred",
+        "scores",
+        "is_valid",
+    )
+
+    def __init__(
+        self,
+        parents: np.ndarray,
+        keys: np.ndarray,
+        entry_nrs: np.ndarray,
+        resource_names: np.ndarray,
+        resource_types: np.ndarray,
+        strings: List[str],
+        fhir_true: list,
+        fhir_pred: list,
+        scores: np.ndarray,
+        is_valid: bool = None,
+    ) -> None:
+        """A FhirDiff tree stored as a struct of arrays, one row per node in depth-first pre-order.
+
+        The root is node 0. Strings are stored as indices into strings and the payloads are references to the
+        compared FHIR elements, not copies. Use to_fhir_diff for the equivalent FhirDiff tree.
+
+        Args:
+            parents (np.ndarray): int32 index of the parent node, -1 for the root
+            keys (np.ndarray): int32 index of the key, i.e. FhirDiff.key
+            entry_nrs (np.ndarray): int32 index of array items, -1 for nodes that are not array items
+            resource_names (np.ndarray): int32 index of FhirDiff.resource_name
+            resource_types (np.ndarray): int32 index of FhirDiff.resource_type
+            strings (List[str]): the strings the indices refer to
+            fhir_true (list): ground truth fhir element per node
+            fhir_pred (list): predicted fhir element per node
+            scores (np.ndarray): int32 score counts per node, of shape (n_nodes, 5), see SCORE_COLUMNS
+            is_valid (bool, optional): whether the predicted resource is valid, FhirScore.is_valid of the root
+        """
+        self.parents = parents
+        self.keys = keys
+        self.entry_nrs = entry_nrs
+        self.resource_names = resource_names
+        self.resource_types = resource_types
+        self.strings = strings
+        self.fhir_true = fhir_true
+        self.fhir_pred = fhir_pred
+        self.scores = scores
+        self.is_valid = is_valid
+
+    def __len__(self) -> int:
+        return len(self.parents)
+
+    @property
+    def score(self) -> FhirScore:
+        """FhirScore of the root node"""
+        score = self.node_score(0)
+        score.is_valid = self.is_valid
+        return score
+
+    def node_score(self, idx: int) -> FhirScore:
+        """FhirScore of a node
+
+        Args:
+            idx (int): node index
+
+        Returns:
+            FhirScore: score of the node
+        """
+        return FhirScore(**dict(zip(SCORE_COLUMNS, self.scores[idx].tolist())))
+
+    def score_table(self) -> ScoreTable:
+        """The scores of all nodes, for computing metrics column-wise"""
+        return ScoreTable(self.scores)
+
+    def key(self, idx: int) -> str:
+        return self.strings[self.keys[idx]]
+
+    def entry_nr(self, idx: int) -> str:
+        entry_nr = self.entry_nrs[idx]
+        return "" if entry_nr < 0 else str(entry_nr)
+
+    def resource_type(self, idx: int) -> str:
+        return self.strings[self.resource_types[idx]]
+
+    def labels(self) -> List[str]:
+        """Labels of all nodes, as FhirDiff.label
+
+        Returns:
+            List[str]: label per node
+        """
+        labels = []
+        for idx, parent in enumerate(self.parents.tolist()):
+            parent_label = labels[parent] if parent >= 0 else ""
+            key = self.key(idx)
+            keylabel = key if key != "resource" else self.resource_type(idx)
+            labels.append(".".join([parent_label, keylabel, self.entry_nr(idx)]).strip("."))
+        return labels
+
+    def nbytes(self) -> int:
+        """Size of the arrays, excluding the shared payloads and strings"""
+        arrays = [self.parents, self.keys, self.entry_nrs, self.resource_names, self.resource_types, self.scores]
+        return sum(array.nbytes for array in arrays) + 2 * 8 * len(self)
+
+    def to_fhir_diff(self) -> FhirDiff:
+        """Convert to the equivalent FhirDiff tree. Arrays without items are not added to the children.
+
+        Returns:
+            FhirDiff: the root node
+        """
+        nodes = []
+        for idx, parent in enumerate(self.parents.tolist()):
+            node = FhirDiff(
+                fhir_true=self.fhir_true[idx],
+                fhir_pred=self.fhir_pred[idx],
+                resource_name=self.strings[self.resource_names[idx]],
+                parent=nodes[parent] if parent >= 0 else None,
+                entry_nr=self.entry_nr(idx),
+                key=self.key(idx),
+                score=self.node_score(idx) if idx else self.score,
+            )
+            nodes.append(node)
+            if parent < 0:
+                continue
+            if self.entry_nrs[idx] >= 0:
+                nodes[parent].children.setdefault(node.key, []).append(node)
+            else:
+                nodes[parent].children[node.key] = node
+        return nodes[0]
+
+    @classmethod
+    def from_fhir_diff(cls, diff: FhirDiff) -> "CompactDiff":
+        """Convert a FhirDiff tree
+
+        Args:
+            diff (FhirDiff): root node
+
+        Returns:
+            CompactDiff: the equivalent CompactDiff
+        """
+        builder = CompactDiffBuilder()
+        idxs = {}
+        for node in walk(diff, FhirDiff.iter_children):
+            parent = idxs[id(node.parent)] if node.parent is not None else -1
+            idx = builder.add(
+                parent,
+                node.key,
+                int(node.entry_nr) if node.entry_nr else -1,
+                node.resource_name,
+                node.resource_type,
+                node.fhir_true,
+                node.fhir_pred,
+            )
+            idxs[id(node)] = idx
+            builder.counts[idx] = tuple(getattr(node.score, column) for column in SCORE_COLUMNS)
+        compact = builder.build(aggregate=False)
+        compact.is_valid = diff.score.is_valid
+        return compact
+
+
+class CompactDiffBuilder(object):
+    def __init__(self) -> None:
+        """Collects the nodes of a CompactDiff in depth-first pre-order"""
+        self.parents = []
+        self.depths = []
+        self.keys = []
+        self.entry_nrs = []
+        self.resource_names = []
+        self.resource_types = []
+        self.fhir_true = []
+        self.fhir_pred = []
+        self.counts = []  # score counts of the leaves, None for other nodes
+        self.strings = []
+        self._string_idxs = {}
+
+    def add(
+        self,
+        parent: int,
+        key: str,
+        entry_nr: int,
+        resource_name: str,
+        resource_type: str,
+        fhir_true: any,
+        fhir_pred: any,
+    ) -> int:
+        """Add a node, after its parent
+
+        Returns:
+            int: index of the node
+        """
+        self.parents.append(parent)
+        self.depths.append(self.depths[parent] + 1 if parent >= 0 else 0)
+        self.keys.append(self._string_idx(key))
+        self.entry_nrs.append(entry_nr)
+        self.resource_names.append(self._string_idx(resource_name))
+        self.resource_types.append(self._string_idx(resource_type))
+        self.fhir_true.append(fhir_true)
+        self.fhir_pred.append(fhir_pred)
+        self.counts.append(None)
+        return len(self.parents) - 1
+
+    def build(self, aggregate: bool = True) -> CompactDiff:
+        """Build the CompactDiff
+
+        Args:
+            aggregate (bool, optional): sum the counts of the leaves into the scores of their ancestors.
+                Defaults to True.
+
+        Returns:
+            CompactDiff: the tree
+        """
+        parents = np.array(self.parents, dtype=np.int32)
+        scores = np.array(
+            [(0, 0, 0, 0, 0) if counts is None else counts for counts in self.counts],
+            dtype=np.int32,
+        ).reshape(-1, len(SCORE_COLUMNS))
+        if aggregate:
+            # Add the scores of each level to their parents, from the deepest level up
+            depths = np.array(self.depths, dtype=np.int32)
+            for depth in range(int(depths.max(initial=0)), 0, -1):
+                idxs = np.flatnonzero(depths == depth)
+                np.add.at(scores, parents[idxs], scores[idxs])
+        return CompactDiff(
+            parents=parents,
+            keys=np.array(self.keys, dtype=np.int32),
+            entry_nrs=np.array(self.entry_nrs, dtype=np.int32),
+            resource_names=np.array(self.resource_names, dtype=np.int32),
+            resource_types=np.array(self.resource_types, dtype=np.int32),
+            strings=self.strings,
+            fhir_true=self.fhir_true,
+            fhir_pred=self.fhir_pred,
+            scores=scores,
+        )
+
+    def _string_idx(self, string: str) -> int:
+        idx = self._string_idxs.get(string)
+        if idx is None:
+            idx = len(self.strings)
+            self._string_idxs[string] = idx
+            self.strings.append(string)
+        return idx
+
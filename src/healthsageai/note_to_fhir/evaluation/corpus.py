@@ -0,0 +1,355 @@
+#  Copyright (c) 2024. HealthSage AI.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Evaluation of a corpus of (ground truth, predicted) FHIR pairs, in parallel over a process pool
+"""
+import itertools
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from pydantic import BaseModel, ConfigDict
+from healthsageai.note_to_fhir.evaluation.compact import CompactDiff
+from healthsageai.note_to_fhir.evaluation.datamodels import FhirScore
+from healthsageai.note_to_fhir.evaluation.scores import SCORE_COLUMNS, ScoreTable
+from healthsageai.note_to_fhir.evaluation.utils import get_diff
+
+
+# Counters summed per resource type, accuracy is averaged over the nodes that have one
+RESOURCE_TABLE_COLUMNS = [
+    "n_nodes",
+    "n_leaves",
+    "n_matches",
+    "n_additions",
+    "n_deletions",
+    "n_modifications",
+    "accuracy_sum",
+    "n_accuracy",
+]
+# Position of each of SCORE_COLUMNS in RESOURCE_TABLE_COLUMNS
+_SCORE_POSITIONS = [RESOURCE_TABLE_COLUMNS.index(column) for column in SCORE_COLUMNS]
+
+
+class CorpusEvaluation(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    score: FhirScore  # Aggregate score over the evaluated records
+    n_records: int  # Number of evaluated records, failed records excluded
+    n_valid: Optional[int] = None  # Number of records with a valid prediction, if validated
+    record_scores: Optional[List[Optional[FhirScore]]]  # Score per record, in input order, None if failed, if kept
+    resource_table: pd.DataFrame  # Aggregates per resource type, see resource_table()
+    failed_records: List[Tuple[int, str]] = []  # Input index and error of the records that could not be evaluated
+
+
+class RecordReadError(ValueError):
+    """A corpus record that could not be read, see read_jsonl_pairs. Evaluating it raises the error, so the
+    record is reported in failed_records like any other record that fails."""
+
+
+class CorpusAccumulator(object):
+    def __init__(self, keep_record_scores: bool = True) -> None:
+        """Incrementally aggregates the results of evaluate_record. Memory is independent of the number of records,
+        unless the score per record is kept.
+
+        Args:
+            keep_record_scores (bool, optional): keep the score of each record. Defaults to True.
+        """
+        self.counts = np.zeros(len(SCORE_COLUMNS), dtype=np.int64)  # summed score counters
+        self.n_records = 0
+        self.n_valid = None  # number of valid predictions, if validated
+        self.record_scores = [] if keep_record_scores else None
+        self.resource_counts = {}  # resource type : array of RESOURCE_TABLE_COLUMNS
+        self.failed_records = []  # (input index, error)
+
+    def add(self, record_result: tuple) -> None:
+        """Add the result of evaluate_record
+
+        Args:
+            record_result (tuple): record score and resource counts
+        """
+        record_score, resource_counts = record_result
+        self.counts += [getattr(record_score, column) for column in SCORE_COLUMNS]
+        self.n_records += 1
+        if record_score.is_valid is not None:
+            self.n_valid = (self.n_valid or 0) + record_score.is_valid
+        if self.record_scores is not None:
+            self.record_scores.append(record_score)
+        for resource_type, counts in resource_counts.items():
+            totals = self.resource_counts.get(resource_type)
+            if totals is None:
+                self.resource_counts[resource_type] = np.array(counts, dtype=float)
+            else:
+                totals += counts
+
+    def add_failure(self, error: str) -> None:
+        """Add a record that could not be evaluated, which is excluded from the aggregates
+
+        Args:
+            error (str): the error raised while evaluating the record
+        """
+        self.failed_records.append((self.n_records + len(self.failed_records), error))
+        if self.record_scores is not None:
+            self.record_scores.append(None)
+
+    @property
+    def score(self) -> FhirScore:
+        """Aggregate score over all records added so far, valid if all validated predictions are valid"""
+        score = ScoreTable(self.counts).total()
+        if self.n_valid is not None:
+            score.is_valid = self.n_valid == self.n_records
+        return score
+
+    def resource_table(self) -> pd.DataFrame:
+        """Aggregates per resource type
+
+        Returns:
+            pd.DataFrame: indexed by resource type, with the number of nodes, the summed leaf counters and
+                the mean accuracy of the nodes.
+        """
+        table = pd.DataFrame(
+            np.array(list(self.resource_counts.values())).reshape(
+                -1, len(RESOURCE_TABLE_COLUMNS)
+            ),
+            index=list(self.resource_counts.keys()),
+            columns=RESOURCE_TABLE_COLUMNS,
+        )
+        table.index.name = "resource_type"
+        counters = [column for column in RESOURCE_TABLE_COLUMNS if column != "accuracy_sum"]
+        table[counters] = table[counters].astype(np.int64)
+        table["accuracy"] = table["accuracy_sum"] / table["n_accuracy"]
+        return table.drop(columns=["accuracy_sum", "n_accuracy"]).sort_index()
+
+    def result(self) -> CorpusEvaluation:
+        return CorpusEvaluation(
+            score=self.score,
+            n_records=self.n_records,
+            n_valid=self.n_valid,
+            record_scores=self.record_scores,
+            resource_table=self.resource_table(),
+            failed_records=self.failed_records,
+        )
+
+
+def evaluate_record(pair: tuple, resource_type: str = "Bundle", validate: bool = False) -> tuple:
+    """Evaluate a single (fhir_true, fhir_pred) pair
+
+    Args:
+        pair (tuple): ground truth and predicted FHIR, as dicts or json strings
+        resource_type (str, optional): The resource type. Defaults to "Bundle".
+        validate (bool, optional): validate the prediction, setting is_valid of the record score. Defaults to False.
+
+    Returns:
+        tuple: FhirScore of the record and the RESOURCE_TABLE_COLUMNS counts per resource type
+    """
+    fhir_true, fhir_pred = pair
+    if isinstance(fhir_true, RecordReadError):
+        raise fhir_true
+    if isinstance(fhir_true, str):
+        fhir_true = json.loads(fhir_true)
+    if isinstance(fhir_pred, str):
+        fhir_pred = json.loads(fhir_pred)
+    diff = get_diff(fhir_true, fhir_pred, resource_type, compact=True, validate=validate)
+    return diff.score, _resource_counts(diff)
+
+
+def _resource_counts(diff: CompactDiff) -> dict:
+    """RESOURCE_TABLE_COLUMNS counts per resource type, aggregated over the nodes of diff in bulk"""
+    n_types = len(diff.strings)
+    groups = diff.resource_types
+    scores = diff.score_table()
+    accuracy = scores.accuracy()
+    has_accuracy = ~np.isnan(accuracy)
+
+    counts = np.zeros((n_types, len(RESOURCE_TABLE_COLUMNS)))
+    counts[:, 0] = np.bincount(groups, minlength=n_types)
+    counts[:, _SCORE_POSITIONS] = scores.group_sum(groups, n_types).counts
+    counts[:, 6] = np.bincount(
+        groups, weights=np.where(has_accuracy, accuracy, 0.0), minlength=n_types
+    )
+    counts[:, 7] = np.bincount(groups, weights=has_accuracy, minlength=n_types)
+    return {
+        diff.strings[group]: counts[group] for group in np.flatnonzero(counts[:, 0])
+    }
+
+
+def _evaluate_chunk(chunk: list, resource_type: str, validate: bool = False) -> list:
+    """(result of evaluate_record, None) per record, or (None, error) if it raised, so one malformed record does
+    not fail the chunk"""
+    results = []
+    for pair in chunk:
+        try:
+            results.append((evaluate_record(pair, resource_type, validate), None))
+        except Exception as e:
+            results.append((None, f"{type(e).__name__}: {e}"))
+    return results
+
+
+def _add_chunk(accumulator: CorpusAccumulator, chunk_results: list) -> None:
+    for record_result, error in chunk_results:
+        if error is None:
+            accumulator.add(record_result)
+        else:
+            accumulator.add_failure(error)
+
+
+def evaluate_corpus(
+    pairs: Iterable[tuple],
+    resource_type: str = "Bundle",
+    workers: int = None,
+    chunksize: int = 16,
+    keep_record_scores: bool = True,
+    validate: bool = False,
+) -> CorpusEvaluation:
+    """Evaluate a corpus of (fhir_true, fhir_pred) pairs, distributing the records over a process pool.
+
+    pairs is consumed lazily and only a bounded number of chunks is in flight, so with keep_record_scores=False the
+    memory use does not grow with the size of the corpus. Records that raise while being evaluated, e.g. invalid
+    json, are reported in failed_records and excluded from the aggregates.
+
+    Args:
+        pairs (Iterable[tuple]): ground truth and predicted FHIR per record, as dicts or json strings
+        resource_type (str, optional): The resource type of the records. Defaults to "Bundle".
+        workers (int, optional): number of processes, 1 evaluates in the current process. Defaults to the number
+            of CPUs.
+        chunksize (int, optional): number of records sent to a worker at once. Defaults to 16.
+        keep_record_scores (bool, optional): keep the score of each record. Defaults to True.
+        validate (bool, optional): validate the predictions, counting the valid ones in n_valid. Defaults to False.
+
+    Returns:
+        CorpusEvaluation: aggregate score, score per record, aggregates per resource type and failed records
+    """
+    accumulator = CorpusAccumulator(keep_record_scores=keep_record_scores)
+    chunks = _chunked(pairs, chunksize)
+    if workers == 1:
+        for chunk in chunks:
+            _add_chunk(accumulator, _evaluate_chunk(chunk, resource_type, validate))
+    else:
+        workers = workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            max_pending = 2 * workers
+            for chunk_results in _map_bounded(
+                executor, _evaluate_chunk, chunks, max_pending, resource_type, validate
+            ):
+                _add_chunk(accumulator, chunk_results)
+    return accumulator.result()
+
+
+def evaluate_jsonl(
+    path: str,
+    pred_path: str = None,
+    resource_type: str = "Bundle",
+    true_key: str = "fhir_true",
+    pred_key: str = "note_to_fhir",
+    workers: int = None,
+    chunksize: int = 16,
+    validate: bool = False,
+) -> CorpusEvaluation:
+    """Evaluate a corpus stored as JSONL, streaming the records with bounded memory. Scores per record are not kept.
+
+    Args:
+        path (str): JSONL file, see read_jsonl_pairs
+        pred_path (str, optional): JSONL file with the predictions, see read_jsonl_pairs
+        resource_type (str, optional): The resource type of the records. Defaults to "Bundle".
+        true_key (str, optional): see read_jsonl_pairs
+        pred_key (str, optional): see read_jsonl_pairs
+        workers (int, optional): see evaluate_corpus
+        chunksize (int, optional): see evaluate_corpus
+        validate (bool, optional): see evaluate_corpus
+
+    Returns:
+        CorpusEvaluation: aggregate score, aggregates per resource type and failed records
+    """
+    pairs = read_jsonl_pairs(path, pred_path, true_key=true_key, pred_key=pred_key)
+    return evaluate_corpus(
+        pairs,
+        resource_type=resource_type,
+        workers=workers,
+        chunksize=chunksize,
+        keep_record_scores=False,
+        validate=validate,
+    )
+
+
+def read_jsonl_pairs(
+    path: str,
+    pred_path: str = None,
+    true_key: str = "fhir_true",
+    pred_key: str = "note_to_fhir",
+) -> Iterator[tuple]:
+    """Lazily read (fhir_true, fhir_pred) pairs from JSONL
+
+    Args:
+        path (str): JSONL file. Without pred_path, each line is an object holding the ground truth under true_key
+            and the prediction under pred_key, as objects or json strings. With pred_path, each line is a ground
+            truth resource.
+        pred_path (str, optional): JSONL file with a predicted resource per line, aligned with path. Blank lines
+            are skipped in both files.
+        true_key (str, optional): Defaults to "fhir_true".
+        pred_key (str, optional): Defaults to "note_to_fhir".
+
+    Raises:
+        ValueError: if path and pred_path hold a different number of records, when the shorter one runs out
+
+    Yields:
+        tuple: fhir_true, fhir_pred. Without pred_path, a line that is not valid json or lacks a key yields a
+            RecordReadError with its line number in place of fhir_true, so the rest of the file is still read.
+    """
+    if pred_path is not None:
+        with open(path, "r") as f_true, open(pred_path, "r") as f_pred:
+            records = itertools.zip_longest(_non_blank(f_true), _non_blank(f_pred))
+            for n_records, (line_true, line_pred) in enumerate(records):
+                if line_true is None or line_pred is None:
+                    longer, shorter = (path, pred_path) if line_pred is None else (pred_path, path)
+                    raise ValueError(f"{longer} has more records than {shorter}, which has {n_records}")
+                yield line_true, line_pred
+        return
+    with open(path, "r") as f:
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                try:
+                    record = json.loads(line)
+                    pair = record[true_key], record[pred_key]
+                except (json.JSONDecodeError, KeyError, TypeError) as e:
+                    pair = RecordReadError(f"{path} line {line_number}: {type(e).__name__}: {e}"), None
+                yield pair
+
+
+def _non_blank(lines: Iterable[str]) -> Iterator[str]:
+    return (line for line in lines if line.strip())
+
+
+def _chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _map_bounded(
+    executor, fn, iterable: Iterable, max_pending: int, *args
+) -> Iterator:
+    """Like executor.map, but submits lazily with at most max_pending tasks in flight. Results are in input order."""
+    pending = deque()
+    for item in iterable:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item, *args))
+    while pending:
+        yield pending.popleft().result()
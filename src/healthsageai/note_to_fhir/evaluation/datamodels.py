@@ -13,16 +13,34 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from pydantic import BaseModel, computed_field, field_validator, Field
-from typing import Any, Optional
+from pydantic import BaseModel, computed_field, field_validator, Field, PrivateAttr
+from typing import Any, List, Optional, Tuple, Union
 from collections import defaultdict
 
 
+class ValidationIssue(BaseModel):
+    loc: Tuple[Union[str, int], ...] = ()  # Location of the error in the resource, e.g. ("entry", 0, "resource")
+    msg: str
+    type: str  # pydantic error type, e.g. "value_error.missing"
+
+    @computed_field
+    @property
+    def path(self) -> str:
+        return ".".join(str(part) for part in self.loc)
+
+
+class ValidationResult(BaseModel):
+    resource_type: Optional[str] = None
+    is_valid: bool
+    errors: List[ValidationIssue] = Field(default_factory=list)
+
+
 class FhirValiditionScore(BaseModel):
     n_nodes: int = 0
     n_valid_nodes: int = 0
     n_invalid_nodes: int = 0
     self_is_valid: Optional[bool] = None
+    errors: List[ValidationIssue] = Field(default_factory=list)  # Errors in the node itself
 
     @computed_field
     @property
@@ -102,27 +120,67 @@ class FhirDiff(BaseModel):
     entry_nr: str = ""  # For lists, tracking index
     key: str = ""  # What the element is named in its parent object
     score: FhirScore = FhirScore()
+    validation: Optional[FhirValiditionScore] = Field(default=None, repr=False)  # see utils.validate_diff
+
+    # Cached on first access, see label and resource_type
+    _label: Optional[str] = PrivateAttr(default=None)
+    _resource_type: Optional[str] = PrivateAttr(default=None)
 
     @computed_field
     @property
     def label(self) -> str:
         """Labels are used to identify the node in the FHIR tree
 
+        The label is cached, and computed from the cached label of the parent, so labeling all nodes of a tree is
+        linear in its size. The parent of a labeled node should not change, see detached.
+
         Returns:
             str: node label describing PARENT.KEY.ENTRY_NR where parent, key and entry_nr are optional
         """
-        parent_label = "" if not self.parent else self.parent.label
-        keylabel = self.key if self.key != "resource" else self.resource_type
-        label = ".".join([parent_label, keylabel, self.entry_nr]).strip(".")
-        return label
+        if self._label is None:
+            # Label the unlabeled ancestors top-down, without recursion
+            unlabeled = []
+            node = self
+            while node is not None and node._label is None:
+                unlabeled.append(node)
+                node = node.parent
+            for node in reversed(unlabeled):
+                parent_label = "" if not node.parent else node.parent._label
+                keylabel = node.key if node.key != "resource" else node.resource_type
+                node._label = ".".join([parent_label, keylabel, node.entry_nr]).strip(".")
+        return self._label
 
     @computed_field
     @property
     def resource_type(self) -> str:
-        if isinstance(self.fhir_true, dict) and len(self.fhir_true) > 0:
-            if self.fhir_true["resourceType"]:
-                return self.fhir_true["resourceType"]
-        return self.resource_name
+        if self._resource_type is None:
+            self._resource_type = self.resource_name
+            if isinstance(self.fhir_true, dict) and len(self.fhir_true) > 0:
+                if self.fhir_true["resourceType"]:
+                    self._resource_type = self.fhir_true["resourceType"]
+        return self._resource_type
+
+    def iter_children(self):
+        """Iterate over the child nodes, with the items of array elements in order
+
+        Yields:
+            FhirDiff: child node
+        """
+        for child in self.children.values():
+            if isinstance(child, list):
+                yield from child
+            else:
+                yield child
+
+    def detached(self) -> "FhirDiff":
+        """Shallow copy of this node without parent and children, so it is labeled as a root node
+
+        Returns:
+            FhirDiff: the copy, sharing the FHIR payloads and score with this node
+        """
+        node = self.model_copy(update={"parent": None, "children": None})
+        node._label = None
+        return node
 
     @field_validator("fhir_true", "fhir_pred", mode="before")
     def convert_to_defaultdict(cls, v):
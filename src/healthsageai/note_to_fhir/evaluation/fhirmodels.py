@@ -14,71 +14,84 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 """Contains all in-scope FHIR models for the note_to_fhir project
+
+The fhir.resources classes are imported on first use, so importing this module is cheap.
 """
-from fhir.resources.R4B.reference import Reference
-from fhir.resources.R4B.patient import (
-    Patient,
-    PatientCommunication,
-    PatientContact,
-    PatientLink,
-)
-from fhir.resources.R4B.address import Address
-from fhir.resources.R4B.codeableconcept import CodeableConcept
-from fhir.resources.R4B.coding import Coding
-from fhir.resources.R4B.humanname import HumanName
-from fhir.resources.R4B.contactpoint import ContactPoint
-from fhir.resources.R4B.encounter import Encounter, EncounterParticipant, EncounterHospitalization, EncounterLocation, EncounterDiagnosis
-from fhir.resources.R4B.allergyintolerance import AllergyIntolerance, AllergyIntoleranceReaction
-from fhir.resources.R4B.period import Period
-from fhir.resources.R4B.narrative import Narrative
-from fhir.resources.R4B.identifier import Identifier
-from fhir.resources.R4B.bundle import Bundle, BundleEntry
-from fhir.resources.R4B.organization import Organization, OrganizationContact
-from fhir.resources.R4B.practitioner import Practitioner
-from fhir.resources.R4B.procedure import Procedure, ProcedurePerformer
-from fhir.resources.R4B.condition import Condition
-from fhir.resources.R4B.immunization import Immunization, ImmunizationProtocolApplied
-from fhir.resources.R4B.observation import Observation, ObservationComponent
-from fhir.resources.R4B.medication import Medication
-from fhir.resources.R4B.quantity import Quantity
-from fhir.resources.R4B.resource import Resource
-from fhir.resources.R4B.extension import Extension
+import importlib
+from typing import Dict, Iterator, Mapping
+from pydantic.v1.main import ModelMetaclass
 
-object_mapping = {
-    "Patient": Patient,
-    "PatientCommunication": PatientCommunication,
-    "PatientContact": PatientContact,
-    "PatientLink": PatientLink,
-    "Address": Address,
-    "CodeableConcept": CodeableConcept,
-    "Coding": Coding,
-    "HumanName": HumanName,
-    "ContactPoint": ContactPoint,
-    "Encounter": Encounter,
-    "EncounterParticipant": EncounterParticipant,
-    "AllergyIntolerance": AllergyIntolerance,
-    "Period": Period,
-    "Narrative": Narrative,
-    "Identifier": Identifier,
-    "Bundle": Bundle,
-    "BundleEntry": BundleEntry,
-    "Organization": Organization,
-    "Practitioner": Practitioner,
-    "Procedure": Procedure,
-    "Condition": Condition,
-    "Immunization": Immunization,
-    "Observation": Observation,
-    "Medication": Medication,
-    "Reference": Reference,
-    "Quantity": Quantity,
-    "Resource": Resource,
-    "AllergyIntoleranceReaction": AllergyIntoleranceReaction,
-    "ProcedurePerformer": ProcedurePerformer,
-    "ImmunizationProtocolApplied": ImmunizationProtocolApplied,
-    "ObservationComponent": ObservationComponent,
-    "EncounterHospitalization": EncounterHospitalization,
-    "EncounterLocation": EncounterLocation,
-    "OrganizationContact": OrganizationContact,
-    "EncounterDiagnosis": EncounterDiagnosis,
-    "Extension": Extension,
+# Resource type or fhir type : fhir.resources.R4B module that defines its class
+resource_modules = {
+    "Patient": "patient",
+    "PatientCommunication": "patient",
+    "PatientContact": "patient",
+    "PatientLink": "patient",
+    "Address": "address",
+    "CodeableConcept": "codeableconcept",
+    "Coding": "coding",
+    "HumanName": "humanname",
+    "ContactPoint": "contactpoint",
+    "Encounter": "encounter",
+    "EncounterParticipant": "encounter",
+    "AllergyIntolerance": "allergyintolerance",
+    "Period": "period",
+    "Narrative": "narrative",
+    "Identifier": "identifier",
+    "Bundle": "bundle",
+    "BundleEntry": "bundle",
+    "Organization": "organization",
+    "Practitioner": "practitioner",
+    "Procedure": "procedure",
+    "Condition": "condition",
+    "Immunization": "immunization",
+    "Observation": "observation",
+    "Medication": "medication",
+    "Reference": "reference",
+    "Quantity": "quantity",
+    "Resource": "resource",
+    "AllergyIntoleranceReaction": "allergyintolerance",
+    "ProcedurePerformer": "procedure",
+    "ImmunizationProtocolApplied": "immunization",
+    "ObservationComponent": "observation",
+    "EncounterHospitalization": "encounter",
+    "EncounterLocation": "encounter",
+    "OrganizationContact": "organization",
+    "EncounterDiagnosis": "encounter",
+    "Extension": "extension",
 }
+
+
+class LazyObjectMapping(Mapping):
+    def __init__(self, modules: Dict[str, str]) -> None:
+        """Read-only mapping of resource type to fhir.resources class, importing each class on first access.
+
+        Args:
+            modules (Dict[str, str]): resource type : name of its module in fhir.resources.R4B
+        """
+        self.modules = modules
+        self._classes: Dict[str, ModelMetaclass] = {}
+
+    def __getitem__(self, resource_type: str) -> ModelMetaclass:
+        resource_class = self._classes.get(resource_type)
+        if resource_class is None:
+            module = importlib.import_module(f"fhir.resources.R4B.{self.modules[resource_type]}")
+            resource_class = getattr(module, resource_type)
+            self._classes[resource_type] = resource_class
+        return resource_class
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.modules)
+
+    def __len__(self) -> int:
+        return len(self.modules)
+
+
+object_mapping = LazyObjectMapping(resource_modules)
+
+
+def __getattr__(name: str) -> ModelMetaclass:
+    # The classes used to be imported here, e.g. `from fhirmodels import Patient`
+    if name in resource_modules:
+        return object_mapping[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
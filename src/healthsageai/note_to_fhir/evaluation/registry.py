@@ -0,0 +1,101 @@
+#  Copyright (c) 2024. HealthSage AI.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Process-wide cache of the ElementDetails of each in-scope FHIR resource type
+"""
+import json
+from typing import Callable, Dict, Iterable, List
+from healthsageai.note_to_fhir.evaluation.datamodels import ElementDetails
+
+
+class ResourceDetailsRegistry(object):
+    def __init__(self, loader: Callable[[str], List[ElementDetails]]) -> None:
+        """Memoizes the ElementDetails per resource type, so the pydantic schema of a resource class is generated only once.
+
+        Args:
+            loader (Callable): function that computes the ElementDetails for a resource type
+        """
+        self.loader = loader
+        self._details: Dict[str, List[ElementDetails]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, resource_type: str) -> List[ElementDetails]:
+        """Get the ElementDetails of a resource type, computing them on first use.
+
+        Args:
+            resource_type (str): The resource type, e.g. "Patient" or "Coding"
+
+        Returns:
+            List[ElementDetails]: details about the elements of the resource type
+        """
+        details = self._details.get(resource_type)
+        if details is not None:
+            self.hits += 1
+            return details
+        self.misses += 1
+        details = self.loader(resource_type)
+        self._details[resource_type] = details
+        return details
+
+    def warm(self, resource_types: Iterable[str]) -> None:
+        """Precompute the ElementDetails of the given resource types
+
+        Args:
+            resource_types (Iterable[str]): resource types to load, e.g. object_mapping.keys()
+        """
+        for resource_type in resource_types:
+            if resource_type not in self._details:
+                self._details[resource_type] = self.loader(resource_type)
+
+    def clear(self) -> None:
+        """Drop all cached details and reset the statistics"""
+        self._details.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        """Cache statistics for profiling
+
+        Returns:
+            dict: number of hits, misses and cached resource types
+        """
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._details)}
+
+    def save(self, path: str) -> None:
+        """Persist the cached details to a json file
+
+        Args:
+            path (str): path of the json file
+        """
+        data = {
+            resource_type: [element.model_dump() for element in details]
+            for resource_type, details in self._details.items()
+        }
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+    def load(self, path: str) -> None:
+        """Load details that were persisted with save()
+
+        Args:
+            path (str): path of the json file
+        """
+        with open(path, "r") as f:
+            data = json.load(f)
+        for resource_type, details in data.items():
+            self._details[resource_type] = [
+                ElementDetails(**element) for element in details
+            ]
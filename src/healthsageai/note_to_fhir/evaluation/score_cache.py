@@ -0,0 +1,188 @@
+#  Copyright (c) 2024. HealthSage AI.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Memoization of subtree scores, keyed by the content of the compared FHIR elements
+"""
+import hashlib
+import json
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional
+
+
+def subtree_hash(fhir: any, memo: dict = None) -> str:
+    """Canonical hash of a FHIR element: equal for equal content, regardless of the order of dict keys.
+
+    Dicts and lists are hashed from the hashes of their nested dicts and lists, bottom-up without recursion, so
+    with a memo that is shared across calls every subtree is serialized only once.
+
+    Args:
+        fhir (any): FHIR element
+        memo (dict, optional): id of a dict or list : (the object, its hash), filled with the hashes of the
+            subtrees of fhir. The objects must not change while they are in the memo. Defaults to None.
+
+    Returns:
+        str: hex digest
+    """
+    if not isinstance(fhir, (dict, list)):
+        return _digest(_canonical(fhir, memo))
+    memo = {} if memo is None else memo
+    stack = [(fhir, False)]
+    while stack:
+        node, children_hashed = stack.pop()
+        if id(node) in memo:
+            continue
+        if not children_hashed:
+            stack.append((node, True))
+            children = node.values() if isinstance(node, dict) else node
+            stack.extend((child, False) for child in children if isinstance(child, (dict, list)))
+            continue
+        if isinstance(node, dict):
+            items = sorted((str(key), value) for key, value in node.items())
+            canonical = "{" + ",".join(json.dumps(key) + ":" + _canonical(value, memo) for key, value in items) + "}"
+        else:
+            canonical = "[" + ",".join(_canonical(item, memo) for item in node) + "]"
+        memo[id(node)] = (node, _digest(canonical))
+    return memo[id(fhir)][1]
+
+
+def _canonical(value: any, memo: dict) -> str:
+    """Serialized value, with the hash of nested dicts and lists in memo in their place"""
+    if isinstance(value, (dict, list)):
+        return "#" + memo[id(value)][1]
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+
+
+def _digest(canonical: str) -> str:
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+class SubtreeScoreCache(object):
+    def __init__(self, maxsize: int = None) -> None:
+        """Least recently used cache of the score counts of (fhir_true, fhir_pred) element pairs.
+
+        Keys are built with key(), from the subtree hashes of both elements and everything else the score
+        depends on. Values are score counts, see utils._counts_to_score.
+
+        Args:
+            maxsize (int, optional): maximum number of cached scores, unbounded if None. Defaults to None.
+        """
+        self.maxsize = maxsize
+        self._counts = OrderedDict()
+        self._hashes = {}  # memo of subtree_hash within a scope, see scope
+        self._scope_depth = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(
+        true_hash: str,
+        pred_hash: str,
+        fhirtype: str,
+        element_key: str,
+        array_order_strategy: str = None,
+        max_permutations: int = None,
+    ) -> tuple:
+        """Cache key for a pair of elements
+
+        Args:
+            true_hash (str): subtree_hash of the ground truth element
+            pred_hash (str): subtree_hash of the predicted element
+            fhirtype (str): fhir type of the elements
+            element_key (str): What the elements are named in their parent object
+            array_order_strategy (str, optional): resolved strategy for nested arrays, see optimize_array_order
+            max_permutations (int, optional): largest array that "auto" orders exactly, see
+                utils.MAX_PERMUTATIONS_ARRAY_SIZE
+
+        Returns:
+            tuple: the cache key
+        """
+        return true_hash, pred_hash, fhirtype, element_key, array_order_strategy, max_permutations
+
+    def hash(self, fhir: any) -> str:
+        """subtree_hash of fhir, memoized for the subtrees hashed within the current scope
+
+        Args:
+            fhir (any): FHIR element
+
+        Returns:
+            str: hex digest
+        """
+        return subtree_hash(fhir, self._hashes if self._scope_depth else None)
+
+    @contextmanager
+    def scope(self):
+        """Memoize subtree hashes within the block, e.g. a get_diff call, so nested arrays are hashed once.
+        The hashed FHIR must not change within the block. The memo is dropped when the outermost block exits."""
+        self._scope_depth += 1
+        try:
+            yield self
+        finally:
+            self._scope_depth -= 1
+            if not self._scope_depth:
+                self._hashes.clear()
+
+    def get(self, key: tuple) -> Optional[tuple]:
+        """Get the cached score counts, or None on a miss
+
+        Args:
+            key (tuple): see key()
+
+        Returns:
+            Optional[tuple]: score counts
+        """
+        counts = self._counts.get(key)
+        if counts is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.maxsize is not None:
+            self._counts.move_to_end(key)
+        return counts
+
+    def put(self, key: tuple, counts: tuple) -> None:
+        """Cache score counts, evicting the least recently used scores beyond maxsize
+
+        Args:
+            key (tuple): see key()
+            counts (tuple): score counts
+        """
+        self._counts[key] = counts
+        if self.maxsize is not None and len(self._counts) > self.maxsize:
+            self._counts.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """Drop all cached scores and reset the statistics"""
+        self._counts.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self) -> dict:
+        """Cache statistics for profiling
+
+        Returns:
+            dict: number of hits, misses, evictions and cached scores, and the hit rate
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._counts),
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
@@ -0,0 +1,133 @@
+#  Copyright (c) 2024. HealthSage AI.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Vectorized aggregation of the FhirScore counters of many nodes or records
+"""
+from typing import TYPE_CHECKING, Iterable, List
+import numpy as np
+
+if TYPE_CHECKING:  # imported in to_dataframe, to keep importing this module fast
+    import pandas as pd
+from healthsageai.note_to_fhir.evaluation.datamodels import FhirScore
+
+# The counters of FhirScore, in field order
+SCORE_COLUMNS = ["n_leaves", "n_additions", "n_deletions", "n_modifications", "n_matches"]
+METRIC_COLUMNS = ["accuracy", "precision", "recall"]
+
+
+class ScoreTable(object):
+    __slots__ = ("counts",)
+
+    def __init__(self, counts: np.ndarray = None) -> None:
+        """The counters of a number of FhirScores as one integer array, so they are summed and turned into
+        metrics column-wise instead of per FhirScore object.
+
+        Args:
+            counts (np.ndarray, optional): counters of shape (n_scores, 5), see SCORE_COLUMNS. Defaults to no scores.
+        """
+        if counts is None:
+            counts = np.zeros((0, len(SCORE_COLUMNS)), dtype=np.int64)
+        self.counts = np.asarray(counts).reshape(-1, len(SCORE_COLUMNS))
+
+    @classmethod
+    def from_scores(cls, scores: Iterable[FhirScore]) -> "ScoreTable":
+        """Collect the counters of FhirScore objects
+
+        Args:
+            scores (Iterable[FhirScore]): scores
+
+        Returns:
+            ScoreTable: table with a row per score
+        """
+        return cls(
+            np.array(
+                [[getattr(score, column) for column in SCORE_COLUMNS] for score in scores],
+                dtype=np.int64,
+            )
+        )
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def column(self, name: str) -> np.ndarray:
+        """A counter of all scores, e.g. "n_matches" """
+        return self.counts[:, SCORE_COLUMNS.index(name)]
+
+    def total(self) -> FhirScore:
+        """Sum of all scores
+
+        Returns:
+            FhirScore: the summed score
+        """
+        return _to_score(self.counts.sum(axis=0, dtype=np.int64))
+
+    def to_scores(self) -> List[FhirScore]:
+        """FhirScore objects, one per row"""
+        return [_to_score(row) for row in self.counts]
+
+    def group_sum(self, groups: np.ndarray, n_groups: int = None) -> "ScoreTable":
+        """Sum the scores per group
+
+        Args:
+            groups (np.ndarray): integer group of each score
+            n_groups (int, optional): number of groups. Defaults to max(groups) + 1.
+
+        Returns:
+            ScoreTable: table with a row per group
+        """
+        n_groups = int(groups.max(initial=-1)) + 1 if n_groups is None else n_groups
+        sums = np.zeros((n_groups, len(SCORE_COLUMNS)), dtype=np.int64)
+        np.add.at(sums, groups, self.counts)
+        return ScoreTable(sums)
+
+    def accuracy(self) -> np.ndarray:
+        """FhirScore.accuracy of each score, NaN where undefined"""
+        return _ratio(self.column("n_matches"), self.column("n_leaves"))
+
+    def precision(self) -> np.ndarray:
+        """FhirScore.precision of each score, NaN where undefined"""
+        n_matches = self.column("n_matches")
+        total = n_matches + self.column("n_additions") + self.column("n_modifications")
+        return _ratio(n_matches, total)
+
+    def recall(self) -> np.ndarray:
+        """FhirScore.recall of each score, NaN where undefined"""
+        n_matches = self.column("n_matches")
+        total = n_matches + self.column("n_deletions") + self.column("n_modifications")
+        return _ratio(n_matches, total)
+
+    def to_dataframe(self) -> "pd.DataFrame":
+        """The counters and metrics of each score
+
+        Returns:
+            pd.DataFrame: SCORE_COLUMNS and METRIC_COLUMNS
+        """
+        import pandas as pd
+
+        columns = {column: self.column(column) for column in SCORE_COLUMNS}
+        columns["accuracy"] = self.accuracy()
+        columns["precision"] = self.precision()
+        columns["recall"] = self.recall()
+        return pd.DataFrame(columns)
+
+
+def _ratio(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    ratio = np.full(len(numerator), np.nan)
+    np.divide(numerator, denominator, out=ratio, where=denominator != 0)
+    return ratio
+
+
+def _to_score(counts: np.ndarray) -> FhirScore:
+    return FhirScore(**dict(zip(SCORE_COLUMNS, counts.tolist())))
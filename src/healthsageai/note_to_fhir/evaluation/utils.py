@@ -13,23 +13,34 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import json
 from healthsageai.note_to_fhir.evaluation.datamodels import (
     FhirScore,
+    FhirValiditionScore,
     ElementDetails,
     FhirDiff,
 )
 from healthsageai.note_to_fhir.evaluation.fhirmodels import object_mapping
-from typing import List
+from healthsageai.note_to_fhir.evaluation.compact import CompactDiff, CompactDiffBuilder
+from healthsageai.note_to_fhir.evaluation.registry import ResourceDetailsRegistry
+from healthsageai.note_to_fhir.evaluation.score_cache import SubtreeScoreCache, subtree_hash
+from healthsageai.note_to_fhir.evaluation.scores import ScoreTable
+from healthsageai.note_to_fhir.evaluation.validation import ResourceValidator, resource_validator
+from healthsageai.note_to_fhir.traversal import walk
+from typing import TYPE_CHECKING, Iterator, List, Optional, Union
+import sys
 import warnings
 from collections import defaultdict
 from pydantic.v1.main import ModelMetaclass
-import pandas as pd
 import itertools
 import numpy as np
 
+if TYPE_CHECKING:  # pandas and scipy are imported where they are used, to keep importing this module fast
+    import pandas as pd
+
 
 MAX_PERMUTATIONS_ARRAY_SIZE = 7  # When all permutations have to be calculated
+ARRAY_ORDER_STRATEGY = "auto"  # "auto", "exact", "approx" or "hungarian", see optimize_array_order
+SUBTREE_SCORE_CACHE_SIZE = 100_000  # Size of subtree_score_cache
 
 
 def get_resource_details(Resource) -> List[ElementDetails]:
@@ -111,16 +122,11 @@ def validate_resource(resource: dict) -> bool:
         resource (dict): A dictionary representing a FHIR R4B resource.
 
     Returns:
-        bool: True if the resource was successfully parsed, False otherwise.
+        bool: True if the resource was successfully parsed, False otherwise. See ResourceValidator.validate for
+            the location of the errors.
     """
     assert "resourceType" in resource.keys(), "resourceType unspecified"
-    try:
-        ResourceClass = object_mapping[resource["resourceType"]]
-        resource = ResourceClass.parse_raw(json.dumps(resource))
-        is_parsed = True
-    except Exception:
-        is_parsed = False
-    return is_parsed
+    return resource_validator.is_valid(resource)
 
 
 def fhirtype_is_struct(fhirtype: str) -> bool:
@@ -182,43 +188,107 @@ def map_align_arrays(arr1, arr2):
 
 
 def optimize_array_order(
-    fhir_true_array: list, fhir_pred_array: list, element_details: ElementDetails
+    fhir_true_array: list,
+    fhir_pred_array: list,
+    element_details: ElementDetails,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
 ) -> tuple:
-    if len(fhir_true_array) <= MAX_PERMUTATIONS_ARRAY_SIZE:
-        return optimize_array_order_exact(
-            fhir_true_array, fhir_pred_array, element_details
-        )  # scales n!
+    """Re-orders fhir_pred_array so its items align with the best matching items in fhir_true_array.
+
+    Strategies:
+    "auto": "exact" for arrays up to MAX_PERMUTATIONS_ARRAY_SIZE items, "approx" otherwise
+    "exact": evaluate all permutations, scales n!
+    "approx": greedy matching on the pairwise accuracy matrix, scales n**2
+    "hungarian": optimal matching on the pairwise leaf and match counts, scales n**3 per step
+
+    Args:
+        fhir_true_array (list): list of Fhir resources
+        fhir_pred_array (list): list of Fhir resources to optimize
+        element_details (ElementDetails): metadata
+        array_order_strategy (str, optional): Defaults to ARRAY_ORDER_STRATEGY.
+        score_cache (SubtreeScoreCache, optional): memoizes the scores of item pairs. Defaults to None.
+
+    Returns:
+        tuple: fhir_true_array and the re-ordered fhir_pred_array
+    """
+    strategy = array_order_strategy or ARRAY_ORDER_STRATEGY
+    if strategy == "auto":
+        strategy = (
+            "exact" if len(fhir_true_array) <= MAX_PERMUTATIONS_ARRAY_SIZE else "approx"
+        )
+    if strategy == "exact":
+        optimize = optimize_array_order_exact  # scales n!
+    elif strategy == "approx":
+        optimize = optimize_array_order_approx  # scales n**2
+    elif strategy == "hungarian":
+        optimize = optimize_array_order_hungarian  # scales n**3
     else:
-        return optimize_array_order_approx(
-            fhir_true_array, fhir_pred_array, element_details
-        )  # scales n**2
+        raise ValueError(f"Unknown array order strategy: {strategy}")
+    return optimize(
+        fhir_true_array,
+        fhir_pred_array,
+        element_details,
+        array_order_strategy=array_order_strategy,
+        score_cache=score_cache,
+    )
 
 
 def optimize_array_order_exact(
-    fhir_true_array: list, fhir_pred_array: list, element_details: ElementDetails
+    fhir_true_array: list,
+    fhir_pred_array: list,
+    element_details: ElementDetails,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
 ) -> tuple:
     """Finds the list order for fhir_pred the results in the highest accuracy by calculating all possible permutations.
 
+    Each pair of items is scored once, the permutations only sum the scores of their pairs.
+
     Args:
         fhir_true_array (list): list of Fhir resources
         fhir_pred_array (list): list of Fhir resources to optimize
         element_details (ElementDetails): metadata
+        array_order_strategy (str, optional): strategy for nested arrays, see optimize_array_order
+        score_cache (SubtreeScoreCache, optional): memoizes the scores of item pairs. Defaults to None.
     """
     assert isinstance(fhir_true_array, list) and isinstance(fhir_pred_array, list), (
         fhir_true_array,
         fhir_pred_array,
     )
-    fhir_pred_child_permutations = [
-        list(permutation) for permutation in itertools.permutations(fhir_pred_array)
+    true_hashes = _subtree_hashes(fhir_true_array, score_cache)
+    pred_hashes = _subtree_hashes(fhir_pred_array, score_cache)
+    pair_counts = [
+        [
+            _get_item_counts(
+                fhir_true_item,
+                fhir_pred_item,
+                element_details,
+                array_order_strategy,
+                score_cache,
+                true_hash,
+                pred_hash,
+            )
+            for fhir_pred_item, pred_hash in zip(fhir_pred_array, pred_hashes)
+        ]
+        for fhir_true_item, true_hash in zip(fhir_true_array, true_hashes)
     ]
-    max_idx = -1
+
+    max_permutation = None
     max_accuracy = 0.0
-    for i, permutation in enumerate(fhir_pred_child_permutations):
-        score = _get_array_score(fhir_true_array, permutation, element_details)
-        if score.accuracy > max_accuracy:
-            max_idx = i
-            max_accuracy = score.accuracy
-    fhir_pred_child_max = fhir_pred_child_permutations[max_idx]
+    for permutation in itertools.permutations(range(len(fhir_pred_array))):
+        n_leaves, n_matches = 0, 0
+        for true_idx, pred_idx in zip(range(len(fhir_true_array)), permutation):
+            counts = pair_counts[true_idx][pred_idx]
+            n_leaves += counts[0]
+            n_matches += counts[4]
+        accuracy = n_matches / n_leaves if n_leaves else 0.0  # items without scored leaves, e.g. only an id
+        if accuracy > max_accuracy:
+            max_permutation = permutation
+            max_accuracy = accuracy
+    if max_permutation is None:
+        max_permutation = permutation  # the last permutation
+    fhir_pred_child_max = [fhir_pred_array[pred_idx] for pred_idx in max_permutation]
     return fhir_true_array, fhir_pred_child_max
 
 
@@ -267,7 +337,11 @@ def are_same_types(a, b) -> bool:
 
 
 def optimize_array_order_approx(
-    fhir_true_array: list, fhir_pred_array: list, element_details: ElementDetails
+    fhir_true_array: list,
+    fhir_pred_array: list,
+    element_details: ElementDetails,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
 ) -> tuple:
     """Finds the list order for fhir_pred the results in the highest accuracy calculating the match score (accuracy) between each
     list item.
@@ -276,29 +350,19 @@ def optimize_array_order_approx(
         fhir_true_array (list): The array/list in the ground truth FHIR resource
         fhir_pred_array (list): The array/list to be re-ordered
         element_details (ElementDetails): Metadata
+        array_order_strategy (str, optional): strategy for nested arrays, see optimize_array_order
+        score_cache (SubtreeScoreCache, optional): memoizes the scores of item pairs. Defaults to None.
 
     Returns:
         tuple: fhir_true_array and fhir_pred_array_max, where fhir_pred_array_max is a re-ordered version of the fhir_pred_array
     """
-    accuracy_matrix = pd.DataFrame(
-        0.0,
-        index=np.arange(len(fhir_true_array)),
-        columns=np.arange(len(fhir_pred_array)),
+    accuracy_matrix = get_accuracy_matrix(
+        fhir_true_array,
+        fhir_pred_array,
+        element_details,
+        array_order_strategy,
+        score_cache,
     )
-    for i_true, fhir_true in enumerate(fhir_true_array):
-        for i_pred, fhir_pred in enumerate(fhir_pred_array):
-            if not are_same_types(fhir_true, fhir_pred):
-                accuracy_matrix.iloc[i_true, i_pred] = -1.0
-            else:
-                diff = FhirDiff(
-                    fhir_true=fhir_true,
-                    fhir_pred=fhir_pred,
-                    resource_name=element_details.array_item_type,
-                    parent=None,
-                    key=element_details.key,
-                )
-                diff = _expand_diff_tree(diff)
-                accuracy_matrix.iloc[i_true, i_pred] = diff.score.accuracy
 
     optimal_order = get_optimal_order(accuracy_matrix)
 
@@ -312,36 +376,218 @@ def optimize_array_order_approx(
     return fhir_true_array, fhir_pred_array_max
 
 
-def get_optimal_order(accuracy_matrix) -> dict:
+def optimize_array_order_hungarian(
+    fhir_true_array: list,
+    fhir_pred_array: list,
+    element_details: ElementDetails,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
+) -> tuple:
+    """Finds the list order for fhir_pred with the highest accuracy, the same objective as optimize_array_order_exact:
+    the total matches over the total leaves of the aligned pairs, not the sum of their accuracies.
+
+    The ratio is maximized with Dinkelbach's method: each step solves a linear assignment problem (Hungarian
+    algorithm) on n_matches - accuracy * n_leaves of each pair, with the accuracy of the previous step, until the
+    accuracy no longer increases. The first step maximizes the total matches; a few steps usually suffice.
+
+    Args:
+        fhir_true_array (list): The array/list in the ground truth FHIR resource
+        fhir_pred_array (list): The array/list to be re-ordered
+        element_details (ElementDetails): Metadata
+        array_order_strategy (str, optional): strategy for nested arrays, see optimize_array_order
+        score_cache (SubtreeScoreCache, optional): memoizes the scores of item pairs. Defaults to None.
+
+    Returns:
+        tuple: fhir_true_array and fhir_pred_array_max, where fhir_pred_array_max is a re-ordered version of the fhir_pred_array
+    """
+    from scipy.optimize import linear_sum_assignment
+
+    n_leaves, n_matches = get_count_matrices(
+        fhir_true_array,
+        fhir_pred_array,
+        element_details,
+        array_order_strategy,
+        score_cache,
+    )
+    assignment = None
+    max_accuracy = 0.0
+    while True:
+        true_idxs, pred_idxs = linear_sum_assignment(n_matches - max_accuracy * n_leaves, maximize=True)
+        total_leaves = n_leaves[true_idxs, pred_idxs].sum()
+        accuracy = n_matches[true_idxs, pred_idxs].sum() / total_leaves if total_leaves else 0.0
+        if assignment is not None and accuracy <= max_accuracy:
+            break
+        assignment = true_idxs, pred_idxs
+        max_accuracy = accuracy
+
+    fhir_pred_array_max = [None] * len(fhir_true_array)
+    for true_idx, pred_idx in zip(*assignment):
+        fhir_pred_array_max[true_idx] = fhir_pred_array[pred_idx]
+
+    return fhir_true_array, fhir_pred_array_max
+
+
+def get_count_matrices(
+    fhir_true_array: list,
+    fhir_pred_array: list,
+    element_details: ElementDetails,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
+) -> tuple:
+    """Calculates the number of leaves and matches of each pair of items of two arrays.
+
+    Unlike get_accuracy_matrix, pairs of different types are scored as well, as optimize_array_order_exact does.
+    Identical items are scored once and their counts are shared across all pairs they occur in.
+
+    Args:
+        fhir_true_array (list): The array/list in the ground truth FHIR resource
+        fhir_pred_array (list): The array/list in the predicted FHIR resource
+        element_details (ElementDetails): Metadata
+        array_order_strategy (str, optional): strategy for nested arrays, see optimize_array_order
+        score_cache (SubtreeScoreCache, optional): memoizes the scores of item pairs. Defaults to None.
+
+    Returns:
+        tuple: n_leaves and n_matches, matrices of shape (len(fhir_true_array), len(fhir_pred_array))
     """
+    true_items, true_idxs, true_hashes = _unique_items(fhir_true_array, score_cache)
+    pred_items, pred_idxs, pred_hashes = _unique_items(fhir_pred_array, score_cache)
+
+    n_leaves = np.zeros((len(true_items), len(pred_items)))
+    n_matches = np.zeros((len(true_items), len(pred_items)))
+    for i_true, fhir_true in enumerate(true_items):
+        for i_pred, fhir_pred in enumerate(pred_items):
+            counts = _get_item_counts(
+                fhir_true,
+                fhir_pred,
+                element_details,
+                array_order_strategy,
+                score_cache,
+                true_hashes[i_true],
+                pred_hashes[i_pred],
+            )
+            n_leaves[i_true, i_pred], n_matches[i_true, i_pred] = counts[0], counts[4]
+
+    idxs = np.ix_(true_idxs, pred_idxs)
+    return n_leaves[idxs], n_matches[idxs]
+
+
+def get_accuracy_matrix(
+    fhir_true_array: list,
+    fhir_pred_array: list,
+    element_details: ElementDetails,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
+) -> np.ndarray:
+    """Calculates the match score (accuracy) between each pair of items of two arrays.
+
+    Pairs of different types (see are_same_types) score -1.0 and pairs without leaves score NaN.
+    Identical items are scored once and their scores are shared across all pairs they occur in.
+    Scores are calculated with the score-only engine (see get_score), so no FhirDiff trees are built.
 
     Args:
-        matrix (_type_): _description_
+        fhir_true_array (list): The array/list in the ground truth FHIR resource
+        fhir_pred_array (list): The array/list in the predicted FHIR resource
+        element_details (ElementDetails): Metadata
+        array_order_strategy (str, optional): strategy for nested arrays, see optimize_array_order
+        score_cache (SubtreeScoreCache, optional): memoizes the scores of item pairs. Defaults to None.
+
+    Returns:
+        np.ndarray: matrix of shape (len(fhir_true_array), len(fhir_pred_array))
     """
-    optimal_order = {}  # pred idx : true idx
-    while accuracy_matrix.shape[0] > 0:
-        max_col, max_idx = _get_max_loc(accuracy_matrix)
-        optimal_order[max_col] = max_idx
-        del accuracy_matrix[max_col]
-        accuracy_matrix.drop(max_idx, inplace=True)
+    true_items, true_idxs, true_hashes = _unique_items(fhir_true_array, score_cache)
+    pred_items, pred_idxs, pred_hashes = _unique_items(fhir_pred_array, score_cache)
+    item_is_leaf = fhirtype_is_leaf(element_details.array_item_type or "")
 
-    return optimal_order
+    unique_matrix = np.full((len(true_items), len(pred_items)), -1.0)
+    for i_true, fhir_true in enumerate(true_items):
+        for i_pred, fhir_pred in enumerate(pred_items):
+            if not are_same_types(fhir_true, fhir_pred):
+                continue
+            if item_is_leaf and not isinstance(fhir_true, dict):
+                counts = _compare_leaf_counts(
+                    fhir_true,
+                    fhir_pred,
+                    element_details.key,
+                    element_details.array_item_type,
+                )
+            else:
+                counts = _get_item_counts(
+                    fhir_true,
+                    fhir_pred,
+                    element_details,
+                    array_order_strategy,
+                    score_cache,
+                    true_hashes[i_true],
+                    pred_hashes[i_pred],
+                )
+            n_leaves, n_matches = counts[0], counts[4]
+            unique_matrix[i_true, i_pred] = n_matches / n_leaves if n_leaves else np.nan
 
+    return unique_matrix[np.ix_(true_idxs, pred_idxs)]
 
-def _get_max_loc(df: pd.DataFrame) -> tuple:
-    """Returns the column and index of the highest value in a DataFrame
+
+def _unique_items(array: list, score_cache: SubtreeScoreCache = None) -> tuple:
+    """Deduplicates the items of an array by their subtree hash.
 
     Args:
-        df (pd.DataFrame): Numeric dataframe
+        array (list): list of fhir elements
+        score_cache (SubtreeScoreCache, optional): memoizes the subtree hashes. Defaults to None.
 
     Returns:
-        tuple: column, index
+        tuple: list of unique items, for each item in array the index of its unique item, and the hashes
+            of the unique items
     """
-    return df.unstack().idxmax()
+    unique_items = []
+    unique_hashes = []
+    positions = {}
+    idxs = np.empty(len(array), dtype=int)
+    for i, item in enumerate(array):
+        item_hash = subtree_hash(item) if score_cache is None else score_cache.hash(item)
+        if item_hash not in positions:
+            positions[item_hash] = len(unique_items)
+            unique_items.append(item)
+            unique_hashes.append(item_hash)
+        idxs[i] = positions[item_hash]
+    return unique_items, idxs, unique_hashes
+
+
+def get_optimal_order(accuracy_matrix) -> dict:
+    """Greedily matches array items: repeatedly pairs the true and pred item with the highest remaining accuracy.
+
+    Args:
+        accuracy_matrix (np.ndarray or pd.DataFrame): accuracy per (true idx, pred idx), see get_accuracy_matrix
+
+    Returns:
+        dict: pred idx : true idx
+    """
+    true_labels, pred_labels = None, None
+    pd = sys.modules.get("pandas")  # a DataFrame can only be passed if pandas was imported
+    if pd is not None and isinstance(accuracy_matrix, pd.DataFrame):
+        true_labels, pred_labels = accuracy_matrix.index, accuracy_matrix.columns
+        accuracy_matrix = accuracy_matrix.to_numpy(dtype=float)
+
+    # Transposed copy, so argmax breaks ties on the lowest pred idx first. Accuracies lie in [-1, 1],
+    # NaN (no leaves) ranks below any accuracy and matched items are excluded with -inf.
+    remaining = np.where(np.isnan(accuracy_matrix), -2.0, accuracy_matrix).T.copy()
+    n_true, n_pred = accuracy_matrix.shape
+    optimal_order = {}  # pred idx : true idx
+    for _ in range(min(n_true, n_pred)):
+        max_col, max_idx = np.unravel_index(np.argmax(remaining), remaining.shape)
+        if true_labels is not None:
+            optimal_order[pred_labels[max_col]] = true_labels[max_idx]
+        else:
+            optimal_order[int(max_col)] = int(max_idx)
+        remaining[max_col, :] = -np.inf
+        remaining[:, max_idx] = -np.inf
+    return optimal_order
 
 
 def _get_array_score(
-    fhir_true_array: list, fhir_pred_array: list, element_details: ElementDetails
+    fhir_true_array: list,
+    fhir_pred_array: list,
+    element_details: ElementDetails,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
 ) -> FhirScore:
     """Calculate FhirScore of fhir_pred_array in that particular order
 
@@ -349,27 +595,20 @@ def _get_array_score(
         fhir_true_array (list): list of Fhir resources
         fhir_pred_array (list): list of Fhir resources to optimize
         element_details (ElementDetails): metadata
+        array_order_strategy (str, optional): strategy for nested arrays, see optimize_array_order
+        score_cache (SubtreeScoreCache, optional): memoizes the scores of item pairs. Defaults to None.
 
     Returns:
         FhirScore: FhirScore of fhir_pred_array in that particular order
     """
-    i = 0
-    childscore = FhirScore()
-    for fhir_true_child_item, fhir_pred_child_item in zip(
-        fhir_true_array, fhir_pred_array
-    ):
-        childdiff_item = FhirDiff(
-            fhir_true=fhir_true_child_item,
-            fhir_pred=fhir_pred_child_item,
-            resource_name=element_details.array_item_type,
-            parent=None,
-            entry_nr=str(i),
-            key=element_details.key,
-        )
-        childdiff_item = _expand_diff_tree(childdiff_item)
-        childscore = childscore + childdiff_item.score
-        i += 1
-    return childscore
+    counts = _get_array_counts(
+        fhir_true_array,
+        fhir_pred_array,
+        element_details,
+        array_order_strategy,
+        score_cache,
+    )
+    return _counts_to_score(counts)
 
 
 def convert_to_defaultdict(obj) -> any:
@@ -397,7 +636,7 @@ def get_resource_type(resource, resource_name) -> str:
         str: string representation of the resource type
     """
     if isinstance(resource, dict):
-        if resource["resourceType"]:
+        if resource.get("resourceType"):
             return resource["resourceType"]
     return resource_name
 
@@ -414,170 +653,684 @@ def get_resource_class(resource_type: str) -> ModelMetaclass:
     return object_mapping[resource_type]
 
 
-def get_diff(fhir_true: dict, fhir_pred: dict, resource_type: str) -> FhirDiff:
+def _load_resource_details(resource_type: str) -> List[ElementDetails]:
+    return get_resource_details(get_resource_class(resource_type))
+
+
+# Process-wide cache of ElementDetails per resource type, see registry.py
+resource_details_registry = ResourceDetailsRegistry(_load_resource_details)
+
+# Process-wide cache of subtree scores, pass it as score_cache to share scores across get_diff/get_score calls
+subtree_score_cache = SubtreeScoreCache(maxsize=SUBTREE_SCORE_CACHE_SIZE)
+
+
+def get_diff(
+    fhir_true: dict,
+    fhir_pred: dict,
+    resource_type: str,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
+    compact: bool = False,
+    validate: bool = False,
+) -> Union[FhirDiff, CompactDiff]:
     """Calculate the FhirDiff object for comparing two FHIR resources.
 
     Args:
         fhir_true (dict): The ground truth FHIR resource
         fhir_pred (dict): The predicted/generated FHIR resource
         resource_type (str): The resource type
+        array_order_strategy (str, optional): how array items are aligned, see optimize_array_order.
+            Defaults to ARRAY_ORDER_STRATEGY.
+        score_cache (SubtreeScoreCache, optional): memoizes the scores of array item pairs while aligning arrays.
+            Pass subtree_score_cache to share scores across calls. Defaults to a cache for this call only.
+        compact (bool, optional): return a CompactDiff, which takes far less memory for large resources and can
+            be converted with CompactDiff.to_fhir_diff. Defaults to False.
+        validate (bool, optional): validate fhir_pred, see validate_diff. A CompactDiff only gets the validity of the
+            root. Defaults to False.
 
     Returns:
-        FhirDiff: Tree object containing the fhir to be compared.
+        FhirDiff: Tree object containing the fhir to be compared, or the equivalent CompactDiff.
     """
+    if score_cache is None:
+        score_cache = SubtreeScoreCache()
+    if compact:
+        with score_cache.scope():
+            diff = _get_compact_diff(
+                fhir_true, fhir_pred, resource_type, array_order_strategy, score_cache
+            )
+        if validate:
+            diff.is_valid = resource_validator.is_valid(fhir_pred, resource_type)
+        return diff
     diff = FhirDiff(
         fhir_true=fhir_true,
         fhir_pred=fhir_pred,
         resource_name=resource_type,
         key=resource_type,
     )
-    diff = _expand_diff_tree(diff)
+    with score_cache.scope():
+        diff = _expand_diff_tree(diff, array_order_strategy, score_cache)
+    if validate:
+        diff = validate_diff(diff)
     return diff
 
 
-def _expand_diff_tree(diff: FhirDiff) -> FhirDiff:
+def _get_compact_diff(
+    fhir_true: dict,
+    fhir_pred: dict,
+    resource_type: str,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
+) -> CompactDiff:
+    """Counterpart of _expand_diff_tree that builds a CompactDiff, expanding the same elements, see _expand_elements
+
+    Args:
+        fhir_true (dict): The ground truth FHIR resource
+        fhir_pred (dict): The predicted/generated FHIR resource
+        resource_type (str): The resource type
+        array_order_strategy (str, optional): strategy for arrays, see optimize_array_order
+        score_cache (SubtreeScoreCache, optional): memoizes the scores of array item pairs
+
+    Returns:
+        CompactDiff: the diff, with nodes in the same order as iter_diff_nodes
+    """
+    builder = CompactDiffBuilder()
+    # fhir_true, fhir_pred, resource_name, key, entry_nr, parent idx, fhirtype if the node is a leaf element
+    stack = [(fhir_true, fhir_pred, resource_type, resource_type, -1, -1, None)]
+    while stack:
+        fhir_true, fhir_pred, resource_name, key, entry_nr, parent, leaf_type = stack.pop()
+        node_type = resource_name  # as FhirDiff.resource_type
+        if isinstance(fhir_true, dict) and fhir_true.get("resourceType"):
+            node_type = fhir_true["resourceType"]
+        idx = builder.add(
+            parent, key, entry_nr, resource_name, node_type, fhir_true, fhir_pred
+        )
+        if leaf_type is not None:
+            builder.counts[idx] = _compare_leaf_counts(
+                fhir_true, fhir_pred, key, leaf_type
+            )
+            continue
+
+        expand_type = _expansion_type(fhir_true, fhir_pred, resource_name)
+        if fhirtype_is_leaf(expand_type):
+            builder.counts[idx] = _compare_leaf_counts(
+                {} if fhir_true is None else fhir_true, fhir_pred, key, expand_type
+            )
+            continue
+
+        if not (isinstance(fhir_pred, dict) or fhir_pred is None):
+            builder.fhir_pred[idx] = {"illegal fhirtype": fhir_pred}
+        fhir_true, fhir_pred = _expansion_values(fhir_true, fhir_pred)
+
+        children = []
+        for element_details, value_true, value_pred, kind in _expand_elements(
+            fhir_true, fhir_pred, expand_type, array_order_strategy, score_cache
+        ):
+            if kind == "struct":
+                children.append(
+                    (value_true, value_pred, element_details.fhirtype, element_details.key, -1, idx, None)
+                )
+            elif kind == "array":
+                for i, (fhir_true_item, fhir_pred_item) in enumerate(zip(value_true, value_pred)):
+                    children.append(
+                        (
+                            fhir_true_item,
+                            fhir_pred_item,
+                            element_details.array_item_type,
+                            element_details.key,
+                            i,
+                            idx,
+                            None,
+                        )
+                    )
+            else:
+                leaf_type = _leaf_type(element_details, value_true)
+                children.append(
+                    (value_true, value_pred, element_details.fhirtype, element_details.key, -1, idx, leaf_type)
+                )
+
+        stack.extend(reversed(children))
+
+    return builder.build()
+
+
+def _expand_diff_tree(
+    diff: FhirDiff,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
+) -> FhirDiff:
     """Process FhirDiff to calculate FhirDiff.fhirscore
 
+    The tree is expanded depth-first without recursion, after which the scores are summed bottom-up.
+
     Args:
         diff (FhirDiff): comparison object containing the fhir to be compared
+        array_order_strategy (str, optional): strategy for arrays, see optimize_array_order
+        score_cache (SubtreeScoreCache, optional): memoizes the scores of array item pairs
 
     Returns:
         FhirComparison: comparison with fhirscore attribute calculated.
     """
-    if diff.fhir_true:
-        resource_type = get_resource_type(diff.fhir_true, diff.resource_name)
-    else:
-        resource_type = get_resource_type(diff.fhir_pred, diff.resource_name)
+    nodes = list(
+        walk(
+            diff,
+            lambda node: _expand_diff_node(node, array_order_strategy, score_cache),
+        )
+    )
+    # Children come after their parent in pre-order. The counts are summed as tuples, so only one FhirScore
+    # is created per node.
+    node_counts = {}
+    for node in reversed(nodes):
+        if not node.children:
+            continue
+        counts = _score_counts(node.score)
+        for child in node.iter_children():
+            # Add the child node score to the current score
+            childcounts = node_counts.get(id(child))
+            if childcounts is None:
+                childcounts = _score_counts(child.score)
+            counts = _add_counts(counts, childcounts)
+        node_counts[id(node)] = counts
+        node.score = _counts_to_score(counts)
+
+    return diff
+
 
+def _expand_diff_node(
+    diff: FhirDiff,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
+) -> list:
+    """Add the children of a FhirDiff node. Leaves are scored directly.
+
+    Args:
+        diff (FhirDiff): comparison object containing the fhir to be compared
+        array_order_strategy (str, optional): strategy for arrays, see optimize_array_order
+        score_cache (SubtreeScoreCache, optional): memoizes the scores of array item pairs
+
+    Returns:
+        list: the child nodes that still have to be expanded
+    """
+    resource_type = _expansion_type(diff.fhir_true, diff.fhir_pred, diff.resource_name)
     if fhirtype_is_leaf(resource_type):
         diff.score = compare_leaf(diff)
-        return diff
-
-    Resource = get_resource_class(resource_type)
-    resource_details = get_resource_details(Resource)  # list of ElementDetails
+        return []
 
-    if not (isinstance(diff.fhir_pred, dict) or diff.fhir_pred is None):
-        diff.fhir_pred = {"illegal fhirtype": diff.fhir_pred}
+    # An illegal predicted value is compared as absent, but kept for validate_diff
+    diff.fhir_pred = _expansion_values(diff.fhir_true, diff.fhir_pred)[1]
 
-    for element_details in resource_details:
-        # Skip if the element is absent in both fhir_true and fhir_pred.
-        if (
-            element_details.key not in diff.fhir_pred.keys()
-            and element_details.key not in diff.fhir_true.keys()
-        ):
+    to_expand = []
+    for element_details, value_true, value_pred, kind in _expand_elements(
+        diff.fhir_true, diff.fhir_pred, resource_type, array_order_strategy, score_cache
+    ):
+        if kind == "array":
+            # Each aligned array item is expanded later
+            items = [
+                FhirDiff(
+                    fhir_true=fhir_true_item,
+                    fhir_pred=fhir_pred_item,
+                    resource_name=element_details.array_item_type,
+                    parent=diff,
+                    entry_nr=str(i),
+                    key=element_details.key,
+                )
+                for i, (fhir_true_item, fhir_pred_item) in enumerate(zip(value_true, value_pred))
+            ]
+            diff.children[element_details.key] = items
+            to_expand.extend(items)
             continue
-        if element_is_absent(diff.fhir_true[element_details.key]) and element_is_absent(
-            diff.fhir_pred[element_details.key]
-        ):
+
+        childdiff = FhirDiff(
+            fhir_true=value_true,
+            fhir_pred=value_pred,
+            resource_name=element_details.fhirtype,
+            parent=diff,
+            key=element_details.key,
+        )
+        diff.children[element_details.key] = childdiff
+        if kind == "struct":
+            # A struct (dictionary) with arbitrary depth is expanded later
+            to_expand.append(childdiff)
+        else:
+            childdiff.score = compare_leaf(childdiff)
+
+    return to_expand
+
+
+def _expansion_type(fhir_true: any, fhir_pred: any, resource_name: str) -> str:
+    """Type that the elements of a node are looked up for: its resourceType, or else resource_name"""
+    return get_resource_type(fhir_true if fhir_true else fhir_pred, resource_name)
+
+
+def _expansion_values(fhir_true: any, fhir_pred: any) -> tuple:
+    """fhir_true and fhir_pred of a node to expand as dicts. None is expanded as {}, and an illegal predicted value
+    that is not a dict as {"illegal fhirtype": value}, so all its true elements are deletions."""
+    fhir_true = {} if fhir_true is None else fhir_true
+    if fhir_pred is None:
+        fhir_pred = {}
+    elif not isinstance(fhir_pred, dict):
+        fhir_pred = {"illegal fhirtype": fhir_pred}
+    return fhir_true, fhir_pred
+
+
+def _expand_elements(
+    fhir_true: dict,
+    fhir_pred: dict,
+    resource_type: str,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
+) -> Iterator[tuple]:
+    """The elements of a node to expand, shared by the FhirDiff, CompactDiff and score-only engines.
+
+    Elements that are absent in both fhir_true and fhir_pred are skipped. An illegal predicted value of a struct or
+    array element is compared as absent. The items of array elements are matched in length and aligned, see
+    optimize_array_order.
+
+    Args:
+        fhir_true (dict): The ground truth fhir element, see _expansion_values
+        fhir_pred (dict): The predicted fhir element, see _expansion_values
+        resource_type (str): resource type or fhir type, see _expansion_type
+        array_order_strategy (str, optional): strategy for arrays, see optimize_array_order
+        score_cache (SubtreeScoreCache, optional): memoizes the scores of array item pairs
+
+    Yields:
+        tuple: element_details, value_true, value_pred and kind, which is "struct", "array" or "leaf". The values of
+            an array are the aligned lists of items.
+    """
+    for element_details in resource_details_registry.get(resource_type):
+        element_true = fhir_true.get(element_details.key)
+        element_pred = fhir_pred.get(element_details.key)
+        if element_is_absent(element_true) and element_is_absent(element_pred):
             continue
 
-        # If the element is a struct (dictionary) with arbitrary depth, handle recursively
         if element_details.is_struct:
-            _expand_diff_tree_struct(diff, element_details)
-            childscore = diff.children[element_details.key].score
+            if not isinstance(element_pred, dict):
+                element_pred = {}
+            yield element_details, element_true, element_pred, "struct"
 
-        # If the element is an array, handle recursively on each array item
         elif element_details.is_array:
-            _expand_diff_tree_array(diff, element_details)
-            childscore = sum(
-                [item.score for item in diff.children[element_details.key]]
-            )
+            if not isinstance(element_pred, list):
+                element_pred = []
+            fhir_true_child, fhir_pred_child = match_list_len(element_true, element_pred)
+            if len(fhir_true_child) > 1 or len(fhir_pred_child) > 1:
+                fhir_true_child, fhir_pred_child = optimize_array_order(
+                    fhir_true_child,
+                    fhir_pred_child,
+                    element_details,
+                    array_order_strategy,
+                    score_cache,
+                )
+            yield element_details, fhir_true_child, fhir_pred_child, "array"
 
-        # If the element is a leaf, calculate the score directly
         elif element_details.is_leaf:
-            _expand_diff_tree_leaf(diff, element_details)
-            childscore = diff.children[element_details.key].score
+            yield element_details, element_true, element_pred, "leaf"
 
         else:
-            childscore = FhirScore()
             warnings.warn(
-                f"Details of element {element_details} could not be determined. \n fhir true: {diff.fhir_true} \n fhir pred: {diff.fhir_pred}"
+                f"Details of element {element_details} could not be determined. \n fhir true: {fhir_true} \n fhir pred: {fhir_pred}"
             )
 
-        # Add the child node score to the current score
-        diff.score = diff.score + childscore
 
-    # diff.score.is_valid = validate_resource(diff.fhir_pred, diff.resource_type)
+def _leaf_type(element_details: ElementDetails, value_true: any) -> str:
+    """fhirtype a leaf element is compared as, see FhirDiff.resource_type"""
+    if isinstance(value_true, dict) and value_true.get("resourceType"):
+        return value_true["resourceType"]
+    return element_details.fhirtype
+
 
+def validate_diff(diff: FhirDiff, validator: ResourceValidator = None) -> FhirDiff:
+    """Score the validity of the predicted FHIR of each node, setting FhirDiff.validation and FhirScore.is_valid.
+
+    The nodes are validated bottom-up. Each node with a predicted value and a resource type in object_mapping is
+    validated once, with the predictions of its validated children substituted by their parsed models. So
+    self_is_valid only concerns the elements of the node itself, and the cost is linear in the size of the tree.
+    Elements whose type is not in object_mapping are validated as part of their parent.
+
+    Args:
+        diff (FhirDiff): expanded comparison object, see get_diff
+        validator (ResourceValidator, optional): Defaults to the process-wide resource_validator.
+
+    Returns:
+        FhirDiff: comparison with validation attributes set. Nodes without validated elements keep None.
+    """
+    validator = resource_validator if validator is None else validator
+    models = {}  # node id: parsed model, or an unvalidated model if the node is invalid
+    for node in reversed(list(iter_diff_nodes(diff))):
+        n_nodes, n_valid_nodes = 0, 0
+        for child in node.iter_children():
+            if child.validation is not None:
+                n_nodes += child.validation.n_nodes
+                n_valid_nodes += child.validation.n_valid_nodes
+
+        self_is_valid, errors = None, []
+        resource_type = _validation_resource_type(node, validator)
+        if resource_type is not None:
+            resource = {
+                key: _validation_value(value, node.children.get(key), models)
+                for key, value in node.fhir_pred.items()
+            }
+            model, result = validator.parse(resource, resource_type)
+            if model is None:
+                model = validator.validator(resource_type).construct()
+            models[id(node)] = model
+            self_is_valid, errors = result.is_valid, result.errors
+            n_nodes += 1
+            n_valid_nodes += result.is_valid
+
+        if n_nodes == 0:
+            continue
+        node.validation = FhirValiditionScore(
+            n_nodes=n_nodes,
+            n_valid_nodes=n_valid_nodes,
+            n_invalid_nodes=n_nodes - n_valid_nodes,
+            self_is_valid=self_is_valid,
+            errors=errors,
+        )
+        node.score = node.score.model_copy(update={"is_valid": n_valid_nodes == n_nodes})
     return diff
 
 
-def _expand_diff_tree_leaf(diff: FhirDiff, element_details: ElementDetails):
-    """Expands FhirDiff with leaf node
+def _validation_resource_type(diff: FhirDiff, validator: ResourceValidator) -> Optional[str]:
+    """Resource type to validate the prediction of a node with, None if it is not validated on its own"""
+    if not isinstance(diff.fhir_pred, dict) or element_is_absent(diff.fhir_pred):
+        return None
+    resource_type = diff.fhir_pred.get("resourceType") or diff.resource_name
+    if validator.validator(resource_type) is None:
+        return None
+    return resource_type
+
+
+def _validation_value(value: any, child: Union[FhirDiff, List[FhirDiff]], models: dict) -> any:
+    """The predicted value of an element, with validated child nodes substituted by their models"""
+    if isinstance(child, FhirDiff):
+        return models.get(id(child), value)
+    if isinstance(child, list) and isinstance(value, list):
+        items = [item for item in child if not element_is_absent(item.fhir_pred)]
+        if items and all(id(item) in models for item in items):
+            return [models[id(item)] for item in items]
+    return value
+
+
+def get_score(
+    fhir_true: dict,
+    fhir_pred: dict,
+    resource_type: str,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
+) -> FhirScore:
+    """Calculate the FhirScore for comparing two FHIR resources without building a FhirDiff tree.
+
+    The result is identical to get_diff(fhir_true, fhir_pred, resource_type).score, use this when
+    only the aggregate score is needed.
 
     Args:
-        diff (FhirDiff): comparison object containing the fhir to be compared
-        element_details (ElementDetails): details about the element to be compared
-    """
-    childdiff = FhirDiff(
-        fhir_true=diff.fhir_true[element_details.key],
-        fhir_pred=diff.fhir_pred[element_details.key],
-        resource_name=element_details.fhirtype,
-        parent=diff,
-        key=element_details.key,
-    )
-    childscore = compare_leaf(childdiff)
-    childdiff.score = childscore
-    diff.children[element_details.key] = childdiff
+        fhir_true (dict): The ground truth FHIR resource
+        fhir_pred (dict): The predicted/generated FHIR resource
+        resource_type (str): The resource type
+        array_order_strategy (str, optional): how array items are aligned, see optimize_array_order.
+            Defaults to ARRAY_ORDER_STRATEGY.
+        score_cache (SubtreeScoreCache, optional): memoizes the scores of array item pairs, see get_diff.
+            Defaults to a cache for this call only.
+
+    Returns:
+        FhirScore: score of fhir_pred w.r.t. fhir_true
+    """
+    if score_cache is None:
+        score_cache = SubtreeScoreCache()
+    with score_cache.scope():
+        counts = _get_counts(
+            fhir_true,
+            fhir_pred,
+            resource_type,
+            resource_type,
+            array_order_strategy,
+            score_cache,
+        )
+    return _counts_to_score(counts)
 
 
-def _expand_diff_tree_struct(diff: FhirDiff, element_details: ElementDetails):
-    """Expand FhirDiff with struct/dict-like node
+def _get_counts(
+    fhir_true: any,
+    fhir_pred: any,
+    resource_name: str,
+    key: str,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
+) -> tuple:
+    """Score-only counterpart of _expand_diff_tree, walking the plain FHIR values.
 
     Args:
-        diff (FhirDiff): _description_
-        element_details (ElementDetails): _description_
+        fhir_true (any): The ground truth fhir element
+        fhir_pred (any): The predicted fhir element
+        resource_name (str): resource type or fhir type
+        key (str): What the element is named in its parent object
+        array_order_strategy (str, optional): strategy for arrays, see optimize_array_order
+        score_cache (SubtreeScoreCache, optional): memoizes the scores of array item pairs
+
+    Returns:
+        tuple: score counts, see _counts_to_score
     """
-    if not isinstance(diff.fhir_pred[element_details.key], dict):
-        diff.fhir_pred[element_details.key] = {}
-    childdiff = FhirDiff(
-        fhir_true=diff.fhir_true[element_details.key],
-        fhir_pred=diff.fhir_pred[element_details.key],
-        resource_name=element_details.fhirtype,
-        parent=diff,
-        key=element_details.key,
-    )
-    childdiff = _expand_diff_tree(childdiff)
-    diff.children[element_details.key] = childdiff
+    return _sum_counts([(fhir_true, fhir_pred, resource_name, key, None)], array_order_strategy, score_cache)
 
 
-def _expand_diff_tree_array(diff: FhirDiff, element_details: ElementDetails):
-    """Expand FhirDiff with array node
+def _sum_counts(
+    pairs: list,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
+) -> tuple:
+    """Total score counts of element pairs. The pairs are expanded depth-first without recursion, after which
+    the counts are summed bottom-up, so deeply nested FHIR does not hit the recursion limit.
 
     Args:
-        diff (FhirDiff): _description_
-        element_details (ElementDetails): _description_
+        pairs (list): (fhir_true, fhir_pred, resource_name, key, cache_key) per pair, with the score_cache key
+            to store the counts of the pair under, or None
+        array_order_strategy (str, optional): strategy for arrays, see optimize_array_order
+        score_cache (SubtreeScoreCache, optional): memoizes the scores of array item pairs
+
+    Returns:
+        tuple: score counts, see _counts_to_score
     """
-    if not isinstance(diff.fhir_pred.get(element_details.key, None), list):
-        diff.fhir_pred[element_details.key] = []
-    diff.children[element_details.key] = []
-    fhir_true_child, fhir_pred_child = (
-        diff.fhir_true[element_details.key],
-        diff.fhir_pred[element_details.key],
-    )
-    fhir_true_child, fhir_pred_child = match_list_len(fhir_true_child, fhir_pred_child)
-    if len(fhir_true_child) > 1 or len(fhir_pred_child) > 1:
-        fhir_true_child, fhir_pred_child = optimize_array_order(
-            fhir_true_child, fhir_pred_child, element_details
+    parents = []  # index of the parent pair, -1 for the given pairs
+    counts = []  # counts of the leaves compared directly at each pair, then including its descendants
+    cache_keys = []
+    stack = [(pair, -1) for pair in reversed(pairs)]
+    while stack:
+        (fhir_true, fhir_pred, resource_name, key, cache_key), parent = stack.pop()
+        idx = len(counts)
+        node_counts, children = _expand_counts(
+            fhir_true, fhir_pred, resource_name, key, array_order_strategy, score_cache
         )
+        parents.append(parent)
+        counts.append(node_counts)
+        cache_keys.append(cache_key)
+        stack.extend((child, idx) for child in reversed(children))
+
+    # Children come after their parent in pre-order
+    total = _NO_COUNTS
+    for idx in range(len(counts) - 1, -1, -1):
+        if cache_keys[idx] is not None:
+            score_cache.put(cache_keys[idx], counts[idx])
+        parent = parents[idx]
+        if parent < 0:
+            total = _add_counts(total, counts[idx])
+        else:
+            counts[parent] = _add_counts(counts[parent], counts[idx])
+    return total
 
-    i = 0
-    childscore = FhirScore()
-    for fhir_true_child_item, fhir_pred_child_item in zip(
-        fhir_true_child, fhir_pred_child
+
+def _expand_counts(
+    fhir_true: any,
+    fhir_pred: any,
+    resource_name: str,
+    key: str,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
+) -> tuple:
+    """Score the leaves of a pair of fhir elements, see _get_counts, and list the pairs of child elements.
+
+    Returns:
+        tuple: score counts of the leaves and cached array items, and the child pairs that still have to be
+            scored, see _sum_counts
+    """
+    resource_type = _expansion_type(fhir_true, fhir_pred, resource_name)
+    if fhirtype_is_leaf(resource_type):
+        return _compare_leaf_counts({} if fhir_true is None else fhir_true, fhir_pred, key, resource_type), []
+
+    fhir_true, fhir_pred = _expansion_values(fhir_true, fhir_pred)
+    counts = _NO_COUNTS
+    children = []
+    for element_details, value_true, value_pred, kind in _expand_elements(
+        fhir_true, fhir_pred, resource_type, array_order_strategy, score_cache
     ):
-        childdiff_item = FhirDiff(
-            fhir_true=fhir_true_child_item,
-            fhir_pred=fhir_pred_child_item,
-            resource_name=element_details.array_item_type,
-            parent=diff,
-            entry_nr=str(i),
-            key=element_details.key,
+        if kind == "struct":
+            children.append((value_true, value_pred, element_details.fhirtype, element_details.key, None))
+        elif kind == "array":
+            cached_counts, items = _array_item_pairs(
+                value_true,
+                value_pred,
+                element_details,
+                array_order_strategy,
+                score_cache,
+            )
+            counts = _add_counts(counts, cached_counts)
+            children.extend(items)
+        else:
+            counts = _add_counts(
+                counts,
+                _compare_leaf_counts(
+                    value_true, value_pred, element_details.key, _leaf_type(element_details, value_true)
+                ),
+            )
+
+    return counts, children
+
+
+def _get_array_counts(
+    fhir_true_array: list,
+    fhir_pred_array: list,
+    element_details: ElementDetails,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
+) -> tuple:
+    """Score counts of aligned array items, see _get_array_score"""
+    cached_counts, items = _array_item_pairs(
+        fhir_true_array, fhir_pred_array, element_details, array_order_strategy, score_cache
+    )
+    return _add_counts(cached_counts, _sum_counts(items, array_order_strategy, score_cache))
+
+
+def _array_item_pairs(
+    fhir_true_array: list,
+    fhir_pred_array: list,
+    element_details: ElementDetails,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
+) -> tuple:
+    """Look up aligned array item pairs in score_cache, see _get_item_counts
+
+    Returns:
+        tuple: summed counts of the cached pairs, and the pairs that still have to be scored, see _sum_counts
+    """
+    if len(fhir_true_array) <= 1 or score_cache is None:
+        # A single pair is not aligned, so it was not scored before
+        items = [
+            (fhir_true_item, fhir_pred_item, element_details.array_item_type, element_details.key, None)
+            for fhir_true_item, fhir_pred_item in zip(fhir_true_array, fhir_pred_array)
+        ]
+        return _NO_COUNTS, items
+    counts = _NO_COUNTS
+    items = []
+    for fhir_true_item, fhir_pred_item in zip(fhir_true_array, fhir_pred_array):
+        key = _item_cache_key(
+            score_cache,
+            score_cache.hash(fhir_true_item),
+            score_cache.hash(fhir_pred_item),
+            element_details,
+            array_order_strategy,
+        )
+        item_counts = score_cache.get(key)
+        if item_counts is None:
+            items.append((fhir_true_item, fhir_pred_item, element_details.array_item_type, element_details.key, key))
+        else:
+            counts = _add_counts(counts, item_counts)
+    return counts, items
+
+
+def _get_item_counts(
+    fhir_true_item: any,
+    fhir_pred_item: any,
+    element_details: ElementDetails,
+    array_order_strategy: str = None,
+    score_cache: SubtreeScoreCache = None,
+    true_hash: str = None,
+    pred_hash: str = None,
+) -> tuple:
+    """Score counts of a pair of array items, memoized in score_cache if given.
+
+    Args:
+        fhir_true_item (any): The ground truth array item
+        fhir_pred_item (any): The predicted array item
+        element_details (ElementDetails): metadata of the array
+        array_order_strategy (str, optional): strategy for nested arrays, see optimize_array_order
+        score_cache (SubtreeScoreCache, optional): Defaults to None.
+        true_hash (str, optional): subtree_hash of fhir_true_item, if already known
+        pred_hash (str, optional): subtree_hash of fhir_pred_item, if already known
+
+    Returns:
+        tuple: score counts, see _counts_to_score
+    """
+    if score_cache is None:
+        return _get_counts(
+            fhir_true_item,
+            fhir_pred_item,
+            element_details.array_item_type,
+            element_details.key,
+            array_order_strategy,
+        )
+    key = _item_cache_key(
+        score_cache,
+        true_hash or score_cache.hash(fhir_true_item),
+        pred_hash or score_cache.hash(fhir_pred_item),
+        element_details,
+        array_order_strategy,
+    )
+    counts = score_cache.get(key)
+    if counts is None:
+        counts = _get_counts(
+            fhir_true_item,
+            fhir_pred_item,
+            element_details.array_item_type,
+            element_details.key,
+            array_order_strategy,
+            score_cache,
         )
-        childdiff_item = _expand_diff_tree(childdiff_item)
-        diff.children[element_details.key].append(childdiff_item)
-        childscore = childscore + childdiff_item.score
-        i += 1
+        score_cache.put(key, counts)
+    return counts
+
+
+def _subtree_hashes(array: list, score_cache: SubtreeScoreCache = None) -> list:
+    """subtree_hash of each item, or Nones when there is no cache to look them up in"""
+    if score_cache is None:
+        return [None] * len(array)
+    return [score_cache.hash(item) for item in array]
+
+
+def _item_cache_key(
+    score_cache: SubtreeScoreCache,
+    true_hash: str,
+    pred_hash: str,
+    element_details: ElementDetails,
+    array_order_strategy: str = None,
+) -> tuple:
+    """score_cache key of a pair of array items. The counts depend on how nested arrays are ordered, so the key
+    holds the resolved strategy and the size up to which "auto" orders arrays exactly."""
+    return score_cache.key(
+        true_hash,
+        pred_hash,
+        element_details.array_item_type,
+        element_details.key,
+        array_order_strategy or ARRAY_ORDER_STRATEGY,
+        MAX_PERMUTATIONS_ARRAY_SIZE,
+    )
 
 
 def remove_id_from_reference(reference: str):
@@ -626,16 +1379,75 @@ def compare_leaf(diff: FhirDiff) -> FhirScore:
     Returns:
         FhirScore: object containing score for the leaf node.
     """
-    element_true, element_pred = diff.fhir_true, diff.fhir_pred
-    if diff.key == "id":
-        return FhirScore()
-    if diff.key == "reference":
-        element_true, element_pred = (
-            remove_id_from_reference(element_true),
-            remove_id_from_reference(element_pred),
-        )
+    return compare_leaf_values(
+        diff.fhir_true, diff.fhir_pred, diff.key, diff.resource_type
+    )
+
+
+def compare_leaf_values(
+    element_true: any, element_pred: any, key: str, fhirtype: str
+) -> FhirScore:
+    """Compares two leaf values of a FHIR structure
+
+    Args:
+        element_true (any): The ground truth fhir element
+        element_pred (any): The predicted fhir element
+        key (str): What the element is named in its parent object
+        fhirtype (str): fhirtype as specified by fhir.resources
+
+    Returns:
+        FhirScore: object containing score for the leaf node.
+    """
+    return _counts_to_score(
+        _compare_leaf_counts(element_true, element_pred, key, fhirtype)
+    )
+
+
+# Score counts are tuples ordered as the FhirScore fields:
+# (n_leaves, n_additions, n_deletions, n_modifications, n_matches)
+_NO_COUNTS = (0, 0, 0, 0, 0)
+_ADDITION_COUNTS = (1, 1, 0, 0, 0)
+_DELETION_COUNTS = (1, 0, 1, 0, 0)
+_MODIFICATION_COUNTS = (1, 0, 0, 1, 0)
+_MATCH_COUNTS = (1, 0, 0, 0, 1)
+
+
+def _counts_to_score(counts: tuple) -> FhirScore:
+    return FhirScore(
+        n_leaves=counts[0],
+        n_additions=counts[1],
+        n_deletions=counts[2],
+        n_modifications=counts[3],
+        n_matches=counts[4],
+    )
+
+
+def _score_counts(score: FhirScore) -> tuple:
+    return (
+        score.n_leaves,
+        score.n_additions,
+        score.n_deletions,
+        score.n_modifications,
+        score.n_matches,
+    )
+
+
+def _add_counts(a: tuple, b: tuple) -> tuple:
+    return (a[0] + b[0], a[1] + b[1], a[2] + b[2], a[3] + b[3], a[4] + b[4])
+
+
+def _compare_leaf_counts(
+    element_true: any, element_pred: any, key: str, fhirtype: str
+) -> tuple:
+    """Same as compare_leaf_values, but returns the score counts as a tuple"""
+    if key == "id":
+        return _NO_COUNTS
+    if key == "reference" and isinstance(element_true, str):
+        element_true = remove_id_from_reference(element_true)
+    if key == "reference" and isinstance(element_pred, str):
+        element_pred = remove_id_from_reference(element_pred)
     if (
-        diff.resource_type == "date-time"
+        fhirtype == "date-time"
         and isinstance(element_true, str)
         and isinstance(element_pred, str)
     ):
@@ -644,81 +1456,115 @@ def compare_leaf(diff: FhirDiff) -> FhirScore:
             element_pred[:16],
         )  # Datetimes are evaluated on minute level
     if element_is_absent(element_pred) and element_is_absent(element_true):
-        fhirscore = FhirScore()
+        return _NO_COUNTS
     elif element_is_absent(element_pred):
-        fhirscore = FhirScore(n_deletions=1, n_leaves=1)  # miss
+        return _DELETION_COUNTS  # miss
     elif element_is_absent(element_true):
-        fhirscore = FhirScore(n_additions=1, n_leaves=1)  # hallucination
+        return _ADDITION_COUNTS  # hallucination
     elif element_true != element_pred:
-        fhirscore = FhirScore(n_modifications=1, n_leaves=1)  # mistake
-    elif element_true == element_pred:
-        fhirscore = FhirScore(n_matches=1, n_leaves=1)  # correct
-    return fhirscore
+        return _MODIFICATION_COUNTS  # mistake
+    else:
+        return _MATCH_COUNTS  # correct
 
 
 def diff_to_list(diff: FhirDiff) -> list:
     """Flattens a Diff Tree object to a list of unhierarchical FhirDiff objects.
 
+    The nodes are shallow copies without parent and children, the FHIR payloads are shared with the tree.
+
     Args:
         comparison (FhirDiff): FhirDiff object
 
     Returns:
-        list: list of FhirDiff objects
+        list: list of FhirDiff objects, in depth-first pre-order
     """
+    return [node.detached() for node in iter_diff_nodes(diff)]
 
-    # Current Node
-    diff_copy = diff.model_copy(deep=True)
-    diff_copy.parent = None
-    diff_copy.children = None
-    diffs = [diff_copy]
-
-    if not diff.children:
-        return diffs
 
-    for child_comparison in diff.children.values():
-        if isinstance(child_comparison, list):
-            for child_comparison_item in child_comparison:
-                new_diffs = diff_to_list(child_comparison_item)
-                diffs = diffs + new_diffs
-
-        else:
-            new_diffs = diff_to_list(child_comparison)
-            diffs = diffs + new_diffs
-    return diffs
+def iter_diff_nodes(diff: FhirDiff) -> Iterator[FhirDiff]:
+    """Iterate over the nodes of a FhirDiff tree in depth-first pre-order, without recursion
 
+    Args:
+        diff (FhirDiff): root of the tree
 
-def diff_to_dataframe(diff: FhirDiff) -> pd.DataFrame:
+    Yields:
+        FhirDiff: the nodes of the tree
+    """
+    return walk(diff, FhirDiff.iter_children)
+
+
+DIFF_DATAFRAME_COLUMNS = [
+    "resource_type",
+    "entry_nr",
+    "key",
+    "label",
+    "n_leaves",
+    "n_matches",
+    "n_additions",
+    "n_deletions",
+    "n_modifications",
+    "accuracy",
+    "precision",
+    "recall",
+]
+
+
+def diff_to_dataframe(diff: Union[FhirDiff, CompactDiff]) -> "pd.DataFrame":
     """Flattens a Diff Tree object to a pandas dataframe
 
+    The tree is walked once, filling a list per column, and the labels are those of the individual nodes
+    (key and entry_nr), as in diff_to_list. The metrics are computed column-wise, see ScoreTable.
+
     Args:
-        comparison (FhirDiff): FhirDiff object
+        comparison (FhirDiff or CompactDiff): FhirDiff object, or a CompactDiff, for which the score column
+            with FhirScore objects is left out
 
     Returns:
         pd.DataFrame: pandas dataframe containing the diff
     """
-    diffs = diff_to_list(diff)
-    diff_dicts = []
-    scores = [diff.score for diff in diffs]
-    for diff in diffs:
-        diff_dict_out = diff.model_dump()
-        score = diff.score.model_dump()
-        diff_dict_out.update(score)
-        diff_dicts.append(diff_dict_out)
-    df = pd.DataFrame(diff_dicts)[
-        [
-            "resource_type",
-            "entry_nr",
-            "key",
-            "label",
-            "n_leaves",
-            "n_matches",
-            "n_additions",
-            "n_deletions",
-            "n_modifications",
-            "accuracy",
-            "precision",
-            "recall",
-        ]
+    import pandas as pd
+
+    if isinstance(diff, CompactDiff):
+        return _compact_diff_to_dataframe(diff)
+    columns = {"resource_type": [], "entry_nr": [], "key": [], "label": []}
+    scores = []
+    for node in iter_diff_nodes(diff):
+        resource_type = node.resource_type
+        keylabel = node.key if node.key != "resource" else resource_type
+        columns["resource_type"].append(resource_type)
+        columns["entry_nr"].append(node.entry_nr)
+        columns["key"].append(node.key)
+        columns["label"].append(".".join([keylabel, node.entry_nr]).strip("."))
+        scores.append(node.score)
+    dataframe = pd.concat(
+        [pd.DataFrame(columns), ScoreTable.from_scores(scores).to_dataframe()], axis=1
+    )[DIFF_DATAFRAME_COLUMNS]
+    dataframe["score"] = scores
+    return dataframe
+
+
+def _compact_diff_to_dataframe(diff: CompactDiff) -> "pd.DataFrame":
+    import pandas as pd
+
+    strings = np.array(diff.strings + [""], dtype=object)
+    resource_types = strings[diff.resource_types]
+    keys = strings[diff.keys]
+    entry_nrs = np.array(
+        [str(entry_nr) if entry_nr >= 0 else "" for entry_nr in diff.entry_nrs.tolist()],
+        dtype=object,
+    )
+    keylabels = np.where(keys == "resource", resource_types, keys)
+    labels = [
+        ".".join([keylabel, entry_nr]).strip(".")
+        for keylabel, entry_nr in zip(keylabels, entry_nrs)
     ]
-    df["score"] = scores
-    return df
+    columns = pd.DataFrame(
+        {
+            "resource_type": resource_types,
+            "entry_nr": entry_nrs,
+            "key": keys,
+            "label": labels,
+        }
+    )
+    scores = ScoreTable(diff.scores.astype(np.int64)).to_dataframe()
+    return pd.concat([columns, scores], axis=1)[DIFF_DATAFRAME_COLUMNS]
@@ -0,0 +1,132 @@
+#  Copyright (c) 2024. HealthSage AI.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Validation of FHIR resources against the in-scope fhir.resources models
+"""
+from concurrent.futures import Executor
+from typing import Dict, List
+from pydantic.v1 import ValidationError
+from pydantic.v1.main import ModelMetaclass
+from healthsageai.note_to_fhir.evaluation.datamodels import ValidationIssue, ValidationResult
+from healthsageai.note_to_fhir.evaluation.fhirmodels import object_mapping
+
+
+class ResourceValidator(object):
+    def __init__(self, mapping: Dict[str, ModelMetaclass] = None) -> None:
+        """Validates FHIR dicts directly with the parse_obj of their fhir.resources class, so they are not
+        serialized to json and parsed again. The class of each resource type is resolved once and cached.
+
+        Args:
+            mapping (Dict[str, ModelMetaclass], optional): resource type to fhir.resources class.
+                Defaults to fhirmodels.object_mapping.
+        """
+        self.mapping = object_mapping if mapping is None else mapping
+        self._validators: Dict[str, ModelMetaclass] = {}
+
+    def validator(self, resource_type: str) -> ModelMetaclass:
+        """Get the fhir.resources class that validates a resource type
+
+        Args:
+            resource_type (str): The resource type, e.g. "Patient" or "HumanName"
+
+        Returns:
+            ModelMetaclass: the class, or None if the resource type is not in scope
+        """
+        validator = self._validators.get(resource_type)
+        if validator is None:
+            validator = self.mapping.get(resource_type)
+            if validator is not None:
+                self._validators[resource_type] = validator
+        return validator
+
+    def validate(self, resource: dict, resource_type: str = None) -> ValidationResult:
+        """Validate a FHIR resource or element
+
+        Args:
+            resource (dict): A dictionary representing a FHIR R4B resource or element
+            resource_type (str, optional): The resource type or fhir type. Defaults to resource["resourceType"].
+
+        Returns:
+            ValidationResult: whether the resource is valid and the location of each error
+        """
+        return self.parse(resource, resource_type)[1]
+
+    def parse(self, resource: dict, resource_type: str = None) -> tuple:
+        """Validate a FHIR resource or element and keep the parsed model, see validate
+
+        Returns:
+            tuple: the fhir.resources model, None if invalid, and the ValidationResult
+        """
+        if resource_type is None:
+            resource_type = resource.get("resourceType") if isinstance(resource, dict) else None
+            if resource_type is None:
+                return None, _invalid(None, ("resourceType",), "resourceType unspecified", "value_error.missing")
+        validator = self.validator(resource_type)
+        if validator is None:
+            return None, _invalid(
+                resource_type, ("resourceType",), f"Resource type {resource_type} is not in scope", "value_error.scope"
+            )
+        try:
+            model = validator.parse_obj(resource)
+        except ValidationError as e:
+            errors = [
+                ValidationIssue(loc=error["loc"], msg=error["msg"], type=error["type"])
+                for error in e.errors()
+            ]
+            return None, ValidationResult(resource_type=resource_type, is_valid=False, errors=errors)
+        except Exception as e:
+            return None, _invalid(resource_type, (), str(e), type(e).__name__)
+        return model, ValidationResult(resource_type=resource_type, is_valid=True)
+
+    def is_valid(self, resource: dict, resource_type: str = None) -> bool:
+        """Checks whether a FHIR resource or element is valid, see validate"""
+        return self.validate(resource, resource_type).is_valid
+
+    def validate_entries(self, bundle: dict, executor: Executor = None) -> List[ValidationResult]:
+        """Validate the resources of the entries of a Bundle separately, e.g. to find the invalid entries.
+
+        Validation is CPU-bound, so pass a ProcessPoolExecutor to validate large bundles in parallel. Error
+        locations are relative to the resource of the entry.
+
+        Args:
+            bundle (dict): A dictionary representing a FHIR R4B Bundle
+            executor (Executor, optional): executor to validate the entries with. Defaults to validating in the
+                current thread.
+
+        Returns:
+            List[ValidationResult]: result per entry, in order
+        """
+        resources = [
+            entry.get("resource") if isinstance(entry, dict) else entry for entry in bundle.get("entry") or []
+        ]
+        if executor is None:
+            return [self.validate(resource) for resource in resources]
+        return list(executor.map(self.validate, resources))
+
+    def clear(self) -> None:
+        """Drop the cached validators"""
+        self._validators.clear()
+
+
+def _invalid(resource_type: str, loc: tuple, msg: str, error_type: str) -> ValidationResult:
+    return ValidationResult(
+        resource_type=resource_type,
+        is_valid=False,
+        errors=[ValidationIssue(loc=loc, msg=msg, type=error_type)],
+    )
+
+
+# Process-wide validator
+resource_validator = ResourceValidator()
@@ -1,6 +1,7 @@
 import plotly.graph_objects as go
 from collections import defaultdict
 from healthsageai.note_to_fhir.evaluation.datamodels import FhirDiff
+from healthsageai.note_to_fhir.evaluation.utils import iter_diff_nodes
 import pprint
 
 
@@ -43,32 +44,11 @@ def preprocess_for_treemap(diff: FhirDiff):
             - values or the content of the treemap
     """
 
-    # Current Node
-    labels = [diff.label]
-    parents = [diff.parent.label] if diff.parent else [""]
-    values = [diff]
-
-    if not diff.children:
-        return labels, parents, values
-
-    for child_comparison in diff.children.values():
-        if isinstance(child_comparison, list):
-            for child_comparison_item in child_comparison:
-                new_labels, new_parents, new_values = preprocess_for_treemap(
-                    child_comparison_item
-                )
-                labels = labels + new_labels
-                parents = parents + new_parents
-                values = values + new_values
-
-        else:
-            new_labels, new_parents, new_values = preprocess_for_treemap(
-                child_comparison
-            )
-            labels = labels + new_labels
-            parents = parents + new_parents
-            values = values + new_values
-
+    labels, parents, values = [], [], []
+    for node in iter_diff_nodes(diff):
+        labels.append(node.label)
+        parents.append(node.parent.label if node.parent else "")
+        values.append(node)
     return labels, parents, values
 
 
@@ -1 +1,24 @@
-from healthsageai.note_to_fhir.inference.note_to_fhir import NoteToFhir13b, NoteToFhir8x7b  # noqa: F401
\ No newline at end of file
+from healthsageai.note_to_fhir.inference.config import InferenceConfig  # noqa: F401
+
+# The models import transformers and torch, so they are imported on first access
+_LAZY_ATTRIBUTES = {
+    "NoteToFhir": "healthsageai.note_to_fhir.inference.note_to_fhir",
+    "NoteToFhir13b": "healthsageai.note_to_fhir.inference.note_to_fhir",
+    "NoteToFhir8x7b": "healthsageai.note_to_fhir.inference.note_to_fhir",
+}
+
+__all__ = ["InferenceConfig", "NoteToFhir", "NoteToFhir13b", "NoteToFhir8x7b"]
+
+
+def __getattr__(name: str):
+    if name in _LAZY_ATTRIBUTES:
+        import importlib
+
+        value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,273 @@
+#  Copyright (c) 2024. HealthSage AI.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Splitting of long notes into chunks that fit the prompt, and merging of the FHIR translated from the chunks
+"""
+import copy
+import re
+from typing import Callable, Dict, Iterable, List, Union
+from healthsageai.note_to_fhir.traversal import rebuild_dict
+
+# Lines that start a section: "MEDICATION", "Past medical history:" or "HISTORY OF PRESENT ILLNESS: The patient ..."
+_SECTION_HEADING = re.compile(r"^(?:[A-Z][A-Z0-9 /&(),-]{2,}:.*|[A-Z][A-Z0-9 /&(),-]{2,}|[^:]{1,60}:)$")
+_SENTENCE_END = re.compile(r"(?<=[.!?;])\s+")
+
+DEDUPLICATED_RESOURCE_TYPES = ("Patient", "Encounter")
+_CONFLICT = object()
+
+
+def split_note(note: str, max_tokens: int, count_tokens: Callable[[str], int]) -> List[str]:
+    """Split a note into chunks of at most max_tokens tokens.
+
+    Notes are split at section and paragraph boundaries first. Paragraphs that are too long are split at line
+    breaks, then at sentence ends, then between words. Consecutive parts are packed into chunks greedily.
+    A single word longer than max_tokens becomes a chunk of its own.
+
+    Args:
+        note (str): clinical note
+        max_tokens (int): token budget per chunk
+        count_tokens (Callable[[str], int]): number of tokens of a text
+
+    Returns:
+        List[str]: chunks in note order, [note] if the note fits
+    """
+    return _split(note.strip(), max_tokens, count_tokens, 0) if note.strip() else [note]
+
+
+def _paragraphs(text: str) -> List[str]:
+    paragraphs = [[]]
+    for line in text.split("\n"):
+        if not line.strip() or _SECTION_HEADING.match(line.strip()):
+            paragraphs.append([])
+        if line.strip():
+            paragraphs[-1].append(line)
+    return ["\n".join(lines) for lines in paragraphs if lines]
+
+
+def _lines(text: str) -> List[str]:
+    return [line for line in text.split("\n") if line.strip()]
+
+
+def _sentences(text: str) -> List[str]:
+    return [sentence for sentence in _SENTENCE_END.split(text) if sentence]
+
+
+def _words(text: str) -> List[str]:
+    return text.split()
+
+
+# (split, separator to join the parts of a chunk) per level, from coarse to fine
+_SPLITTERS = [(_paragraphs, "\n\n"), (_lines, "\n"), (_sentences, " "), (_words, " ")]
+
+
+def _split(text: str, max_tokens: int, count_tokens: Callable[[str], int], level: int) -> List[str]:
+    if level == len(_SPLITTERS) or count_tokens(text) <= max_tokens:
+        return [text]
+    split, separator = _SPLITTERS[level]
+    n_separator = count_tokens(separator)
+    chunks = []
+    parts = []  # parts of the current chunk
+    n_tokens = 0  # running count of the current chunk
+    is_counted = True  # whether n_tokens is the count of the chunk as a whole, rather than an estimate
+    for part in split(text):
+        n_part = count_tokens(part)
+        # Parts that are too long are split further, and their pieces are packed with the neighbouring parts
+        pieces = [part] if n_part <= max_tokens else _split(part, max_tokens, count_tokens, level + 1)
+        for piece in pieces:
+            n_piece = n_part if piece is part else count_tokens(piece)
+            # The sum of the counts is an estimate, as tokens can merge across the separator. The chunk is only
+            # counted as a whole when the estimate no longer fits, so it is not re-tokenized for every piece.
+            n_joined, is_joined_counted = n_tokens + n_separator + n_piece, False
+            if parts and n_joined > max_tokens:
+                n_joined, is_joined_counted = count_tokens(separator.join(parts + [piece])), True
+                if n_joined > max_tokens:
+                    chunks.extend(_join(parts, separator, max_tokens, count_tokens, is_counted))
+                    parts = []
+            if not parts:
+                n_joined, is_joined_counted = n_piece, True
+            parts.append(piece)
+            n_tokens, is_counted = n_joined, is_joined_counted
+    if parts:
+        chunks.extend(_join(parts, separator, max_tokens, count_tokens, is_counted))
+    return chunks
+
+
+def _join(
+    parts: List[str], separator: str, max_tokens: int, count_tokens: Callable[[str], int], is_counted: bool
+) -> List[str]:
+    """Join the parts of a chunk. Unless the chunk was already counted as a whole, it is counted before it is
+    emitted, and if the running count underestimated it, the parts are packed again counting each candidate chunk."""
+    chunk = separator.join(parts)
+    if is_counted or count_tokens(chunk) <= max_tokens:
+        return [chunk]
+    chunks = []
+    packed = []
+    for part in parts:
+        if packed and count_tokens(separator.join(packed + [part])) > max_tokens:
+            chunks.append(separator.join(packed))
+            packed = []
+        packed.append(part)
+    chunks.append(separator.join(packed))
+    return chunks
+
+
+def merge_bundles(
+    results: Iterable[Union[dict, list]],
+    deduplicated_types: Iterable[str] = DEDUPLICATED_RESOURCE_TYPES,
+) -> dict:
+    """Merge the FHIR translated from the chunks of a note into one collection Bundle.
+
+    Resources get a new id when their id was already used by an earlier chunk, and the references within their
+    chunk are rewritten to match. Resources of the deduplicated types are merged into an earlier resource of the
+    same type when their elements do not conflict, e.g. the Patient that each chunk describes, and references to
+    them are rewritten to the resource they were merged into. Lists of merged resources are combined.
+
+    Args:
+        results (Iterable[Union[dict, list]]): FHIR per chunk, in note order: a Bundle, a single resource or a
+            list of resources
+        deduplicated_types (Iterable[str], optional): resource types to merge, in the order they are merged.
+            Defaults to Patient and Encounter.
+
+    Returns:
+        dict: collection Bundle with the resources of all chunks
+    """
+    deduplicated_types = list(deduplicated_types)
+    entries = []  # merged entries
+    used_ids: Dict[str, set] = {}  # resource type : ids in entries
+    for result in results:
+        chunk_entries = [copy.deepcopy(entry) for entry in _entries(result)]
+
+        # Give resources with an id that is already used a new id
+        references = {}  # old reference : new reference
+        for entry in chunk_entries:
+            resource = entry["resource"]
+            resource_type, resource_id = resource.get("resourceType"), resource.get("id")
+            if resource_id is None:
+                continue
+            ids = used_ids.setdefault(resource_type, set())
+            new_id = str(resource_id)
+            n = 1
+            while new_id in ids:
+                n += 1
+                new_id = f"{resource_id}-{n}"
+            ids.add(new_id)
+            if new_id != str(resource_id):
+                resource["id"] = new_id
+                references[f"{resource_type}/{resource_id}"] = f"{resource_type}/{new_id}"
+        chunk_entries = [_rewrite_references(entry, references) for entry in chunk_entries]
+
+        # Merge resources of the deduplicated types into earlier resources, Patients before Encounters so
+        # Encounters of the same Patient refer to the same merged Patient when they are compared
+        merged_references = {}  # reference of a merged resource : reference of the resource it was merged into
+        kept_entries = [None] * len(chunk_entries)  # None for merged entries
+        order = sorted(range(len(chunk_entries)), key=lambda i: _merge_order(chunk_entries[i], deduplicated_types))
+        for i in order:
+            entry = chunk_entries[i]
+            resource_type = entry["resource"].get("resourceType")
+            if resource_type not in deduplicated_types:
+                kept_entries[i] = entry
+                continue
+            entry = _rewrite_references(entry, merged_references)
+            for other in entries + [kept for kept in kept_entries if kept is not None]:
+                if other["resource"].get("resourceType") != resource_type:
+                    continue
+                merged = _merge_resources(other["resource"], entry["resource"])
+                if merged is _CONFLICT:
+                    continue
+                other["resource"] = merged
+                for reference in _reference_keys(entry):
+                    merged_references[reference] = _reference(other)
+                break
+            else:
+                kept_entries[i] = entry
+        entries.extend(
+            _rewrite_references(entry, merged_references) for entry in kept_entries if entry is not None
+        )
+    return {"resourceType": "Bundle", "type": "collection", "entry": entries}
+
+
+def _entries(result: Union[dict, list]) -> List[dict]:
+    """Bundle entries of a translation result"""
+    if isinstance(result, list):
+        return [{"resource": resource} for resource in result if isinstance(resource, dict)]
+    if not isinstance(result, dict):
+        return []
+    if result.get("resourceType") != "Bundle":
+        return [{"resource": result}]
+    entries = result.get("entry") or []
+    return [entry for entry in entries if isinstance(entry, dict) and isinstance(entry.get("resource"), dict)]
+
+
+def _merge_order(entry: dict, deduplicated_types: List[str]) -> int:
+    resource_type = entry["resource"].get("resourceType")
+    return deduplicated_types.index(resource_type) if resource_type in deduplicated_types else len(deduplicated_types)
+
+
+def _reference(entry: dict) -> str:
+    """Reference to the resource of an entry"""
+    resource = entry["resource"]
+    if resource.get("id") is None and entry.get("fullUrl"):
+        return entry["fullUrl"]
+    return f"{resource.get('resourceType')}/{resource.get('id')}"
+
+
+def _reference_keys(entry: dict) -> List[str]:
+    """References that may refer to the resource of an entry"""
+    resource = entry["resource"]
+    keys = [entry["fullUrl"]] if entry.get("fullUrl") else []
+    if resource.get("id") is not None:
+        keys.append(f"{resource.get('resourceType')}/{resource['id']}")
+    return keys
+
+
+def _merge_resources(resource: dict, other: dict):
+    """Merge other into resource, keeping the id of resource. Returns _CONFLICT if they have different values."""
+    return _merge(resource, {key: value for key, value in other.items() if key != "id"})
+
+
+def _merge(value, other):
+    if isinstance(value, dict) and isinstance(other, dict):
+        merged = dict(value)
+        for key, other_value in other.items():
+            if key not in merged:
+                merged[key] = other_value
+                continue
+            merged_value = _merge(merged[key], other_value)
+            if merged_value is _CONFLICT:
+                return _CONFLICT
+            merged[key] = merged_value
+        return merged
+    if isinstance(value, list) and isinstance(other, list):
+        return value + [item for item in other if item not in value]
+    return value if value == other else _CONFLICT
+
+
+def _rewrite_references(entry: dict, references: Dict[str, str]) -> dict:
+    """Copy of an entry with the references in the mapping replaced"""
+    if not references:
+        return entry
+
+    def rewrite_node(d, dd, copy):
+        for k, v in d.items():
+            if isinstance(v, dict):
+                dd[k] = copy(v)
+            elif isinstance(v, list):
+                dd[k] = [copy(vv) if isinstance(vv, dict) else vv for vv in v]
+            elif k == "reference" and isinstance(v, str):
+                dd[k] = references.get(v, v)
+            else:
+                dd[k] = v
+
+    return rebuild_dict(entry, rewrite_node)
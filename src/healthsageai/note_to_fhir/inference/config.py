@@ -0,0 +1,46 @@
+#  Copyright (c) 2024. HealthSage AI.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pydantic import BaseModel
+from typing import Optional
+
+
+class InferenceConfig(BaseModel):
+    use_cache: bool = True  # Reuse the attention key/values of previous tokens during generation
+    do_sample: bool = False  # Greedy decoding by default, for deterministic output
+    temperature: Optional[float] = None  # Only used when sampling
+    top_p: Optional[float] = None  # Only used when sampling
+    max_new_tokens: int = 3072  # Maximum number of generated tokens, excluding the prompt
+    max_length: int = 4096  # Context window: prompt plus generated tokens, caps max_new_tokens and note chunks
+    stop_on_code_fence: bool = True  # Stop generating once the FHIR JSON code block is closed
+    stop_on_json_close: bool = False  # Stop generating once the JSON brackets in the code block are balanced
+
+    def generation_kwargs(self) -> dict:
+        """Keyword arguments for the transformers text-generation pipeline
+
+        Returns:
+            dict: generation arguments
+        """
+        kwargs = {
+            "use_cache": self.use_cache,
+            "do_sample": self.do_sample,
+            "max_new_tokens": self.max_new_tokens,
+        }
+        if self.do_sample:
+            if self.temperature is not None:
+                kwargs["temperature"] = self.temperature
+            if self.top_p is not None:
+                kwargs["top_p"] = self.top_p
+        return kwargs
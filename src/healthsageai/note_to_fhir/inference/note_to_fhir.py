@@ -13,58 +13,68 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from transformers import (
-    BitsAndBytesConfig,
-    AutoModelForCausalLM,
-    AutoTokenizer,
-    pipeline,
+import copy
+from threading import Event, Thread
+from typing import Iterable, Iterator, List, Optional, Union
+from healthsageai.note_to_fhir.data_utils import (
+    FhirNormalizer,
+    DropNones,
+    DropSnomedLoincCodes,
 )
-import torch
-from healthsageai.note_to_fhir.data_utils import drop_snomed_loinc, drop_nones
 from healthsageai.note_to_fhir.templates.simple import template_dict
-from healthsageai.note_to_fhir.parsers import parse_note_to_fhir
+from healthsageai.note_to_fhir.parsers import parse_note_to_fhir, StreamingFhirParser
+from healthsageai.note_to_fhir.inference.chunking import merge_bundles, split_note
+from healthsageai.note_to_fhir.inference.config import InferenceConfig
+from healthsageai.note_to_fhir.inference.registry import ModelRegistry, model_registry
+from healthsageai.note_to_fhir.inference.result_cache import ResultCache, result_key
+
+# transformers, torch and the stopping criteria (which subclass a transformers class) are imported where they are
+# used, so importing this module does not load them
 
 
 class NoteToFhir(object):
-    def __init__(self, model_name: str, adapter_name: str, template_style: str) -> None:
+    def __init__(
+        self,
+        model_name: str,
+        adapter_name: str,
+        template_style: str,
+        inference_config: InferenceConfig = None,
+        registry: ModelRegistry = None,
+        result_cache: ResultCache = None,
+    ) -> None:
         """_summary_
 
         Args:
             model_name (str or os.PathLike): The base model
             adapter_name (str or os.PathLike): The Q-LoRA adapter
             template_style (str): "gpt", "llama" or "mixtral"
+            inference_config (InferenceConfig, optional): decoding settings. Defaults to greedy decoding with KV cache.
+            registry (ModelRegistry, optional): where the model is loaded from, so instances share the weights of
+                their base model. Defaults to the process-wide model_registry.
+            result_cache (ResultCache, optional): cache of the FHIR of translated notes, keyed by the normalized note,
+                the model and the decoding settings, see result_cache.py. Not used when sampling, as every call
+                should draw a new sample. Defaults to no cache.
         """
+        self.template_style = template_style
         self.template = template_dict[template_style]
-        bnb_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.float16,
-        )
-
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            trust_remote_code=True,
-            quantization_config=bnb_config,
-            device_map="auto",
-        )
+        self.inference_config = inference_config or InferenceConfig()
+        self.normalizer = FhirNormalizer([DropNones(), DropSnomedLoincCodes()])
+        self.registry = model_registry if registry is None else registry
+        self.model_name = model_name
+        self.adapter_name = adapter_name
+        self.result_cache = result_cache
 
-        model.config.use_cache = False
-        model.load_adapter(adapter_name)
+        from transformers import pipeline
 
-        tokenizer = AutoTokenizer.from_pretrained(
-            model_name, trust_remote_code=True, return_tensor="pt", padding=True
-        )
-        tokenizer.pad_token = tokenizer.bos_token
-        tokenizer.padding_side = "left"
+        model, tokenizer = self.registry.load(model_name, adapter_name)
+        self.tokenizer = tokenizer
 
         self.generator = pipeline(
             model=model,
             tokenizer=tokenizer,
             task="text-generation",
-            do_sample=True,
             eos_token_id=model.config.eos_token_id,
-            max_length=4096,
+            **self.inference_config.generation_kwargs(),
         )
 
     def translate(self, note: str) -> dict:
@@ -73,27 +83,311 @@ class NoteToFhir(object):
         Args:
             note (str): clinical note
         """
+        key = self._result_key(note)
+        if key is not None:
+            fhir = self.result_cache.get(key)
+            if fhir is not None:
+                return fhir
         prompt = self.template.format(note=note)
-        generated_output = self.generator(prompt)
-        fhir = parse_note_to_fhir(generated_output[0]["generated_text"])
-        fhir = drop_nones(fhir)
-        fhir = drop_snomed_loinc(fhir)
+        with self._use_adapter():
+            generated_output = self.generator(prompt, **self._call_kwargs([prompt]))
+        fhir = self._postprocess(generated_output[0]["generated_text"])
+        if key is not None:
+            self.result_cache.put(key, fhir)
         return fhir
 
+    def translate_chunked(self, note: str, batch_size: int = 8) -> dict:
+        """Convert a long note to FHIR in chunks that fit the prompt.
+
+        The note is split at section and paragraph boundaries into chunks that leave room for max_new_tokens
+        generated tokens within max_length, see InferenceConfig. The chunks are translated in batches and their
+        FHIR is merged into one Bundle, with one Patient and Encounter where the chunks agree, see merge_bundles.
+        A note that fits is translated as a whole.
+
+        Args:
+            note (str): clinical note
+            batch_size (int, optional): number of chunks per generation batch. Defaults to 8.
+
+        Raises:
+            Exception: the exception raised for the first chunk that failed
+
+        Returns:
+            dict: FHIR
+        """
+        chunks = self.split_note(note)
+        if len(chunks) == 1:
+            return self.translate(note)
+        results = self.translate_batch(chunks, batch_size=batch_size)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return merge_bundles(results)
+
+    def split_note(self, note: str) -> List[str]:
+        """Split a note into chunks whose prompts fit the token budget, see translate_chunked
+
+        Args:
+            note (str): clinical note
+
+        Returns:
+            List[str]: chunks in note order
+        """
+        config = self.inference_config
+        template_tokens = len(self.tokenizer(self.template.format(note=""))["input_ids"])
+        max_tokens = config.max_length - config.max_new_tokens - template_tokens
+        if max_tokens <= 0:
+            raise ValueError(
+                f"No room for the note: the template takes {template_tokens} tokens and max_new_tokens is "
+                f"{config.max_new_tokens}, of max_length {config.max_length}"
+            )
+        return split_note(note, max_tokens, self._count_tokens)
+
+    def translate_incremental(self, note: str) -> Iterator[dict]:
+        """Convert a note to FHIR, yielding each resource as soon as it has been generated
+
+        The result cache is not used, the resources are parsed while the note is generated. Generation runs on a
+        separate thread. When the caller stops iterating early, generation is stopped at the next token. Malformed
+        JSON ends the resources at the object that could not be parsed, see StreamingFhirParser.
+
+        Args:
+            note (str): clinical note
+
+        Raises:
+            Exception: the exception raised while generating, after the resources generated before it
+
+        Yields:
+            dict: FHIR resource, e.g. the resource of each Bundle entry
+        """
+        from transformers import TextIteratorStreamer
+
+        prompt = self.template.format(note=note)
+        streamer = TextIteratorStreamer(
+            self.tokenizer, skip_prompt=True, skip_special_tokens=True
+        )
+        cancelled = Event()
+        errors = []
+
+        def generate():
+            # The adapter is only held while generating, not while the caller handles the yielded resources
+            try:
+                with self._use_adapter():
+                    self.generator(prompt, streamer=streamer, **self._call_kwargs([prompt], cancelled))
+            except Exception as e:
+                errors.append(e)
+                streamer.end()  # ends the iteration over the streamer below
+
+        thread = Thread(target=generate, daemon=True)
+        thread.start()
+        try:
+            parser = StreamingFhirParser()
+            for text in streamer:
+                for resource in parser.feed(text):
+                    yield self.normalizer(resource)
+        finally:
+            cancelled.set()
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def translate_batch(
+        self, notes: List[str], batch_size: int = 8
+    ) -> List[Union[dict, Exception]]:
+        """Convert a list of notes to FHIR, generating in batches
+
+        Args:
+            notes (List[str]): clinical notes
+            batch_size (int, optional): number of prompts per generation batch. Defaults to 8.
+
+        Returns:
+            List[Union[dict, Exception]]: FHIR per note, in input order. Notes that failed are returned as the
+                exception raised for that note.
+        """
+        return list(self.translate_stream(notes, batch_size=batch_size))
+
+    def translate_stream(
+        self, notes: Iterable[str], batch_size: int = 8, window_size: int = None
+    ) -> Iterator[Union[dict, Exception]]:
+        """Lazily convert a stream of notes to FHIR.
+
+        Notes are read in windows of window_size notes. Within a window, prompts are sorted by token length
+        and generated in batches, so each batch needs little padding.
+
+        Args:
+            notes (Iterable[str]): clinical notes
+            batch_size (int, optional): number of prompts per generation batch. Defaults to 8.
+            window_size (int, optional): number of notes sorted together. Defaults to 8 * batch_size.
+
+        Yields:
+            Union[dict, Exception]: FHIR per note, in input order. Notes that failed yield the exception
+                raised for that note.
+        """
+        window_size = window_size or 8 * batch_size
+        window = []
+        for note in notes:
+            window.append(note)
+            if len(window) >= window_size:
+                yield from self._translate_window(window, batch_size)
+                window = []
+        if window:
+            yield from self._translate_window(window, batch_size)
+
+    def _translate_window(
+        self, notes: List[str], batch_size: int
+    ) -> List[Union[dict, Exception]]:
+        results = [None] * len(notes)
+        keys = [self._result_key(note) for note in notes]
+        todo = []  # idxs of the notes to generate
+        duplicates = {}  # idx of a note : idx of the same note that is generated
+        first_idxs = {}  # key : idx of the first note with the key
+        for i, key in enumerate(keys):
+            if key is None:
+                todo.append(i)
+            elif key in first_idxs:
+                duplicates[i] = first_idxs[key]
+            else:
+                first_idxs[key] = i
+                results[i] = self.result_cache.get(key)
+                if results[i] is None:
+                    todo.append(i)
+
+        prompts = {i: self.template.format(note=notes[i]) for i in todo}
+        prompt_lengths = {i: len(self.tokenizer(prompt)["input_ids"]) for i, prompt in prompts.items()}
+        order = sorted(todo, key=lambda i: prompt_lengths[i])
+
+        for start in range(0, len(order), batch_size):
+            batch_idxs = order[start : start + batch_size]
+            for i, generated_text in zip(
+                batch_idxs, self._generate_batch([prompts[i] for i in batch_idxs])
+            ):
+                if isinstance(generated_text, Exception):
+                    results[i] = generated_text
+                    continue
+                try:
+                    results[i] = self._postprocess(generated_text)
+                except Exception as e:
+                    results[i] = e
+                    continue
+                if keys[i] is not None:
+                    self.result_cache.put(keys[i], results[i])
+
+        for i, first_idx in duplicates.items():
+            result = results[first_idx]
+            results[i] = result if isinstance(result, Exception) else copy.deepcopy(result)
+        return results
+
+    def _generate_batch(self, prompts: List[str]) -> List[Union[str, Exception]]:
+        """Generate a batch of prompts. If the batch fails, retry per prompt to isolate the failing prompt(s)."""
+        with self._use_adapter():
+            return self._generate_batch_with_retry(prompts)
+
+    def _generate_batch_with_retry(self, prompts: List[str]) -> List[Union[str, Exception]]:
+        try:
+            outputs = self.generator(
+                prompts, batch_size=len(prompts), **self._call_kwargs(prompts)
+            )
+            return [output[0]["generated_text"] for output in outputs]
+        except Exception as e:
+            if len(prompts) == 1:
+                return [e]
+        generated_texts = []
+        for prompt in prompts:
+            try:
+                generated_output = self.generator(prompt, **self._call_kwargs([prompt]))
+                generated_texts.append(generated_output[0]["generated_text"])
+            except Exception as e:
+                generated_texts.append(e)
+        return generated_texts
+
+    def _count_tokens(self, text: str) -> int:
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def _result_key(self, note: str) -> Optional[str]:
+        """Key of the note in the result cache, None without a result cache or when sampling"""
+        if self.result_cache is None or self.inference_config.do_sample:
+            return None
+        return result_key(
+            note, self.template_style, self.model_name, self.adapter_name, self.inference_config
+        )
+
+    def _use_adapter(self):
+        """Activate the adapter of this instance on the shared base model, see ModelRegistry.use_adapter"""
+        return self.registry.use_adapter(self.model_name, self.adapter_name)
+
+    def _call_kwargs(self, prompts: List[str], cancelled: Event = None) -> dict:
+        """Per-call generation arguments. Stopping criteria keep state, so they are created for every call.
+
+        max_new_tokens is clamped so the longest prompt plus the generated tokens fit in max_length.
+
+        Args:
+            prompts (List[str]): prompts of the call
+            cancelled (Event, optional): stop generating once set. Defaults to generating until done.
+
+        Raises:
+            ValueError: if a prompt leaves no room to generate within max_length
+        """
+        config = self.inference_config
+        prompt_tokens = max(len(self.tokenizer(prompt)["input_ids"]) for prompt in prompts)
+        if prompt_tokens >= config.max_length:
+            raise ValueError(
+                f"The prompt takes {prompt_tokens} tokens, no room to generate within max_length {config.max_length}"
+            )
+        kwargs = {"max_new_tokens": min(config.max_new_tokens, config.max_length - prompt_tokens)}
+        stopping_criteria = []
+        if config.stop_on_code_fence or config.stop_on_json_close:
+            from healthsageai.note_to_fhir.inference.stopping import CodeFenceStoppingCriteria
+
+            stopping_criteria.append(
+                CodeFenceStoppingCriteria(
+                    self.tokenizer,
+                    stop_on_code_fence=config.stop_on_code_fence,
+                    stop_on_json_close=config.stop_on_json_close,
+                )
+            )
+        if cancelled is not None:
+            from healthsageai.note_to_fhir.inference.stopping import CancelledStoppingCriteria
+
+            stopping_criteria.append(CancelledStoppingCriteria(cancelled))
+        if stopping_criteria:
+            from transformers import StoppingCriteriaList
+
+            kwargs["stopping_criteria"] = StoppingCriteriaList(stopping_criteria)
+        return kwargs
+
+    def _postprocess(self, generated_text: str) -> dict:
+        """Parse the FHIR from the generated text and clean it up"""
+        fhir = parse_note_to_fhir(generated_text)
+        return self.normalizer(fhir)
+
 
 class NoteToFhir13b(NoteToFhir):
-    def __init__(self):
+    def __init__(
+        self,
+        inference_config: InferenceConfig = None,
+        registry: ModelRegistry = None,
+        result_cache: ResultCache = None,
+    ):
         super().__init__(
             model_name="meta-llama/Llama-2-13b-chat-hf",
             adapter_name="healthsageai/note-to-fhir-13b-adapter",
             template_style="llama",
+            inference_config=inference_config,
+            registry=registry,
+            result_cache=result_cache,
         )
 
 
 class NoteToFhir8x7b(NoteToFhir):
-    def __init__(self):
+    def __init__(
+        self,
+        inference_config: InferenceConfig = None,
+        registry: ModelRegistry = None,
+        result_cache: ResultCache = None,
+    ):
         super().__init__(
             model_name="mistralai/Mixtral-8x7B-Instruct-v0.1",
             adapter_name="healthsageai/note-to-fhir-8x7b-adapter",
             template_style="mixtral",
+            inference_config=inference_config,
+            registry=registry,
+            result_cache=result_cache,
         )
@@ -0,0 +1,199 @@
+#  Copyright (c) 2024. HealthSage AI.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Process-wide cache of loaded base models and their adapters, with an optional on-disk cache of the quantized models
+"""
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Set
+
+
+class ModelRegistry(object):
+    def __init__(
+        self,
+        cache_dir: str = None,
+        quantize: bool = True,
+        device_map: Optional[str] = "auto",
+    ) -> None:
+        """Keeps loaded base models in memory by name, so NoteToFhir instances of the same base model share its weights.
+
+        Adapters are loaded onto the shared base model once, by name, and switched with use_adapter instead of
+        loading the base model again. With a cache_dir, a base model is saved there when it is first loaded, already
+        quantized and before any adapter is added, and later loaded from there, so a restarted process skips the
+        download and quantization.
+
+        Args:
+            cache_dir (str, optional): directory for the quantized base models. Defaults to no on-disk cache.
+            quantize (bool, optional): load base models in 4 bit, which needs a CUDA device. Defaults to True.
+            device_map (str, optional): device map for from_pretrained, None to load on the CPU. Defaults to "auto".
+        """
+        self.cache_dir = cache_dir
+        self.quantize = quantize
+        self.device_map = device_map
+        self._models: Dict[str, tuple] = {}  # model name : (model, tokenizer)
+        self._adapters: Dict[str, Set[str]] = {}  # model name : names of the loaded adapters
+        self._locks: Dict[str, threading.RLock] = {}  # model name : lock for loading it and switching its adapter
+        self._lock = threading.Lock()  # guards the dicts and statistics, never held while loading
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+    def load(self, model_name: str, adapter_name: str = None) -> tuple:
+        """Get a base model and its tokenizer, loading them on first use, and load the adapter onto the model.
+
+        Use use_adapter to activate the adapter before generating, as other adapters may share the model. A model is
+        loaded under its own lock, which use_adapter holds as well, so loading one model does not block another.
+
+        Args:
+            model_name (str or os.PathLike): The base model
+            adapter_name (str or os.PathLike, optional): The Q-LoRA adapter. Defaults to no adapter.
+
+        Returns:
+            tuple: model and tokenizer
+        """
+        with self._lock:
+            model_lock = self._locks.setdefault(model_name, threading.RLock())
+        # Only loads of the same model wait for each other, other models are loaded in parallel
+        with model_lock:
+            loaded = self._models.get(model_name)
+            if loaded is not None:
+                with self._lock:
+                    self.hits += 1
+            else:
+                with self._lock:
+                    self.misses += 1
+                loaded = self._load_base(model_name)
+                with self._lock:
+                    self._models[model_name] = loaded
+                    self._adapters[model_name] = set()
+            model, tokenizer = loaded
+            if adapter_name is not None and adapter_name not in self._adapters[model_name]:
+                model.load_adapter(adapter_name, adapter_name=_adapter_key(adapter_name))
+                self._adapters[model_name].add(adapter_name)
+        return model, tokenizer
+
+    @contextmanager
+    def use_adapter(self, model_name: str, adapter_name: str = None) -> Iterator:
+        """Activate an adapter of a loaded model for the duration of the context. Other threads wait to switch the
+        adapter of the same model until the context is left.
+
+        Args:
+            model_name (str): The base model, see load
+            adapter_name (str, optional): adapter loaded with load. Defaults to the base model without adapters.
+
+        Yields:
+            model: the model with the adapter active
+        """
+        model, _ = self._models[model_name]
+        with self._locks[model_name]:
+            if self._adapters[model_name]:
+                if adapter_name is None:
+                    model.disable_adapters()
+                else:
+                    model.enable_adapters()
+                    model.set_adapter(_adapter_key(adapter_name))
+            yield model
+
+    def cached_path(self, model_name: str) -> Optional[str]:
+        """Directory of the base model in cache_dir, None without cache_dir"""
+        if self.cache_dir is None:
+            return None
+        quantization = "4bit" if self.quantize else "full"
+        return os.path.join(self.cache_dir, f"{model_name.replace('/', '--')}--{quantization}")
+
+    def unload(self, model_name: str) -> None:
+        """Drop a base model and its adapters from memory"""
+        with self._lock:
+            self._models.pop(model_name, None)
+            self._adapters.pop(model_name, None)
+            self._locks.pop(model_name, None)
+
+    def clear(self) -> None:
+        """Drop all models from memory and reset the statistics"""
+        with self._lock:
+            self._models.clear()
+            self._adapters.clear()
+            self._locks.clear()
+            self.hits = 0
+            self.misses = 0
+            self.disk_hits = 0
+
+    def stats(self) -> dict:
+        """Cache statistics for profiling
+
+        Returns:
+            dict: number of hits, misses, loads from cache_dir, and the loaded models with their adapters
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "models": {name: sorted(adapters) for name, adapters in self._adapters.items()},
+        }
+
+    def _load_base(self, model_name: str) -> tuple:
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+
+        path = self.cached_path(model_name)
+        is_cached = path is not None and os.path.isdir(path)
+        kwargs = {"trust_remote_code": True}
+        if self.device_map is not None:
+            kwargs["device_map"] = self.device_map
+        if self.quantize and not is_cached:
+            # A cached model was saved quantized, its config holds the quantization config
+            kwargs["quantization_config"] = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.float16,
+            )
+        source = path if is_cached else model_name
+        model = AutoModelForCausalLM.from_pretrained(source, **kwargs)
+
+        tokenizer = AutoTokenizer.from_pretrained(
+            source, trust_remote_code=True, return_tensor="pt", padding=True
+        )
+        tokenizer.pad_token = tokenizer.bos_token
+        tokenizer.padding_side = "left"
+
+        if is_cached:
+            with self._lock:
+                self.disk_hits += 1
+        elif path is not None:
+            _save_base(model, tokenizer, path)
+        return model, tokenizer
+
+
+def _adapter_key(adapter_name: str) -> str:
+    """Name of an adapter in the model, which may not contain dots"""
+    return adapter_name.replace(".", "-")
+
+
+def _save_base(model, tokenizer, path: str) -> None:
+    """Save to a temporary directory first, so an interrupted save is never loaded as a cached model"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    model.save_pretrained(tmp_path)
+    tokenizer.save_pretrained(tmp_path)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:  # saved by another process in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+# Process-wide registry used by NoteToFhir. Set HEALTHSAGEAI_MODEL_CACHE to keep the quantized models on disk.
+model_registry = ModelRegistry(cache_dir=os.environ.get("HEALTHSAGEAI_MODEL_CACHE"))
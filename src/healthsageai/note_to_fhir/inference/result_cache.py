@@ -0,0 +1,214 @@
+#  Copyright (c) 2024. HealthSage AI.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Caches of translation results, keyed by the normalized note and everything else the translation depends on
+"""
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import unicodedata
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+from healthsageai.note_to_fhir.inference.config import InferenceConfig
+
+_WHITESPACE = re.compile(r"[^\S\n]+")
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+
+def normalize_note(note: str) -> str:
+    """Normalize the formatting of a note, so re-sent notes that only differ in whitespace or line endings are equal.
+
+    Args:
+        note (str): clinical note
+
+    Returns:
+        str: the note in NFC form, with "\\n" line endings, single spaces, no trailing spaces and at most one blank line
+    """
+    note = unicodedata.normalize("NFC", note).replace("\r\n", "\n").replace("\r", "\n")
+    lines = [_WHITESPACE.sub(" ", line).strip() for line in note.split("\n")]
+    return _BLANK_LINES.sub("\n\n", "\n".join(lines)).strip()
+
+
+def result_key(
+    note: str,
+    template_style: str,
+    model_name: str,
+    adapter_name: str,
+    inference_config: InferenceConfig,
+) -> str:
+    """Cache key of a translation
+
+    Args:
+        note (str): clinical note, normalized with normalize_note
+        template_style (str): "gpt", "llama" or "mixtral"
+        model_name (str): The base model
+        adapter_name (str): The Q-LoRA adapter
+        inference_config (InferenceConfig): decoding settings
+
+    Returns:
+        str: hex digest
+    """
+    parts = {
+        "note": normalize_note(note),
+        "template_style": template_style,
+        "model_name": str(model_name),
+        "adapter_name": None if adapter_name is None else str(adapter_name),
+        "inference_config": inference_config.model_dump(),
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache(ABC):
+    def __init__(self) -> None:
+        """Base class of the translation result caches. Results are stored as json, so every get returns a new dict.
+
+        Subclasses implement _get, _put, _clear and __len__. Only deterministic translations are cached: NoteToFhir
+        bypasses its cache when InferenceConfig.do_sample is set.
+        """
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        """Get a cached translation, or None on a miss
+
+        Args:
+            key (str): see result_key
+
+        Returns:
+            Optional[dict]: the post-processed FHIR
+        """
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def put(self, key: str, fhir: dict) -> None:
+        """Cache a translation
+
+        Args:
+            key (str): see result_key
+            fhir (dict): the post-processed FHIR
+        """
+        self._put(key, json.dumps(fhir))
+
+    def clear(self) -> None:
+        """Drop all cached translations and reset the statistics"""
+        self._clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        """Cache statistics for profiling
+
+        Returns:
+            dict: number of hits, misses and cached translations, and the hit rate
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self),
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Number of cached translations"""
+
+    @abstractmethod
+    def _get(self, key: str) -> Optional[str]:
+        """The json stored for key, or None"""
+
+    @abstractmethod
+    def _put(self, key: str, value: str) -> None:
+        """Store the json value for key"""
+
+    @abstractmethod
+    def _clear(self) -> None:
+        """Drop all cached translations"""
+
+
+class MemoryResultCache(ResultCache):
+    def __init__(self, maxsize: int = 10_000) -> None:
+        """In-memory least recently used cache of translations
+
+        Args:
+            maxsize (int, optional): maximum number of cached translations, unbounded if None. Defaults to 10_000.
+        """
+        super().__init__()
+        self.maxsize = maxsize
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._values.get(key)
+            if value is not None:
+                self._values.move_to_end(key)
+            return value
+
+    def _put(self, key: str, value: str) -> None:
+        with self._lock:
+            self._values[key] = value
+            self._values.move_to_end(key)
+            if self.maxsize is not None and len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+
+    def _clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+class SQLiteResultCache(ResultCache):
+    def __init__(self, path: str) -> None:
+        """On-disk cache of translations in a SQLite database, shared by processes and kept across restarts
+
+        Args:
+            path (str): path of the database file, created if it does not exist
+        """
+        super().__init__()
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, fhir TEXT NOT NULL)")
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute("SELECT fhir FROM results WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _put(self, key: str, value: str) -> None:
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO results (key, fhir) VALUES (?, ?)", (key, value))
+
+    def _clear(self) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM results")
+
+    def close(self) -> None:
+        self._connection.close()
@@ -0,0 +1,220 @@
+#  Copyright (c) 2024. HealthSage AI.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Asyncio front-end of NoteToFhir, which coalesces concurrent requests into generation batches
+"""
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+_STOP = object()  # queued by stop, after the pending requests
+
+
+class NoteToFhirServer(object):
+    def __init__(
+        self,
+        translator,
+        max_batch_size: int = 8,
+        max_wait: float = 0.01,
+        max_queue_size: int = 0,
+        n_latencies: int = 1000,
+    ) -> None:
+        """Serves translations to concurrent asyncio callers.
+
+        Requests are queued and coalesced into micro-batches: a batch is closed when it holds max_batch_size notes,
+        or max_wait seconds after its first note arrived. Batches are generated with translate_batch on a
+        dedicated worker thread, so the event loop keeps accepting requests while the model generates, and the
+        requests that arrive in the meantime form the next batch.
+
+        Use as an async context manager, or call start and stop:
+
+            async with NoteToFhirServer(NoteToFhir8x7b()) as server:
+                fhir = await server.translate(note)
+
+        Args:
+            translator (NoteToFhir): translator with a translate_batch method
+            max_batch_size (int, optional): maximum number of notes per batch. Defaults to 8.
+            max_wait (float, optional): seconds to wait for more notes before a batch is generated. Defaults to 0.01.
+            max_queue_size (int, optional): maximum number of queued requests, translate waits for room when the
+                queue is full. Defaults to 0, an unbounded queue.
+            n_latencies (int, optional): number of most recent requests the latency statistics are computed over.
+                Defaults to 1000.
+        """
+        self.translator = translator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue_size = max_queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._batcher: Optional[asyncio.Task] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._latencies = deque(maxlen=n_latencies)  # seconds from request to result
+        self._queue_waits = deque(maxlen=n_latencies)  # seconds from request to the start of its batch
+        self.n_requests = 0
+        self.n_failed = 0
+        self.n_batches = 0
+        self.n_batched = 0  # requests that were generated
+        self.max_queue_depth = 0
+
+    @property
+    def is_running(self) -> bool:
+        return self._batcher is not None
+
+    async def start(self) -> None:
+        """Start the worker thread and the task that batches the queued requests"""
+        if self.is_running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="note-to-fhir")
+        self._batcher = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        """Translate the queued requests, then stop the worker thread"""
+        if not self.is_running:
+            return
+        batcher, queue, executor = self._batcher, self._queue, self._executor
+        self._batcher = None  # new requests are refused from here
+        await queue.put(_STOP)
+        await batcher
+        executor.shutdown(wait=True)
+        self._executor = None
+        self._queue = None
+        # Requests that were still waiting for room in a full queue when stop was called
+        while not queue.empty():
+            item = queue.get_nowait()
+            if item is not _STOP and not item[1].done():
+                item[1].set_exception(RuntimeError("NoteToFhirServer stopped"))
+
+    async def __aenter__(self) -> "NoteToFhirServer":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.stop()
+
+    async def translate(self, note: str) -> dict:
+        """Convert a note to FHIR, batched with the other requests
+
+        Args:
+            note (str): clinical note
+
+        Raises:
+            RuntimeError: if the server is not running
+            Exception: the exception raised while translating the note
+
+        Returns:
+            dict: FHIR
+        """
+        if not self.is_running:
+            raise RuntimeError("NoteToFhirServer is not running, call start first")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((note, future, time.perf_counter()))
+        self.n_requests += 1
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return await future
+
+    def stats(self) -> dict:
+        """Server statistics for profiling. Latencies are in seconds, over the most recent requests.
+
+        Returns:
+            dict: number of requests, failed requests and batches, mean batch size, current and maximum queue
+                depth, mean time in the queue and the mean, median, 95th percentile and maximum latency
+        """
+        latencies = sorted(self._latencies)
+        return {
+            "requests": self.n_requests,
+            "failed": self.n_failed,
+            "batches": self.n_batches,
+            "mean_batch_size": self.n_batched / self.n_batches if self.n_batches else None,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "mean_queue_wait": _mean(self._queue_waits),
+            "mean_latency": _mean(latencies),
+            "p50_latency": _percentile(latencies, 0.5),
+            "p95_latency": _percentile(latencies, 0.95),
+            "max_latency": latencies[-1] if latencies else None,
+        }
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of requests waiting for a batch"""
+        return 0 if self._queue is None else self._queue.qsize()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                # Requests that queued up during the previous batch are added without waiting
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self._queue.get_nowait()
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._translate_batch(loop, batch)
+
+    async def _translate_batch(self, loop: asyncio.AbstractEventLoop, batch: List[tuple]) -> None:
+        # Requests cancelled by their caller while queued are not generated
+        batch = [(note, future, queued) for note, future, queued in batch if not future.done()]
+        if not batch:
+            return
+        self.n_batches += 1
+        self.n_batched += len(batch)
+        start = time.perf_counter()
+        self._queue_waits.extend(start - queued for _, _, queued in batch)
+        notes = [note for note, _, _ in batch]
+        try:
+            results = await loop.run_in_executor(
+                self._executor, lambda: self.translator.translate_batch(notes, batch_size=len(notes))
+            )
+        except Exception as e:
+            results = [e] * len(batch)
+        end = time.perf_counter()
+        for (_, future, queued), result in zip(batch, results):
+            self._latencies.append(end - queued)
+            if isinstance(result, Exception):
+                self.n_failed += 1
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+def _mean(values) -> Optional[float]:
+    return sum(values) / len(values) if values else None
+
+
+def _percentile(sorted_values: list, q: float) -> Optional[float]:
+    """Nearest-rank percentile"""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
@@ -0,0 +1,78 @@
+#  Copyright (c) 2024. HealthSage AI.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from threading import Event
+from transformers import StoppingCriteria
+import torch
+from healthsageai.note_to_fhir.parsers import CodeFenceTracker
+
+
+class CodeFenceStoppingCriteria(StoppingCriteria):
+    def __init__(
+        self,
+        tokenizer,
+        stop_on_code_fence: bool = True,
+        stop_on_json_close: bool = False,
+    ) -> None:
+        """Stops generation of a sequence once the generated text contains a closed code block, i.e. once the FHIR JSON
+        is complete. Only the newly generated tokens are decoded at each step.
+
+        Use a new instance for every generate call, the prompt length is determined at the first step.
+
+        Args:
+            tokenizer (PreTrainedTokenizer): tokenizer of the model
+            stop_on_code_fence (bool, optional): stop once the code block is closed. Defaults to True.
+            stop_on_json_close (bool, optional): also stop as soon as the JSON bracket depth in the code block returns
+                to zero. Defaults to False.
+        """
+        self.tokenizer = tokenizer
+        self.stop_on_code_fence = stop_on_code_fence
+        self.stop_on_json_close = stop_on_json_close
+        self.trackers = None
+        self.n_seen = None
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ) -> torch.BoolTensor:
+        if self.trackers is None:
+            self.trackers = [CodeFenceTracker() for _ in range(input_ids.shape[0])]
+            self.n_seen = input_ids.shape[1] - 1  # One token has been generated
+        new_tokens = input_ids[:, self.n_seen :].tolist()
+        self.n_seen = input_ids.shape[1]
+
+        is_done = []
+        for tracker, tokens in zip(self.trackers, new_tokens):
+            tracker.feed(self.tokenizer.decode(tokens, skip_special_tokens=True))
+            is_done.append(
+                (self.stop_on_code_fence and tracker.block_closed)
+                or (self.stop_on_json_close and tracker.json_closed)
+            )
+        return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
+
+
+class CancelledStoppingCriteria(StoppingCriteria):
+    def __init__(self, cancelled: Event) -> None:
+        """Stops generation of all sequences once the event is set, e.g. when the consumer of a stream of generated
+        text stops reading.
+
+        Args:
+            cancelled (Event): set to stop generating
+        """
+        self.cancelled = cancelled
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.cancelled.is_set(), dtype=torch.bool, device=input_ids.device)
@@ -15,20 +15,118 @@
 
 import json
 import re
-import marko
+from typing import List, Optional
 
 
 def extract_from_code_block(markdown):
-    parsed = marko.Parser().parse(markdown)
-    code_block = [elem for elem in parsed.children if isinstance(
-        elem, marko.block.FencedCode)]
-    if len(code_block) > 0:
-        raw_data = code_block[0].children[0].children
-        return ''.join(raw_data)
+    code = extract_fenced_code(markdown)
+    if code is not None:
+        return code
     else:
         return markdown if '\n\n' not in markdown else markdown.split('\n\n')[1]
 
 
+def extract_fenced_code(markdown: str) -> Optional[str]:
+    """Returns the content of the first fenced code block in a markdown string, in a single pass.
+
+    Follows the CommonMark rules for fences: an opening fence of at least 3 backticks or tildes indented by at most
+    3 spaces, closed by a fence of the same character that is at least as long. An unclosed block runs until the end
+    of the string. Unlike a full markdown parser, fences nested in list items are found as well.
+    Only lines containing a fence are inspected, the scan jumps between them with str.find.
+
+    Args:
+        markdown (str): markdown string, e.g. generated text
+
+    Returns:
+        Optional[str]: the code, or None if there is no fenced code block.
+    """
+    pos = 0
+    while True:
+        line_start = min(
+            _find_fence_line(markdown, "```", pos),
+            _find_fence_line(markdown, "~~~", pos),
+        )
+        if line_start == len(markdown):
+            return None
+        line_end = _line_end(markdown, line_start)
+        fence = _match_fence(markdown, line_start, line_end)
+        if not (fence[0] == "`" and "`" in markdown[line_start + fence[2] : line_end]):
+            return _read_fenced_code(markdown, line_end + 1, fence)
+        pos = line_end + 1
+
+
+def _line_end(markdown: str, pos: int) -> int:
+    line_end = markdown.find("\n", pos)
+    return len(markdown) if line_end == -1 else line_end
+
+
+def _find_fence_line(markdown: str, token: str, pos: int) -> int:
+    """Returns the start of the first line from pos that starts with token after at most 3 spaces,
+    or len(markdown) if there is none."""
+    idx = markdown.find(token, pos)
+    while idx != -1:
+        line_start = markdown.rfind("\n", pos, idx) + 1
+        line_start = max(line_start, pos)
+        if idx - line_start <= 3 and markdown[line_start:idx].strip(" ") == "":
+            return line_start
+        idx = markdown.find(token, _line_end(markdown, idx))
+    return len(markdown)
+
+
+def _match_fence(markdown: str, start: int, end: int) -> Optional[tuple]:
+    """Matches a fence at the start of a line
+
+    Returns:
+        Optional[tuple]: fence character, fence length, offset of the end of the fence and indentation, or None
+    """
+    indent = 0
+    while indent < 3 and start + indent < end and markdown[start + indent] == " ":
+        indent += 1
+    fence_start = start + indent
+    if fence_start >= end or markdown[fence_start] not in "`~":
+        return None
+    char = markdown[fence_start]
+    fence_end = fence_start
+    while fence_end < end and markdown[fence_end] == char:
+        fence_end += 1
+    if fence_end - fence_start < 3:
+        return None
+    return char, fence_end - fence_start, fence_end - start, indent
+
+
+def _read_fenced_code(markdown: str, start: int, fence: tuple) -> str:
+    """Reads the code of a fenced code block from start until its closing fence"""
+    char, length, _, indent = fence
+    pos = start
+    while pos < len(markdown):
+        line_start = _find_fence_line(markdown, char * 3, pos)
+        if line_start == len(markdown):
+            break
+        line_end = _line_end(markdown, line_start)
+        closing = _match_fence(markdown, line_start, line_end)
+        if (
+            closing[1] >= length
+            and markdown[line_start + closing[2] : line_end].strip(" \t") == ""
+        ):
+            return _dedent(markdown[start:line_start], indent)
+        pos = line_end + 1
+    return _dedent(markdown[start:], indent)
+
+
+def _dedent(code: str, indent: int) -> str:
+    """Removes up to indent columns of leading whitespace per line, like the indentation of the opening fence"""
+    if indent == 0:
+        return code
+    lines = code.split("\n")
+    for i, line in enumerate(lines):
+        width, n_chars = 0, 0
+        while width < indent and n_chars < len(line) and line[n_chars] in " \t":
+            width = width + 4 - width % 4 if line[n_chars] == "\t" else width + 1
+            n_chars += 1
+        lines[i] = line[n_chars:]
+    return "\n".join(lines)
+
+
 def parse_json_markdown(markdown_string: str) -> dict:
     json_str = extract_from_code_block(markdown_string)
 
@@ -64,3 +162,242 @@ def parse_note_to_fhir(s) -> dict:
     fhir_json = s.split("```")[3][4:].strip(" \t\n\r")
     fhir = json.loads(fhir_json)
     return fhir
+
+
+class CodeFenceTracker(object):
+    def __init__(self) -> None:
+        """Incrementally tracks markdown code fences and the JSON bracket depth inside code blocks of streamed text,
+        e.g. of text that is being generated token by token.
+        """
+        self.n_fences = 0  # number of ``` fences seen
+        self.n_backticks = 0  # consecutive backticks seen
+        self.depth = 0  # JSON bracket depth inside the current code block
+        self.in_string = False
+        self.escape = False
+        self.json_started = False
+        self.json_closed = False
+
+    @property
+    def in_code_block(self) -> bool:
+        return self.n_fences % 2 == 1
+
+    @property
+    def block_closed(self) -> bool:
+        """True once a code block has been opened and closed"""
+        return self.n_fences >= 2
+
+    def feed(self, text: str) -> None:
+        """Process the next chunk of text
+
+        Args:
+            text (str): text chunk, e.g. a decoded token
+        """
+        for char in text:
+            self._feed_char(char)
+
+    def _feed_char(self, char: str) -> None:
+        if self.in_string:
+            if self.escape:
+                self.escape = False
+            elif char == "\\":
+                self.escape = True
+            elif char == '"':
+                self.in_string = False
+            return
+
+        if char == "`":
+            self.n_backticks += 1
+            if self.n_backticks == 3:
+                self.n_fences += 1
+                self.n_backticks = 0
+                self.depth = 0
+            return
+        self.n_backticks = 0
+
+        if not self.in_code_block:
+            return
+        if char == '"':
+            self.in_string = True
+        elif char in "{[":
+            self.depth += 1
+            self.json_started = True
+        elif char in "}]":
+            self.depth -= 1
+            if self.json_started and self.depth == 0:
+                self.json_closed = True
+
+
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+class StreamingFhirParser(object):
+    def __init__(self) -> None:
+        """Incrementally parses the FHIR JSON in the first code block of generated text.
+
+        Feed the generated text chunk by chunk, e.g. token by token. Completed resources are returned as soon as
+        their closing bracket arrives: the resource of each Bundle entry, each object in a top-level array, or the
+        top-level object itself if it is not a Bundle. When the output is truncated, recover() returns the longest
+        complete prefix of the JSON with the open brackets closed.
+
+        Malformed output, e.g. mismatched brackets or a trailing comma, does not raise from feed(). The parser is
+        marked as failed and stops at the object that could not be parsed, no resource is returned for it, and
+        recover() returns the complete prefix before it.
+        """
+        self.buffer = []  # JSON characters of the code block
+        self.n_fences = 0
+        self.n_backticks = 0
+        self.started = False  # first bracket of the code block seen
+        self.finished = False  # top-level JSON value closed, or parsing failed
+        self.failed = False  # the JSON is malformed
+        self.stack = []  # open containers as [bracket, key, start index, safe prefix before the container]
+        self.in_string = False
+        self.escape = False
+        self.string_start = None
+        self.last_string = None
+        self.pending_key = None
+        self.expect_key = False
+        self.safe_end = 0  # end of the longest prefix that is complete up to its closing brackets
+        self.safe_closers = ""
+
+    @property
+    def text(self) -> str:
+        return "".join(self.buffer)
+
+    def feed(self, text: str) -> List[dict]:
+        """Process the next chunk of generated text
+
+        Args:
+            text (str): text chunk, e.g. a decoded token
+
+        Returns:
+            List[dict]: resources that were completed by this chunk
+        """
+        resources = []
+        for char in text:
+            resource = self._feed_char(char)
+            if resource is not None:
+                resources.append(resource)
+        return resources
+
+    def result(self) -> dict:
+        """Parse the complete FHIR JSON
+
+        Returns:
+            dict: The FHIR, raises json.JSONDecodeError if the JSON is incomplete or invalid.
+        """
+        return json.loads(self.text)
+
+    def recover(self) -> Optional[dict]:
+        """Parse the FHIR JSON, recovering the complete part of truncated output
+
+        Returns:
+            Optional[dict]: The (partial) FHIR, None if nothing could be recovered.
+        """
+        if self.started and not self.stack and not self.failed:
+            return self.result()
+        if self.safe_end == 0:
+            return None
+        try:
+            return json.loads(self.text[: self.safe_end] + self.safe_closers)
+        except json.JSONDecodeError:
+            return None
+
+    def _fail(self, safe: tuple = None) -> None:
+        """Stop parsing malformed JSON, optionally resetting the safe prefix to one before the malformed part"""
+        self.failed = True
+        self.finished = True
+        if safe is not None:
+            self.safe_end, self.safe_closers = safe
+
+    def _mark_safe(self, end: int) -> None:
+        self.safe_end = end
+        self.safe_closers = "".join(
+            _CLOSERS[bracket] for bracket, _, _, _ in reversed(self.stack)
+        )
+
+    def _feed_char(self, char: str) -> Optional[dict]:
+        if self.finished:
+            return None
+
+        if self.in_string:
+            self.buffer.append(char)
+            if self.escape:
+                self.escape = False
+            elif char == "\\":
+                self.escape = True
+            elif char == '"':
+                self.in_string = False
+                self.last_string = "".join(self.buffer[self.string_start :])
+                if not self.expect_key:
+                    self._mark_safe(len(self.buffer))
+            return None
+
+        if char == "`":
+            self.n_backticks += 1
+            if self.n_backticks == 3:
+                self.n_fences += 1
+                self.n_backticks = 0
+                if self.n_fences >= 2:
+                    self.finished = True  # code block closed, possibly truncated
+            return None
+        self.n_backticks = 0
+
+        if self.n_fences != 1:
+            return None
+        if not self.started:
+            if char not in _CLOSERS:
+                return None  # skip the info string, e.g. "json"
+            self.started = True
+
+        self.buffer.append(char)
+        index = len(self.buffer) - 1
+        in_object = len(self.stack) > 0 and self.stack[-1][0] == "{"
+
+        if char == '"':
+            self.in_string = True
+            self.string_start = index
+        elif char == ":":
+            try:
+                self.pending_key = json.loads(self.last_string)
+            except (TypeError, json.JSONDecodeError):  # no key string, or an invalid one
+                self._fail()
+                return None
+            self.expect_key = False
+        elif char == ",":
+            self._mark_safe(index)
+            self.expect_key = in_object
+        elif char in _CLOSERS:
+            key = self.pending_key if in_object else None
+            self.stack.append([char, key, index, (self.safe_end, self.safe_closers)])
+            self.expect_key = char == "{"
+            self._mark_safe(index + 1)
+        elif char in "}]":
+            if not self.stack or _CLOSERS[self.stack[-1][0]] != char:
+                self._fail()  # stray or mismatched closing bracket
+                return None
+            bracket, key, start, safe = self.stack.pop()
+            self.expect_key = False
+            self._mark_safe(index + 1)
+            if not self.stack:
+                self.finished = True
+            if bracket == "{":
+                return self._completed_resource(key, start, index, safe)
+        return None
+
+    def _completed_resource(self, key: str, start: int, end: int, safe: tuple) -> Optional[dict]:
+        """Returns the just closed object if it is a resource, see __init__"""
+        depth = len(self.stack)
+        is_entry = depth == 2 and self.stack[0][0] == "{" and self.stack[1][1] == "entry"
+        if not (depth == 0 or depth == 1 and self.stack[0][0] == "[" or is_entry):
+            return None
+        try:
+            value = json.loads("".join(self.buffer[start : end + 1]))
+        except json.JSONDecodeError:  # e.g. a trailing comma
+            self._fail(safe)
+            return None
+        if depth == 0:
+            return value if value.get("resourceType") != "Bundle" else None
+        if is_entry:
+            return value.get("resource", value)
+        return value
+
@@ -0,0 +1,70 @@
+#  Copyright (c) 2024. HealthSage AI.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Tree walkers with an explicit stack, so deeply nested FHIR does not hit the recursion limit
+"""
+from typing import Any, Callable, Iterable, Iterator
+
+
+def walk(root: Any, children: Callable[[Any], Iterable]) -> Iterator:
+    """Depth-first pre-order walk, in the same order as the recursive equivalent.
+
+    children(node) is called after node is yielded and before its first child, so it may build the children
+    on the fly.
+
+    Args:
+        root (Any): root node
+        children (Callable): function returning the children of a node, in order
+
+    Yields:
+        Any: the nodes of the tree
+    """
+    yield root
+    stack = [iter(children(root))]
+    while stack:
+        for node in stack[-1]:
+            yield node
+            stack.append(iter(children(node)))
+            break
+        else:
+            stack.pop()
+
+
+def rebuild_dict(root: dict, rebuild_node: Callable[[dict, dict, Callable], None]) -> dict:
+    """Build a new dict from nested dicts, without recursion.
+
+    rebuild_node(source, target, copy) is called once for each dict that is rebuilt, and fills the empty dict
+    target from dict source. copy(d) returns a new, empty dict that will be rebuilt from the nested dict d, so
+    nested dicts are rebuilt by assigning copy(value) instead of recursing.
+
+    Args:
+        root (dict): dict to rebuild
+        rebuild_node (Callable): see above
+
+    Returns:
+        dict: the rebuilt dict
+    """
+    stack = []
+
+    def copy(source: dict) -> dict:
+        target = {}
+        stack.append((source, target))
+        return target
+
+    result = copy(root)
+    while stack:
+        source, target = stack.pop()
+        rebuild_node(source, target, copy)
+    return result
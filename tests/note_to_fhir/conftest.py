@@ -0,0 +1,112 @@
+import json
+import pytest
+
+
+def _bundle(*resources) -> dict:
+    return {
+        "resourceType": "Bundle",
+        "type": "collection",
+        "entry": [{"resource": resource} for resource in resources],
+    }
+
+
+def _patient(family: str = "de Jong", **elements) -> dict:
+    return {"resourceType": "Patient", "name": [{"family": family}], **elements}
+
+
+@pytest.fixture
+def make_bundle():
+    """make_bundle(*resources) builds a collection Bundle with an entry per resource"""
+    return _bundle
+
+
+@pytest.fixture
+def make_patient():
+    """make_patient(family, **elements) builds a Patient with one name"""
+    return _patient
+
+
+@pytest.fixture
+def patient() -> dict:
+    return {
+        "resourceType": "Patient",
+        "name": [{"family": "de Jong", "given": ["Sofie"]}],
+        "gender": "female",
+        "birthDate": "1970-01-01",
+    }
+
+
+@pytest.fixture
+def observation() -> dict:
+    return {
+        "resourceType": "Observation",
+        "status": "final",
+        "code": {"coding": [{"display": "Body mass index"}], "text": "BMI"},
+        "valueQuantity": {"value": 30.7, "unit": "kg/m2"},
+    }
+
+
+@pytest.fixture(scope="session")
+def tiny_model(tmp_path_factory) -> str:
+    """Path of a tiny random Llama model and word level tokenizer, which load in a fraction of a second on CPU"""
+    from tokenizers import Tokenizer
+    from tokenizers.models import WordLevel
+    from tokenizers.pre_tokenizers import Whitespace
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    path = tmp_path_factory.mktemp("tiny_model")
+    vocab = {word: i for i, word in enumerate(["<unk>", "<s>", "</s>", "a", "b", "c"])}
+    tokenizer = Tokenizer(WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = Whitespace()
+    config = LlamaConfig(
+        vocab_size=len(vocab),
+        hidden_size=16,
+        intermediate_size=32,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        num_key_value_heads=2,
+        bos_token_id=1,
+        eos_token_id=2,
+    )
+    LlamaForCausalLM(config).save_pretrained(path)
+    PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", unk_token="<unk>"
+    ).save_pretrained(path)
+    return str(path)
+
+
+@pytest.fixture
+def make_translator(tiny_model):
+    """make_translator(**kwargs) builds a NoteToFhir of the tiny model with the llama template, in its own registry"""
+    from healthsageai.note_to_fhir.inference.note_to_fhir import NoteToFhir
+    from healthsageai.note_to_fhir.inference.registry import ModelRegistry
+
+    def make_translator(**kwargs):
+        registry = ModelRegistry(quantize=False, device_map=None)
+        return NoteToFhir(tiny_model, None, "llama", registry=registry, **kwargs)
+
+    return make_translator
+
+
+@pytest.fixture
+def fake_generator():
+    """fake_generator(fhir_for_prompt) stubs the text-generation pipeline of a NoteToFhir: each prompt generates
+    the FHIR that fhir_for_prompt(prompt) returns, in the format of the templates, or the text it returns as is.
+    If fhir_for_prompt raises, the whole call raises, as a failing batch does. The prompts of each call are
+    recorded in generator.calls."""
+
+    def generated_text(fhir) -> str:
+        return fhir if isinstance(fhir, str) else "```note\n```\n```json\n" + json.dumps(fhir) + "\n```"
+
+    def make_generator(fhir_for_prompt):
+        def generator(prompts, **kwargs):
+            is_batch = isinstance(prompts, list)
+            batch = prompts if is_batch else [prompts]
+            generator.calls.append(batch)
+            outputs = [[{"generated_text": generated_text(fhir_for_prompt(prompt))}] for prompt in batch]
+            return outputs if is_batch else outputs[0]
+
+        generator.calls = []
+        return generator
+
+    return make_generator
@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+import pytest
+from healthsageai.note_to_fhir.evaluation.utils import (
+    get_diff,
+    get_score,
+    optimize_array_order,
+    get_accuracy_matrix,
+    get_count_matrices,
+    get_optimal_order,
+)
+from healthsageai.note_to_fhir.evaluation.datamodels import ElementDetails
+
+
+@pytest.fixture
+def patient_bundle(make_bundle, make_patient):
+    return lambda names: make_bundle(*[make_patient(name) for name in names])
+
+
+def test_hungarian_matches_exact(patient_bundle):
+    fhir_true = patient_bundle(["Doe", "Jansen", "de Jong", "Smith"])
+    fhir_pred = patient_bundle(["Smith", "de Jong", "Doe", "Jansen"])
+    exact = get_diff(fhir_true, fhir_pred, "Bundle", array_order_strategy="exact")
+    hungarian = get_diff(
+        fhir_true, fhir_pred, "Bundle", array_order_strategy="hungarian"
+    )
+    assert hungarian.score == exact.score
+    assert hungarian.score.accuracy == 1.0
+
+
+def test_hungarian_large_array(patient_bundle):
+    names = [f"Name{i}" for i in range(20)]
+    diff = get_diff(
+        patient_bundle(names),
+        patient_bundle(names[::-1] + ["Extra"]),
+        "Bundle",
+        array_order_strategy="hungarian",
+    )
+    assert diff.score.n_matches == 21  # 20 names and the bundle type
+    assert diff.score.n_additions == 1
+
+
+def test_hungarian_maximizes_total_accuracy():
+    # The summed pair accuracies favour swapping the names (0/3 + 1/2 > 0/1 + 1/3), but the identity order has
+    # the highest accuracy overall (1/4 > 1/5).
+    fhir_true = {"resourceType": "Patient", "name": [{"text": "a"}, {"family": "b", "text": "b"}]}
+    fhir_pred = {"resourceType": "Patient", "name": [{"text": "b"}, {"family": "b", "given": ["c"]}]}
+    exact = get_score(fhir_true, fhir_pred, "Patient", array_order_strategy="exact")
+    hungarian = get_score(fhir_true, fhir_pred, "Patient", array_order_strategy="hungarian")
+    assert hungarian == exact
+    assert hungarian.accuracy == 0.25
+
+
+def test_hungarian_matches_exact_random_arrays():
+    rng = np.random.default_rng(0)
+
+    def make_name():
+        name = {
+            key: str(rng.choice(["a", "b"])) for key in ["family", "text", "use"] if rng.random() < 0.5
+        }
+        if rng.random() < 0.4:
+            name["given"] = [str(given) for given in rng.choice(["a", "b", "c"], rng.integers(1, 4), replace=False)]
+        return name
+
+    for _ in range(50):
+        fhir_true = {"resourceType": "Patient", "name": [make_name() for _ in range(rng.integers(1, 5))]}
+        fhir_pred = {"resourceType": "Patient", "name": [make_name() for _ in range(rng.integers(1, 5))]}
+        exact = get_score(fhir_true, fhir_pred, "Patient", array_order_strategy="exact")
+        hungarian = get_score(fhir_true, fhir_pred, "Patient", array_order_strategy="hungarian")
+        assert hungarian.accuracy == pytest.approx(exact.accuracy)
+
+
+@pytest.mark.parametrize("array_order_strategy", [None, "exact"])
+def test_exact_order_items_without_leaves(array_order_strategy):
+    # Items with only an id have no scored leaves, so every permutation has no accuracy
+    fhir_true = {"resourceType": "Patient", "identifier": [{"id": "a"}, {"id": "b"}]}
+    fhir_pred = {"resourceType": "Patient", "identifier": [{"id": "b"}, {"id": "a"}]}
+    diff = get_diff(fhir_true, fhir_pred, "Patient", array_order_strategy=array_order_strategy)
+    assert get_score(fhir_true, fhir_pred, "Patient", array_order_strategy=array_order_strategy) == diff.score
+    assert diff.score.n_leaves == 0
+
+
+def test_unknown_strategy():
+    element_details = ElementDetails(
+        key="given",
+        fhirtype="array",
+        required=False,
+        is_leaf=False,
+        is_array=True,
+        is_struct=False,
+        array_item_type="string",
+    )
+    with pytest.raises(ValueError):
+        optimize_array_order(["a", "b"], ["b", "a"], element_details, "random")
+
+
+def test_accuracy_matrix():
+    element_details = ElementDetails(
+        key="given",
+        fhirtype="array",
+        required=False,
+        is_leaf=False,
+        is_array=True,
+        is_struct=False,
+        array_item_type="string",
+    )
+    matrix = get_accuracy_matrix(["a", "b", "a"], ["a", 1, "c"], element_details)
+    assert matrix.shape == (3, 3)
+    assert matrix.tolist() == [
+        [1.0, -1.0, 0.0],
+        [0.0, -1.0, 0.0],
+        [1.0, -1.0, 0.0],
+    ]
+
+
+def test_count_matrices():
+    element_details = ElementDetails(
+        key="given",
+        fhirtype="array",
+        required=False,
+        is_leaf=False,
+        is_array=True,
+        is_struct=False,
+        array_item_type="string",
+    )
+    n_leaves, n_matches = get_count_matrices(["a", "b", "a"], ["a", None, "c"], element_details)
+    assert n_leaves.tolist() == [[1, 1, 1]] * 3
+    assert n_matches.tolist() == [[1, 0, 0], [0, 0, 0], [1, 0, 0]]
+
+
+def test_optimal_order_dataframe_and_array():
+    matrix = np.array([[0.2, 0.9], [0.8, np.nan]])
+    assert get_optimal_order(matrix) == {1: 0, 0: 1}
+    assert get_optimal_order(pd.DataFrame(matrix)) == {1: 0, 0: 1}
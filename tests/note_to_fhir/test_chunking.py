@@ -0,0 +1,111 @@
+from healthsageai.note_to_fhir.inference.chunking import merge_bundles, split_note
+
+note = """DISCHARGE SUMMARY
+Patient Sofie de Jong, born 1970-01-01.
+
+HISTORY OF PRESENT ILLNESS: Admitted with chest pain. Troponin was elevated.
+MEDICATION
+Aspirin 80 mg daily. Metoprolol 50 mg twice daily. Atorvastatin 40 mg daily."""
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def test_split_note():
+    assert split_note(note, 100, count_words) == [note]
+    chunks = split_note(note, 12, count_words)
+    assert chunks == [
+        "DISCHARGE SUMMARY\nPatient Sofie de Jong, born 1970-01-01.",
+        "HISTORY OF PRESENT ILLNESS: Admitted with chest pain. Troponin was elevated.",
+        "MEDICATION\nAspirin 80 mg daily. Metoprolol 50 mg twice daily.",
+        "Atorvastatin 40 mg daily.",
+    ]
+    assert all(count_words(chunk) <= 12 for chunk in chunks)
+    assert split_note("a b c d e", 2, count_words) == ["a b", "c d", "e"]
+
+
+def test_split_note_counts_tokens_linearly():
+    long_note = " ".join(["word"] * 5000)
+    n_counted = {}
+    for max_tokens in [50, 500]:
+        counted = []
+
+        def count_counted_words(text):
+            counted.append(count_words(text))
+            return counted[-1]
+
+        chunks = split_note(long_note, max_tokens, count_counted_words)
+        assert chunks == [" ".join(["word"] * max_tokens)] * (5000 // max_tokens)
+        n_counted[max_tokens] = sum(counted)
+    # The chunks are counted as a whole when they are full, not for every word that is added, so the number of
+    # counted words does not grow with the chunk size
+    assert n_counted[500] < 1.2 * n_counted[50]
+
+
+def test_split_note_recounts_underestimated_chunks():
+    # Joining parts costs extra tokens, so the sum of the parts underestimates the chunk
+    def count_superadditive(text):
+        return count_words(text) + count_words(text) // 5
+
+    chunks = split_note(" ".join(["word"] * 30), 10, count_superadditive)
+    assert all(count_superadditive(chunk) <= 10 for chunk in chunks)
+    assert " ".join(chunks).split() == ["word"] * 30
+
+
+def _resource(resource_type, resource_id, **elements):
+    return {"resourceType": resource_type, "id": resource_id, **elements}
+
+
+def test_merge_bundles(make_bundle, make_patient):
+    patient = make_patient(id="1")
+    encounter = _resource("Encounter", "1", status="finished", subject={"reference": "Patient/1"})
+    first = make_bundle(
+        patient,
+        encounter,
+        _resource("Condition", "1", subject={"reference": "Patient/1"}, encounter={"reference": "Encounter/1"}),
+    )
+    second = make_bundle(
+        make_patient(id="2", gender="female"),
+        _resource("Encounter", "1", status="finished", subject={"reference": "Patient/2"}),
+        _resource("Condition", "1", subject={"reference": "Patient/2"}, encounter={"reference": "Encounter/1"}),
+        _resource("Patient", "3", gender="male"),  # conflicts with the merged Patient
+    )
+    observation = _resource("Observation", "1", subject={"reference": "Patient/1"})
+
+    merged = merge_bundles([first, second, observation])
+    resources = [entry["resource"] for entry in merged["entry"]]
+    assert [(r["resourceType"], r["id"]) for r in resources] == [
+        ("Patient", "1"),
+        ("Encounter", "1"),
+        ("Condition", "1"),
+        ("Condition", "1-2"),
+        ("Patient", "3"),
+        ("Observation", "1"),
+    ]
+    assert resources[0] == make_patient(id="1", gender="female")
+    assert resources[3]["subject"] == {"reference": "Patient/1"}
+    assert resources[3]["encounter"] == {"reference": "Encounter/1"}
+    assert first["entry"][0]["resource"] == patient  # the inputs are not changed
+
+
+def test_translate_chunked(make_translator, fake_generator, make_bundle):
+    from healthsageai.note_to_fhir.inference.config import InferenceConfig
+
+    translator = make_translator(inference_config=InferenceConfig(max_length=400, max_new_tokens=100))
+    long_note = "\n\n".join(["a b c " * 50, "c b a " * 50])
+    chunks = translator.split_note(long_note)
+    assert len(chunks) == 2
+
+    prompt_chunks = {translator.template.format(note=chunk): str(i) for i, chunk in enumerate(chunks)}
+    translator.generator = fake_generator(
+        lambda prompt: make_bundle(
+            _resource("Patient", "1", gender="female"),
+            _resource("Condition", "1", subject={"reference": "Patient/1"}, note=[{"text": prompt_chunks[prompt]}]),
+        )
+    )
+    fhir = translator.translate_chunked(long_note)
+    assert [len(prompts) for prompts in translator.generator.calls] == [2]
+    resources = [entry["resource"] for entry in fhir["entry"]]
+    assert [r["resourceType"] for r in resources] == ["Patient", "Condition", "Condition"]
+    assert [r["subject"]["reference"] for r in resources[1:]] == ["Patient/1", "Patient/1"]
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from healthsageai.note_to_fhir.evaluation.compact import CompactDiff
+from healthsageai.note_to_fhir.evaluation.utils import (
+    diff_to_dataframe,
+    get_diff,
+    get_score,
+    iter_diff_nodes,
+)
+
+@pytest.fixture
+def fhir_true(make_bundle, patient, observation):
+    return make_bundle(patient, observation)
+
+
+@pytest.fixture
+def fhir_pred(make_bundle, patient, observation):
+    return make_bundle(
+        {**observation, "code": {"text": "BMI"}, "valueQuantity": {"value": 30.1, "unit": "kg/m2"}},
+        {**patient, "name": [{"family": "de Jong", "given": ["Sofie", "Anna"]}], "birthDate": "1970-02-01"},
+    )
+
+
+def test_compact_diff_equals_diff(fhir_true, fhir_pred):
+    diff = get_diff(fhir_true, fhir_pred, "Bundle")
+    compact = get_diff(fhir_true, fhir_pred, "Bundle", compact=True)
+    assert isinstance(compact, CompactDiff)
+    assert compact.score == diff.score
+    assert compact.labels() == [node.label for node in iter_diff_nodes(diff)]
+    assert diff_to_dataframe(compact.to_fhir_diff()).drop(columns=["score"]).equals(
+        diff_to_dataframe(diff).drop(columns=["score"])
+    )
+
+
+def test_compact_diff_from_fhir_diff(fhir_true, fhir_pred):
+    diff = get_diff(fhir_true, fhir_pred, "Bundle")
+    compact = CompactDiff.from_fhir_diff(diff)
+    expected = get_diff(fhir_true, fhir_pred, "Bundle", compact=True)
+    assert len(compact) == len(expected)
+    assert np.array_equal(compact.parents, expected.parents)
+    assert np.array_equal(compact.scores, expected.scores)
+    assert compact.scores.dtype == np.int32
+
+
+def test_engines_agree_on_illegal_predictions(fhir_true, patient, observation, make_bundle):
+    # A struct predicted as a string, an array predicted as a dict and a resource predicted as a list
+    fhir_pred = make_bundle(
+        {**observation, "code": "BMI", "valueQuantity": {"value": 30.7, "unit": "kg/m2"}},
+        {**patient, "name": {"family": "de Jong"}},
+    )
+    fhir_pred["entry"].append(["not a resource"])
+    diff = get_diff(fhir_true, fhir_pred, "Bundle")
+    compact = get_diff(fhir_true, fhir_pred, "Bundle", compact=True)
+    assert get_score(fhir_true, fhir_pred, "Bundle") == compact.score == diff.score
+    assert compact.labels() == [node.label for node in iter_diff_nodes(diff)]
+    assert diff.score.n_deletions == 4  # illegal predicted values are compared as absent
@@ -0,0 +1,104 @@
+import json
+import pytest
+from healthsageai.note_to_fhir.evaluation.corpus import evaluate_corpus, evaluate_jsonl, read_jsonl_pairs
+from healthsageai.note_to_fhir.evaluation.utils import get_score
+
+
+@pytest.fixture
+def pairs(make_bundle, make_patient):
+    def bundle(names: list, gender: str) -> dict:
+        return make_bundle(*[make_patient(name, gender=gender) for name in names])
+
+    return [
+        (bundle(["Doe", "Jansen"], "male"), bundle(["Jansen", "Doe"], "male")),
+        (bundle(["de Jong"], "female"), bundle(["de Jong", "Smith"], "male")),
+        (json.dumps(bundle(["Doe"], "male")), json.dumps(bundle([], "male"))),
+    ]
+
+
+def test_evaluate_corpus(pairs):
+    evaluation = evaluate_corpus(pairs, workers=1)
+    expected = [
+        get_score(
+            json.loads(t) if isinstance(t, str) else t,
+            json.loads(p) if isinstance(p, str) else p,
+            "Bundle",
+        )
+        for t, p in pairs
+    ]
+    assert evaluation.record_scores == expected
+    assert evaluation.score == sum(expected)
+    # A hallucinated Patient has no ground truth resourceType and is counted as "Resource"
+    assert evaluation.resource_table.loc["Patient", "n_nodes"] == 4
+    assert evaluation.resource_table.loc["Bundle", "n_leaves"] == evaluation.score.n_leaves
+
+
+def test_evaluate_corpus_process_pool(pairs):
+    serial = evaluate_corpus(pairs, workers=1)
+    parallel = evaluate_corpus(pairs, workers=2, chunksize=1)
+    assert parallel.record_scores == serial.record_scores
+    assert parallel.resource_table.equals(serial.resource_table)
+
+
+def test_evaluate_jsonl(tmp_path, pairs):
+    path = tmp_path / "corpus.jsonl"
+    with open(path, "w") as f:
+        for fhir_true, fhir_pred in pairs:
+            f.write(json.dumps({"fhir_true": fhir_true, "note_to_fhir": fhir_pred}) + "\n")
+    evaluation = evaluate_jsonl(str(path), workers=1, chunksize=2)
+    expected = evaluate_corpus(pairs, workers=1)
+    assert evaluation.record_scores is None
+    assert evaluation.n_records == 3
+    assert evaluation.score == expected.score
+    assert evaluation.resource_table.equals(expected.resource_table)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_evaluate_jsonl_unreadable_lines(tmp_path, pairs, workers):
+    lines = [json.dumps({"fhir_true": fhir_true, "note_to_fhir": fhir_pred}) for fhir_true, fhir_pred in pairs]
+    lines = lines[:1] + ['{"fhir_true": {"resourceType": "Bun', ""] + lines[1:] + [json.dumps({"fhir_true": {}})]
+    path = _write_lines(tmp_path / "corpus.jsonl", lines)
+    evaluation = evaluate_jsonl(path, workers=workers, chunksize=2)
+    expected = evaluate_corpus(pairs, workers=1)
+    assert [index for index, _ in evaluation.failed_records] == [1, 4]
+    assert evaluation.failed_records[0][1].startswith(f"RecordReadError: {path} line 2: JSONDecodeError")
+    assert evaluation.failed_records[1][1].startswith(f"RecordReadError: {path} line 6: KeyError")
+    assert evaluation.n_records == 3
+    assert evaluation.score == expected.score
+
+
+def _write_lines(path, lines: list) -> str:
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return str(path)
+
+
+def test_read_jsonl_pairs_two_files(tmp_path, pairs):
+    lines_true = [json.dumps(t) if isinstance(t, dict) else t for t, _ in pairs]
+    lines_pred = [json.dumps(p) if isinstance(p, dict) else p for _, p in pairs]
+    path = _write_lines(tmp_path / "true.jsonl", [lines_true[0], "", lines_true[1], lines_true[2]])
+    pred_path = _write_lines(tmp_path / "pred.jsonl", ["", lines_pred[0], lines_pred[1], "  ", lines_pred[2], ""])
+    read = [(json.loads(t), json.loads(p)) for t, p in read_jsonl_pairs(path, pred_path)]
+    assert read == [(json.loads(t), json.loads(p)) for t, p in zip(lines_true, lines_pred)]
+
+
+def test_read_jsonl_pairs_record_count_mismatch(tmp_path, pairs):
+    lines = [json.dumps(t) if isinstance(t, dict) else t for t, _ in pairs]
+    path = _write_lines(tmp_path / "true.jsonl", lines)
+    pred_path = _write_lines(tmp_path / "pred.jsonl", lines[:2] + [""])
+    for paths in [(path, pred_path), (pred_path, path)]:
+        with pytest.raises(ValueError, match="true.jsonl has more records than .*pred.jsonl, which has 2"):
+            list(read_jsonl_pairs(*paths))
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_evaluate_corpus_failed_records(pairs, workers):
+    failing = pairs[:1] + [("{not json", json.dumps({}))] + pairs[1:] + [(pairs[0][0], '{"resourceType": "Bun')]
+    evaluation = evaluate_corpus(failing, workers=workers, chunksize=2)
+    expected = evaluate_corpus(pairs, workers=1)
+    assert [index for index, _ in evaluation.failed_records] == [1, 4]
+    assert evaluation.failed_records[0][1].startswith("JSONDecodeError")
+    assert evaluation.n_records == 3
+    assert evaluation.score == expected.score
+    assert evaluation.record_scores == expected.record_scores[:1] + [None] + expected.record_scores[1:] + [None]
+    assert evaluation.resource_table.equals(expected.resource_table)
@@ -0,0 +1,65 @@
+from healthsageai.note_to_fhir.data_utils import (
+    FhirNormalizer,
+    DropNones,
+    DropSnomedLoincCodes,
+    FilterSupportedResources,
+    drop_nones,
+    drop_snomed_loinc,
+)
+
+bundle = {
+    "resourceType": "Bundle",
+    "id": None,
+    "entry": [
+        {
+            "resource": {
+                "resourceType": "Condition",
+                "code": {
+                    "coding": [
+                        {"system": "http://snomed.info/sct", "code": "195967001", "display": "Asthma"},
+                        {"system": "http://example.org", "code": "A1", "display": None},
+                    ]
+                },
+                "note": [None, {"text": None}],
+            }
+        },
+        {"resource": {"resourceType": "Basic", "code": {"text": "unsupported"}}},
+    ],
+}
+
+
+def test_normalizer_matches_drop_functions():
+    normalizer = FhirNormalizer([DropNones(), DropSnomedLoincCodes()])
+    assert normalizer(bundle) == drop_snomed_loinc(drop_nones(bundle))
+
+
+def test_normalizer_filter_supported_resources():
+    normalizer = FhirNormalizer([DropNones(), FilterSupportedResources()])
+    fhir = normalizer(bundle)
+    assert [entry["resource"]["resourceType"] for entry in fhir["entry"]] == ["Condition"]
+    assert "id" not in fhir
+    assert bundle["id"] is None  # the input is not modified
+
+
+def test_drop_nones_deeply_nested():
+    nested = {"value": 1, "none": None}
+    for _ in range(5000):
+        nested = {"child": nested, "none": None, "items": [{"none": None}]}
+    dropped = drop_nones(nested)
+    for _ in range(5000):
+        assert set(dropped) == {"child", "items"}
+        assert dropped["items"] == [{}]
+        dropped = dropped["child"]
+    assert dropped == {"value": 1}
+
+
+def test_normalizer_deeply_nested():
+    nested = {"coding": [{"system": "http://loinc.org", "code": "1-8", "display": None}]}
+    for _ in range(5000):
+        nested = {"child": nested, "none": None, "items": [[{"none": None}]]}
+    normalized = FhirNormalizer([DropNones(), DropSnomedLoincCodes()])(nested)
+    for _ in range(5000):
+        assert set(normalized) == {"child", "items"}
+        assert normalized["items"] == [[{}]]
+        normalized = normalized["child"]
+    assert normalized == {"coding": [{"system": "http://loinc.org"}]}
@@ -0,0 +1,32 @@
+import subprocess
+import sys
+
+light_modules = [
+    "healthsageai.note_to_fhir.parsers",
+    "healthsageai.note_to_fhir.data_utils",
+    "healthsageai.note_to_fhir.evaluation.utils",
+    "healthsageai.note_to_fhir.inference",
+]
+heavy_modules = ["torch", "transformers", "pandas", "scipy", "fhir.resources.R4B.patient"]
+
+
+def test_imports_are_lazy():
+    # A fresh interpreter, as the test session itself has imported the heavy modules already
+    code = f"""
+import sys
+for module in {light_modules!r}:
+    __import__(module)
+print(",".join(module for module in {heavy_modules!r} if module in sys.modules))
+"""
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    assert output.strip() == ""
+
+
+def test_lazy_attributes():
+    from healthsageai.note_to_fhir import inference
+    from healthsageai.note_to_fhir.evaluation import fhirmodels
+
+    assert inference.NoteToFhir13b.__name__ == "NoteToFhir13b"
+    assert fhirmodels.Patient is fhirmodels.object_mapping["Patient"]
+    assert fhirmodels.object_mapping.get("Spaceship") is None
+    assert len(fhirmodels.object_mapping) == len(list(fhirmodels.object_mapping))
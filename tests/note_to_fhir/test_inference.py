@@ -0,0 +1,158 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import torch
+from healthsageai.note_to_fhir.inference.config import InferenceConfig
+from healthsageai.note_to_fhir.inference.stopping import CancelledStoppingCriteria, CodeFenceStoppingCriteria
+
+vocab = ["~\n", "```", "json\n", "{", '"a"', ":", "1", "}", "\n", "x"]
+
+
+class CharTokenizer:
+    def decode(self, ids, skip_special_tokens=True):
+        return "".join(vocab[i] for i in ids)
+
+
+def test_code_fence_stopping_criteria():
+    prompt = [1, 2, 9, 1]  # the prompt contains a code block as well
+    generated = [[0, 1, 2, 3, 4, 5, 6, 7, 8, 1], [0, 1, 2, 3, 4, 5, 6, 6, 6, 6]]
+    criteria = CodeFenceStoppingCriteria(CharTokenizer())
+    json_criteria = CodeFenceStoppingCriteria(
+        CharTokenizer(), stop_on_code_fence=False, stop_on_json_close=True
+    )
+    for step in range(1, len(generated[0]) + 1):
+        input_ids = torch.tensor([prompt + tokens[:step] for tokens in generated])
+        is_done = criteria(input_ids, None).tolist()
+        is_json_done = json_criteria(input_ids, None).tolist()
+    assert is_done == [True, False]
+    assert is_json_done == [True, False]
+
+
+def test_cancelled_stopping_criteria():
+    cancelled = threading.Event()
+    criteria = CancelledStoppingCriteria(cancelled)
+    input_ids = torch.zeros((2, 3), dtype=torch.long)
+    assert criteria(input_ids, None).tolist() == [False, False]
+    cancelled.set()
+    assert criteria(input_ids, None).tolist() == [True, True]
+
+
+def test_generation_kwargs():
+    assert InferenceConfig(temperature=0.7, top_p=0.9).generation_kwargs() == {
+        "use_cache": True,
+        "do_sample": False,
+        "max_new_tokens": 3072,
+    }
+    sampling = InferenceConfig(do_sample=True, temperature=0.7, top_p=0.9, max_new_tokens=16, use_cache=False)
+    assert sampling.generation_kwargs() == {
+        "use_cache": False,
+        "do_sample": True,
+        "max_new_tokens": 16,
+        "temperature": 0.7,
+        "top_p": 0.9,
+    }
+    assert "temperature" not in InferenceConfig(do_sample=True, top_p=0.9).generation_kwargs()
+
+
+def test_inference_config_leaves_shared_model_config(make_translator):
+    translator = make_translator(inference_config=InferenceConfig(use_cache=False))
+    model, _ = translator.registry.load(translator.model_name, translator.adapter_name)
+    assert model.config.use_cache  # the model is shared with other translators through the registry
+    assert translator.inference_config.generation_kwargs()["use_cache"] is False
+
+
+def test_max_new_tokens_clamped_to_max_length(make_translator, patient):
+    translator = make_translator(inference_config=InferenceConfig(max_length=160, max_new_tokens=48))
+    calls = []
+
+    def generator(prompts, **kwargs):
+        calls.append(kwargs)
+        batch = prompts if isinstance(prompts, list) else [prompts]
+        outputs = [[{"generated_text": "```note\n```\n```json\n" + json.dumps(patient) + "\n```"}] for _ in batch]
+        return outputs if isinstance(prompts, list) else outputs[0]
+
+    translator.generator = generator
+
+    def prompt_tokens(note):
+        return len(translator.tokenizer(translator.template.format(note=note))["input_ids"])
+
+    translator.translate("a")
+    assert calls[-1]["max_new_tokens"] == min(48, 160 - prompt_tokens("a"))
+    # A batch is clamped for its longest prompt
+    long_note = " ".join(["a"] * 20)
+    translator.translate_batch(["a", long_note], batch_size=2)
+    assert calls[-1]["max_new_tokens"] == 160 - prompt_tokens(long_note) < 48
+    assert "stopping_criteria" in calls[-1]
+    with pytest.raises(ValueError, match="no room to generate"):
+        translator.translate(" ".join(["a"] * 64))
+
+
+def _generated_text(fhir):
+    return "~\n```json\n" + json.dumps(fhir) + "\n```"
+
+
+def test_translate_incremental(make_translator, make_bundle, patient, observation):
+    translator = make_translator()
+    text = _generated_text(make_bundle(patient, observation))
+
+    def generator(prompt, streamer, **kwargs):  # streams the text in pieces, as the pipeline does
+        for i in range(0, len(text), 5):
+            streamer.on_finalized_text(text[i : i + 5])
+        streamer.on_finalized_text("", stream_end=True)
+
+    translator.generator = generator
+    assert list(translator.translate_incremental("a")) == [patient, observation]
+
+
+def test_translate_incremental_malformed_output(make_translator, make_bundle, patient, observation):
+    translator = make_translator()
+    text = _generated_text(make_bundle(patient, observation)).replace('"Observation"', '"Observation"]', 1)
+
+    def generator(prompt, streamer, **kwargs):
+        streamer.on_finalized_text(text)
+        streamer.on_finalized_text("", stream_end=True)
+
+    translator.generator = generator
+    # The resources before the mismatched bracket are yielded, the stream ends without raising
+    assert list(translator.translate_incremental("a")) == [patient]
+
+
+def test_translate_incremental_stops_early(make_translator, make_bundle, patient, observation):
+    translator = make_translator()
+    stopped = threading.Event()
+
+    def generator(prompt, streamer, stopping_criteria, **kwargs):  # generates until a stopping criterion is met
+        streamer.on_finalized_text(_generated_text(make_bundle(patient, observation)))
+        while not stopping_criteria(torch.zeros((1, 1), dtype=torch.long), None).all():
+            time.sleep(0.01)
+        stopped.set()
+        streamer.on_finalized_text("", stream_end=True)
+
+    translator.generator = generator
+    resources = translator.translate_incremental("a")
+    assert next(resources) == patient
+    resources.close()
+    assert stopped.is_set()
+
+
+def test_translate_incremental_generation_error(make_translator, make_bundle, fake_generator, patient, observation):
+    translator = make_translator()
+    text = _generated_text(make_bundle(patient, observation))
+
+    def generator(prompt, streamer, **kwargs):  # fails after the first resource
+        streamer.on_finalized_text(text[: text.index('"Observation"')])
+        raise RuntimeError("CUDA out of memory")
+
+    translator.generator = generator
+    resources = []
+    with pytest.raises(RuntimeError, match="out of memory"):
+        for resource in translator.translate_incremental("a"):
+            resources.append(resource)
+    assert resources == [patient]
+
+    # The adapter of the shared model is released, so other threads can generate
+    translator.generator = fake_generator(lambda prompt: patient)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert executor.submit(translator.translate, "a").result(timeout=10) == patient
@@ -0,0 +1,68 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from transformers import LlamaForCausalLM
+from healthsageai.note_to_fhir.inference.note_to_fhir import NoteToFhir
+from healthsageai.note_to_fhir.inference.registry import ModelRegistry
+
+
+def test_model_registry(tmp_path, tiny_model):
+    model_name = tiny_model
+    cache_dir = str(tmp_path / "cache")
+    registry = ModelRegistry(cache_dir=cache_dir, quantize=False, device_map=None)
+    translator = NoteToFhir(model_name, None, "llama", registry=registry)
+    other = NoteToFhir(model_name, None, "llama", registry=registry)
+    assert other.generator.model is translator.generator.model
+    assert registry.stats()["hits"] == 1
+    assert registry.stats()["misses"] == 1
+
+    # A new process loads the model from the cache directory
+    restarted = ModelRegistry(cache_dir=cache_dir, quantize=False, device_map=None)
+    model, tokenizer = restarted.load(model_name)
+    assert restarted.stats()["disk_hits"] == 1
+    assert tokenizer.padding_side == "left"
+    with restarted.use_adapter(model_name) as active_model:
+        assert active_model is model
+
+
+def test_model_registry_adapters(tmp_path, tiny_model):
+    peft = pytest.importorskip("peft")
+    model_name = tiny_model
+    adapters = []
+    for name in ["adapter_a", "adapter_b"]:
+        lora = peft.get_peft_model(
+            LlamaForCausalLM.from_pretrained(model_name),
+            peft.LoraConfig(r=2, target_modules=["q_proj", "v_proj"]),
+        )
+        lora.save_pretrained(tmp_path / name)
+        adapters.append(str(tmp_path / name))
+
+    registry = ModelRegistry(quantize=False, device_map=None)
+    model_a, _ = registry.load(model_name, adapters[0])
+    model_b, _ = registry.load(model_name, adapters[1])
+    assert model_a is model_b
+    assert registry.stats()["models"] == {model_name: sorted(adapters)}
+    with registry.use_adapter(model_name, adapters[1]) as model:
+        assert model.active_adapters() == [adapters[1].replace(".", "-")]
+
+
+def test_model_registry_loads_models_in_parallel():
+    started = {"a": threading.Event(), "b": threading.Event()}
+
+    class SlowRegistry(ModelRegistry):
+        def _load_base(self, model_name: str) -> tuple:
+            started[model_name].set()
+            # Loading "a" waits until "b" is loading as well, which a registry-wide lock would prevent
+            assert started["b"].wait(timeout=10)
+            return object(), object()
+
+    registry = SlowRegistry(quantize=False, device_map=None)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        loaded_a = [executor.submit(registry.load, "a") for _ in range(2)]
+        assert started["a"].wait(timeout=10)
+        loaded_b = executor.submit(registry.load, "b")
+        models_a = [future.result(timeout=10)[0] for future in loaded_a]
+        loaded_b.result(timeout=10)
+    assert models_a[0] is models_a[1]
+    assert registry.stats()["misses"] == 2
+    assert registry.stats()["hits"] == 1
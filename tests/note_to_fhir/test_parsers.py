@@ -0,0 +1,104 @@
+import json
+from healthsageai.note_to_fhir.parsers import (
+    CodeFenceTracker,
+    StreamingFhirParser,
+    extract_from_code_block,
+)
+
+generated_text = '~\n```json\n{"resourceType": "Patient", "name": [{"text": "a ``` } ] \\" b"}]}\n```\ntrailing'
+
+
+def test_code_fence_tracker():
+    tracker = CodeFenceTracker()
+    closed_at = None
+    json_closed_at = None
+    for i, char in enumerate(generated_text):
+        tracker.feed(char)
+        if json_closed_at is None and tracker.json_closed:
+            json_closed_at = i
+        if closed_at is None and tracker.block_closed:
+            closed_at = i
+    assert generated_text[json_closed_at] == "}"
+    assert generated_text[: closed_at + 1].endswith("}\n```")
+    assert tracker.n_fences == 2
+
+
+def test_code_fence_tracker_open_block():
+    tracker = CodeFenceTracker()
+    tracker.feed('```json\n{"a": [1, 2')
+    assert tracker.in_code_block
+    assert tracker.depth == 2
+    assert not tracker.block_closed and not tracker.json_closed
+
+
+bundle = {
+    "resourceType": "Bundle",
+    "type": "collection",
+    "entry": [
+        {"resource": {"resourceType": "Patient", "name": [{"text": 'Jo "}]` Doe'}]}},
+        {"resource": {"resourceType": "Condition", "subject": {"reference": "Patient/1"}}},
+    ],
+}
+
+
+def test_streaming_parser():
+    text = "~\n```json\n" + json.dumps(bundle, indent=2) + "\n```\n"
+    parser = StreamingFhirParser()
+    resources = []
+    for i in range(0, len(text), 3):
+        resources += parser.feed(text[i : i + 3])
+    assert resources == [entry["resource"] for entry in bundle["entry"]]
+    assert parser.result() == bundle
+
+
+def test_streaming_parser_truncated():
+    text = "```json\n" + json.dumps(bundle)
+    for end in range(len(text)):
+        parser = StreamingFhirParser()
+        parser.feed(text[:end])
+        recovered = parser.recover()
+        assert recovered is None or recovered.get("resourceType", "Bundle") == "Bundle"
+    parser = StreamingFhirParser()
+    parser.feed(text[: text.index("Condition")])
+    assert parser.recover()["entry"][0] == bundle["entry"][0]
+
+
+def _parse(json_text: str) -> StreamingFhirParser:
+    parser = StreamingFhirParser()
+    assert parser.feed("```json\n" + json_text + "\n```\n") == []
+    return parser
+
+
+def test_streaming_parser_mismatched_bracket():
+    parser = _parse('{"resourceType": "Patient"]}')
+    assert parser.failed
+    assert parser.recover() == {"resourceType": "Patient"}
+
+
+def test_streaming_parser_trailing_comma():
+    parser = StreamingFhirParser()
+    text = '```json\n[{"resourceType": "Patient"}, {"resourceType": "Condition",}, {"resourceType": "Encounter"}]'
+    # No resource for the malformed object, and parsing stops there
+    assert parser.feed(text) == [{"resourceType": "Patient"}]
+    assert parser.failed
+    assert parser.recover() == [{"resourceType": "Patient"}]
+    assert _parse('[{"a": 1,}]').recover() == []
+
+
+def test_streaming_parser_stray_closer():
+    parser = StreamingFhirParser()
+    text = '```json\n{"resourceType": "Bundle", "entry": [{"resource": {"resourceType": "Patient"}}}]}'
+    assert parser.feed(text) == [{"resourceType": "Patient"}]  # completed before the stray bracket
+    assert parser.failed
+    assert parser.recover() == {"resourceType": "Bundle", "entry": [{"resource": {"resourceType": "Patient"}}]}
+    assert _parse('{1: 2}').failed
+
+
+def test_extract_from_code_block():
+    assert extract_from_code_block('a\n\n```json\n{"a": 1}\n```\nb') == '{"a": 1}\n'
+    assert extract_from_code_block("```json\n{1}") == "{1}"
+    assert extract_from_code_block("  ```json\n  {1}\n   x\n  ```") == "{1}\n x\n"
+    assert extract_from_code_block("````\n```\nx\n````") == "```\nx\n"
+    assert extract_from_code_block("``` a`b\nx\n~~~\ny\n~~~") == "y\n"
+    assert extract_from_code_block("a\n\nb\n\nc") == "b"  # fallback without code block
+    assert extract_from_code_block("plain") == "plain"
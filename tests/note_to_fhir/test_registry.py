@@ -0,0 +1,39 @@
+from healthsageai.note_to_fhir.evaluation.registry import ResourceDetailsRegistry
+from healthsageai.note_to_fhir.evaluation.utils import (
+    get_resource_details,
+    get_resource_class,
+    resource_details_registry,
+    get_diff,
+)
+
+
+def test_registry_matches_schema():
+    registry = ResourceDetailsRegistry(
+        lambda resource_type: get_resource_details(get_resource_class(resource_type))
+    )
+    details = registry.get("Coding")
+    assert details == get_resource_details(get_resource_class("Coding"))
+    assert registry.get("Coding") is details
+    assert registry.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+
+def test_registry_save_load(tmp_path):
+    registry = ResourceDetailsRegistry(
+        lambda resource_type: get_resource_details(get_resource_class(resource_type))
+    )
+    registry.warm(["Patient", "HumanName"])
+    path = str(tmp_path / "details.json")
+    registry.save(path)
+
+    loaded = ResourceDetailsRegistry(lambda resource_type: [])
+    loaded.load(path)
+    assert loaded.get("Patient") == registry.get("Patient")
+    assert loaded.stats()["misses"] == 0
+
+
+def test_get_diff_uses_registry():
+    fhir = {"resourceType": "Patient", "gender": "male", "name": [{"family": "Doe"}]}
+    get_diff(fhir, fhir, "Patient")
+    hits = resource_details_registry.stats()["hits"]
+    get_diff(fhir, fhir, "Patient")
+    assert resource_details_registry.stats()["hits"] > hits
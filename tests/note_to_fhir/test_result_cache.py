@@ -0,0 +1,75 @@
+import pytest
+from healthsageai.note_to_fhir.inference.config import InferenceConfig
+from healthsageai.note_to_fhir.inference.result_cache import (
+    MemoryResultCache,
+    ResultCache,
+    SQLiteResultCache,
+    normalize_note,
+    result_key,
+)
+
+
+def test_normalize_note():
+    note = "Patient  Sofie de Jong\r\n\r\n\r\n\tlives in Amsterdam.  \n"
+    assert normalize_note(note) == "Patient Sofie de Jong\n\nlives in Amsterdam."
+    key = result_key(note, "llama", "model", "adapter", InferenceConfig())
+    assert key == result_key(normalize_note(note), "llama", "model", "adapter", InferenceConfig())
+    assert key != result_key(note, "mixtral", "model", "adapter", InferenceConfig())
+    assert key != result_key(note, "llama", "model", "adapter", InferenceConfig(max_new_tokens=10))
+    assert key != result_key(note.lower(), "llama", "model", "adapter", InferenceConfig())
+
+
+def test_memory_result_cache(patient):
+    cache = MemoryResultCache(maxsize=2)
+    cache.put("a", patient)
+    cache.put("b", patient)
+    result = cache.get("a")
+    assert result == patient
+    result["name"] = []  # results are copies
+    assert cache.get("a") == patient
+    cache.put("c", patient)  # evicts "b"
+    assert cache.get("b") is None
+    assert cache.stats() == {"hits": 2, "misses": 1, "size": 2, "hit_rate": 2 / 3}
+
+
+def test_sqlite_result_cache(tmp_path, patient):
+    path = str(tmp_path / "results.sqlite")
+    cache = SQLiteResultCache(path)
+    cache.put("a", patient)
+    cache.close()
+    cache = SQLiteResultCache(path)
+    assert cache.get("a") == patient
+    assert cache.get("b") is None
+    assert cache.stats()["hit_rate"] == 0.5
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_note_to_fhir_result_cache(make_translator, fake_generator, patient):
+    cache = MemoryResultCache()
+    translator = make_translator(result_cache=cache)
+    translator.generator = fake_generator(lambda prompt: patient)  # generates the same FHIR for every prompt
+    assert translator.translate("Sofie de Jong") == patient
+    assert translator.translate("Sofie  de Jong\n") == patient
+    assert len(translator.generator.calls) == 1
+    results = translator.translate_batch(["a b", "Sofie de Jong", "a  b", "c"], batch_size=2)
+    assert results == [patient] * 4
+    prompts = [translator.template.format(note=note) for note in ["c", "a b"]]  # sorted by length
+    assert translator.generator.calls[1:] == [prompts]
+    assert cache.stats()["hits"] == 2
+
+
+def test_result_cache_is_abstract():
+    with pytest.raises(TypeError):
+        ResultCache()
+
+
+def test_note_to_fhir_result_cache_not_used_when_sampling(make_translator, fake_generator, patient):
+    cache = MemoryResultCache()
+    translator = make_translator(result_cache=cache, inference_config=InferenceConfig(do_sample=True))
+    translator.generator = fake_generator(lambda prompt: patient)
+    translator.translate("a")
+    translator.translate_batch(["a", "a"])
+    assert sum(len(prompts) for prompts in translator.generator.calls) == 3  # duplicates are sampled separately
+    assert len(cache) == 0
+    assert cache.stats()["hits"] == cache.stats()["misses"] == 0
@@ -0,0 +1,141 @@
+import numpy as np
+import pytest
+from healthsageai.note_to_fhir.evaluation import utils
+from healthsageai.note_to_fhir.evaluation.score_cache import SubtreeScoreCache, subtree_hash
+from healthsageai.note_to_fhir.evaluation.scores import ScoreTable
+from healthsageai.note_to_fhir.evaluation.utils import get_diff, get_score, iter_diff_nodes
+
+@pytest.fixture
+def fhir_true(make_bundle, patient):
+    condition = {
+        "resourceType": "Condition",
+        "code": {"coding": [{"display": "Asthma"}], "text": "Asthma"},
+        "subject": {"reference": "Patient/1"},
+        "onsetDateTime": "2021-06-06T19:50:28+02:00",
+    }
+    return make_bundle({**patient, "id": "1"}, condition)
+
+
+@pytest.fixture
+def fhir_pred(make_bundle, patient):
+    condition = {
+        "resourceType": "Condition",
+        "code": {"coding": [{"display": "Astma"}], "text": "Asthma"},
+        "subject": {"reference": "Patient/2"},
+        "onsetDateTime": "2021-06-06T19:50:59+02:00",
+    }
+    patient = {
+        **patient,
+        "id": "2",
+        "name": [{"family": "de Jong", "given": ["Sofie", "Anna"]}],
+        "gender": None,
+        "deceasedBoolean": False,
+    }
+    del patient["birthDate"]
+    return make_bundle(condition, patient)
+
+
+def test_score_equals_diff_score(fhir_true, fhir_pred):
+    for strategy in ["auto", "approx", "hungarian"]:
+        diff = get_diff(fhir_true, fhir_pred, "Bundle", array_order_strategy=strategy)
+        score = get_score(fhir_true, fhir_pred, "Bundle", array_order_strategy=strategy)
+        assert score == diff.score
+        assert score.n_leaves > 0
+
+
+def test_score_identical_resources(fhir_true):
+    score = get_score(fhir_true, fhir_true, "Bundle")
+    assert score.accuracy == 1.0
+    assert score.n_matches == score.n_leaves
+
+
+def test_diff_deeply_nested():
+    extension = {"url": "http://example.org/leaf", "valueString": "x"}
+    for _ in range(1500):
+        extension = {"url": "http://example.org/node", "extension": [extension]}
+    patient = {"resourceType": "Patient", "extension": [extension]}
+    diff = get_diff(patient, patient, "Patient")
+    assert diff.score.n_leaves == diff.score.n_matches == 1502
+    nodes = list(iter_diff_nodes(diff))
+    assert len(nodes) == 3004
+    deepest = max(nodes, key=lambda node: len(node.label))
+    assert deepest.label.startswith("Patient.extension.0.extension.0.")
+    assert deepest.label.count("extension") == 1501
+    assert deepest.detached().label == "valueString"
+    assert get_score(patient, patient, "Patient") == diff.score
+
+
+def test_score_cache_reused_across_calls(fhir_true, fhir_pred):
+    score_cache = SubtreeScoreCache()
+    score = get_score(fhir_true, fhir_pred, "Bundle", score_cache=score_cache)
+    stats = score_cache.stats()
+    assert stats["misses"] == stats["size"] > 0
+    assert get_score(fhir_true, fhir_pred, "Bundle") == score
+    diff = get_diff(fhir_true, fhir_pred, "Bundle", score_cache=score_cache)
+    assert diff.score == score
+    assert score_cache.stats()["hits"] > stats["hits"]
+    assert score_cache.stats()["size"] == stats["size"]
+
+
+def test_score_cache_keyed_on_resolved_strategy(fhir_true, fhir_pred, monkeypatch):
+    score_cache = SubtreeScoreCache()
+    get_score(fhir_true, fhir_pred, "Bundle", score_cache=score_cache)
+    misses = score_cache.stats()["misses"]
+    # None resolves to ARRAY_ORDER_STRATEGY, so the scores are reused
+    get_score(fhir_true, fhir_pred, "Bundle", array_order_strategy=utils.ARRAY_ORDER_STRATEGY, score_cache=score_cache)
+    assert score_cache.stats()["misses"] == misses
+    # A different threshold for exact ordering may order nested arrays differently
+    threshold = utils.MAX_PERMUTATIONS_ARRAY_SIZE
+    monkeypatch.setattr(utils, "MAX_PERMUTATIONS_ARRAY_SIZE", 1)
+    get_score(fhir_true, fhir_pred, "Bundle", score_cache=score_cache)
+    assert score_cache.stats()["misses"] > misses
+    assert {key[-2:] for key in score_cache._counts} == {("auto", threshold), ("auto", 1)}
+
+
+def test_subtree_hash():
+    coding = {"system": "http://loinc.org", "code": "39156-5"}
+    fhir = {"code": {"coding": [coding, coding]}, "valueString": "#x"}
+    reordered = {"valueString": "#x", "code": {"coding": [dict(reversed(coding.items()))] * 2}}
+    assert subtree_hash(fhir) == subtree_hash(reordered)
+    assert subtree_hash(fhir) != subtree_hash({**fhir, "valueString": "#y"})
+    assert subtree_hash([1, "1"]) != subtree_hash(["1", 1])
+    memo = {}
+    assert subtree_hash(fhir, memo) == subtree_hash(fhir)
+    # Each nested dict and list is hashed once, and its hash is reused
+    assert len(memo) == 4
+    assert memo[id(coding)][1] == subtree_hash(coding)
+
+
+def test_score_cache_hash_scope():
+    score_cache = SubtreeScoreCache()
+    item = {"text": "a"}
+    with score_cache.scope():
+        with score_cache.scope():
+            score_cache.hash([item])
+        assert len(score_cache._hashes) == 2
+    assert not score_cache._hashes
+
+
+def test_score_cache_evicts_least_recently_used():
+    score_cache = SubtreeScoreCache(maxsize=2)
+    score_cache.put(("a",), (1, 0, 0, 0, 1))
+    score_cache.put(("b",), (1, 0, 0, 0, 1))
+    assert score_cache.get(("a",)) == (1, 0, 0, 0, 1)
+    score_cache.put(("c",), (1, 0, 0, 0, 1))
+    assert score_cache.get(("b",)) is None
+    assert score_cache.stats()["evictions"] == 1
+    assert score_cache.stats()["size"] == 2
+
+
+def test_score_table_metrics(fhir_true, fhir_pred):
+    diff = get_diff(fhir_true, fhir_pred, "Bundle")
+    scores = [node.score for node in iter_diff_nodes(diff)]
+    table = ScoreTable.from_scores(scores)
+    assert table.to_scores() == scores
+    assert table.total() == sum(scores)
+    for metric in ["accuracy", "precision", "recall"]:
+        expected = np.array([getattr(score, metric) for score in scores], dtype=float)
+        np.testing.assert_array_equal(getattr(table, metric)(), expected)
+    groups = np.array([1 if score.n_leaves > 1 else 0 for score in scores])
+    sums = table.group_sum(groups).to_scores()
+    assert sums[1] == sum(score for score in scores if score.n_leaves > 1)
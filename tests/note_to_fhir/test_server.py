@@ -0,0 +1,68 @@
+import asyncio
+import time
+import pytest
+from healthsageai.note_to_fhir.inference.server import NoteToFhirServer
+
+
+class StubTranslator(object):
+    def __init__(self, delay: float = 0.0) -> None:
+        self.delay = delay
+        self.batches = []
+
+    def translate_batch(self, notes, batch_size=8):
+        time.sleep(self.delay)
+        self.batches.append(list(notes))
+        return [ValueError(note) if note == "fail" else {"note": note} for note in notes]
+
+
+def test_server_coalesces_requests():
+    translator = StubTranslator(delay=0.05)
+    server = NoteToFhirServer(translator, max_batch_size=4, max_wait=0.05)
+
+    async def main():
+        async with server:
+            first = await server.translate("first")
+            # These arrive while nothing is generating, and are batched by max_batch_size
+            results = await asyncio.gather(
+                *[server.translate(str(i)) for i in range(6)], server.translate("fail"), return_exceptions=True
+            )
+        return first, results
+
+    first, results = asyncio.run(main())
+    assert first == {"note": "first"}
+    assert results[:6] == [{"note": str(i)} for i in range(6)]
+    assert isinstance(results[6], ValueError)
+    assert [len(batch) for batch in translator.batches] == [1, 4, 3]
+
+    stats = server.stats()
+    assert stats["requests"] == 8
+    assert stats["failed"] == 1
+    assert stats["batches"] == 3
+    assert stats["mean_batch_size"] == 8 / 3
+    assert stats["max_queue_depth"] >= 4
+    assert stats["queue_depth"] == 0
+    assert stats["p95_latency"] >= stats["p50_latency"] >= 0.05
+
+
+def test_server_not_running():
+    server = NoteToFhirServer(StubTranslator())
+    with pytest.raises(RuntimeError):
+        asyncio.run(server.translate("a"))
+
+
+def test_server_with_note_to_fhir(make_translator, fake_generator):
+    translator = make_translator()
+    notes = ["a", "b c", "c"]
+    prompt_notes = {translator.template.format(note=note): note for note in notes}
+    # Echoes the note as a Patient name
+    translator.generator = fake_generator(
+        lambda prompt: {"resourceType": "Patient", "name": [{"text": prompt_notes[prompt]}]}
+    )
+
+    async def main():
+        async with NoteToFhirServer(translator, max_batch_size=8, max_wait=0.05) as server:
+            return await asyncio.gather(*[server.translate(note) for note in notes])
+
+    results = asyncio.run(main())
+    assert [result["name"][0]["text"] for result in results] == notes
+    assert [len(prompts) for prompts in translator.generator.calls] == [3]
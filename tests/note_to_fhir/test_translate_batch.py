@@ -0,0 +1,68 @@
+import pytest
+
+
+@pytest.fixture
+def translator(make_translator, fake_generator):
+    """NoteToFhir whose stub pipeline echoes each note as the text of a Patient name. The note "unparseable"
+    generates text without FHIR, and a call with the note "fail" raises."""
+    translator = make_translator()
+    prefix, suffix = translator.template.split("{note}")
+
+    def fhir_for_prompt(prompt):
+        note = prompt[len(prefix) : len(prompt) - len(suffix)]
+        if note == "unparseable":
+            return "no code block"
+        if note == "fail":
+            raise RuntimeError("generation failed")
+        return {"resourceType": "Patient", "name": [{"text": note}]}
+
+    translator.generator = fake_generator(fhir_for_prompt)
+    return translator
+
+
+def _texts(results):
+    return [result["name"][0]["text"] if isinstance(result, dict) else result for result in results]
+
+
+def _notes(translator):
+    """Notes of the prompts of each generation call"""
+    prefix, suffix = translator.template.split("{note}")
+    return [[prompt[len(prefix) : len(prompt) - len(suffix)] for prompt in call] for call in translator.generator.calls]
+
+
+def test_translate_batch_input_order(translator):
+    notes = ["a b c", "a", "b c", "c"]
+    assert _texts(translator.translate_batch(notes, batch_size=2)) == notes
+    # Generated shortest first
+    assert _notes(translator) == [["a", "c"], ["b c", "a b c"]]
+
+
+def test_translate_stream_windows(translator):
+    read = []
+
+    def notes():
+        for note in ["a b c", "a", "b", "c c", "a a"]:
+            read.append(note)
+            yield note
+
+    results = translator.translate_stream(notes(), batch_size=2, window_size=3)
+    assert _texts([next(results)]) == ["a b c"]
+    assert read == ["a b c", "a", "b"]  # only the first window is read
+    assert _notes(translator) == [["a", "b"], ["a b c"]]
+    assert _texts(results) == ["a", "b", "c c", "a a"]
+    assert _notes(translator)[2:] == [["c c", "a a"]]
+
+
+def test_translate_batch_parse_failure(translator):
+    results = translator.translate_batch(["a", "unparseable", "b"], batch_size=3)
+    assert _texts([results[0], results[2]]) == ["a", "b"]
+    assert isinstance(results[1], Exception)
+    assert len(translator.generator.calls) == 1
+
+
+def test_translate_batch_retries_failed_batch(translator):
+    results = translator.translate_batch(["a", "fail", "b"], batch_size=3)
+    assert _texts([results[0], results[2]]) == ["a", "b"]
+    assert isinstance(results[1], RuntimeError)
+    # The failed batch is retried per prompt
+    assert _notes(translator) == [["a", "fail", "b"], ["a"], ["fail"], ["b"]]
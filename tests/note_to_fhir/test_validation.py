@@ -0,0 +1,76 @@
+from concurrent.futures import ThreadPoolExecutor
+from healthsageai.note_to_fhir.evaluation.corpus import evaluate_corpus
+from healthsageai.note_to_fhir.evaluation.utils import get_diff, iter_diff_nodes, validate_resource
+from healthsageai.note_to_fhir.evaluation.validation import ResourceValidator
+
+invalid_patient = {"resourceType": "Patient", "birthDate": "01-01-1970"}
+observation_without_code = {"resourceType": "Observation", "status": "final"}
+
+
+def test_validate(make_bundle, patient):
+    validator = ResourceValidator()
+    assert validator.validate(patient).is_valid
+    assert validate_resource(patient)
+    assert not validate_resource(invalid_patient)
+
+    result = validator.validate(make_bundle(patient, invalid_patient))
+    assert not result.is_valid
+    assert [error.loc for error in result.errors] == [("entry", 1, "resource", "birthDate")]
+    assert result.errors[0].path == "entry.1.resource.birthDate"
+
+    result = validator.validate(observation_without_code)
+    assert result.errors[0].loc == ("code",)
+    assert result.errors[0].type == "value_error.missing"
+
+    assert not validator.validate({"gender": "female"}).is_valid
+    assert not validator.validate({"resourceType": "Spaceship"}).is_valid
+    assert validator.validate({"family": "de Jong"}, "HumanName").is_valid
+
+
+def test_validate_entries(make_bundle, patient):
+    validator = ResourceValidator()
+    bundle = make_bundle(patient, invalid_patient, observation_without_code)
+    results = validator.validate_entries(bundle)
+    assert [result.is_valid for result in results] == [True, False, False]
+    assert [result.resource_type for result in results] == ["Patient", "Patient", "Observation"]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert validator.validate_entries(bundle, executor) == results
+    assert results[1].errors[0].loc == ("birthDate",)
+
+
+def test_get_diff_validate(make_bundle, patient):
+    fhir_true = make_bundle(patient)
+    assert get_diff(fhir_true, make_bundle(patient), "Bundle").score.is_valid is None
+    assert get_diff(fhir_true, make_bundle(patient), "Bundle", validate=True).score.is_valid
+    assert get_diff(fhir_true, make_bundle(invalid_patient), "Bundle", validate=True).score.is_valid is False
+    compact = get_diff(fhir_true, make_bundle(invalid_patient), "Bundle", compact=True, validate=True)
+    assert compact.score.is_valid is False
+
+    pairs = [(fhir_true, make_bundle(patient)), (fhir_true, make_bundle(invalid_patient))]
+    evaluation = evaluate_corpus(pairs, workers=1, validate=True)
+    assert evaluation.n_valid == 1
+    assert evaluation.score.is_valid is False
+    assert [score.is_valid for score in evaluation.record_scores] == [True, False]
+    assert evaluate_corpus(pairs, workers=1).n_valid is None
+
+
+def test_validate_diff(make_bundle, patient):
+    observation = {**observation_without_code, "code": {"coding": [{"userSelected": "maybe"}]}, "valueQuantity": "30 kg"}
+    fhir_pred = make_bundle(patient, observation)
+    diff = get_diff(make_bundle(patient, observation_without_code), fhir_pred, "Bundle", validate=True)
+    nodes = {node.label: node for node in iter_diff_nodes(diff)}
+
+    # Each node only reports the errors in its own elements
+    observation_node = nodes["Bundle.entry.1.Observation"]
+    assert not observation_node.validation.self_is_valid
+    assert [error.loc[0] for error in observation_node.validation.errors] == ["valueQuantity"]
+    assert nodes["Bundle.entry.1.Observation.code"].validation.self_is_valid
+    assert not nodes["Bundle.entry.1.Observation.code.coding.0"].score.is_valid
+    assert nodes["Bundle.entry.0.Patient"].score.is_valid
+    assert nodes["Bundle.entry.0"].score.is_valid
+    assert nodes["Bundle.entry.0.Patient.gender"].validation is None
+
+    assert diff.validation.n_nodes == 8  # Bundle, 2 entries, Patient, its HumanName, Observation, code, coding
+    assert diff.validation.n_invalid_nodes == 2
+    assert diff.score.is_valid is False
+    assert diff.score.is_valid == validate_resource(fhir_pred)